@@ -0,0 +1,441 @@
+""" Offline benchmarks with a recording mock of the EE API
+
+Runs the request paths of the tool (server.GetMapData, emiss.getEmissions,
+land.getLandcoverData and the health functions) over a matrix of scenarios
+without Earth Engine. MockEE replaces the ee module: every ee object built
+is a Node that records its call, every getInfo and getMapId is a round trip
+that sleeps LATENCY seconds and answers with a value shaped like the EE
+response (see MockEE.respond), so the code after it runs as well.
+
+For every case it reports
+  - nodes_constructed: ee expression nodes built,
+  - nodes_evaluated: distinct nodes of the expressions sent to EE, summed
+    over the round trips,
+  - round_trips: blocking calls to EE,
+  - cpu_seconds and wall_seconds: Python-side time, with simulated latency,
+  - peak_kb: growth of the peak resident memory.
+Each case runs in a fresh process, so instance caches start cold.
+
+    python benchmark.py run [name filter]
+    python benchmark.py update [name filter]
+
+run fails when a case is worse than its entry in BASELINES_PATH: any
+increase of the node and round trip counts, CPU time or memory beyond
+TOLERANCE. update stores the current results as the new baselines.
+The App Engine SDK has to be on the path, as for the development server.
+"""
+
+import inspect
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import types
+
+
+class Node(object):
+    """An ee expression: a function, its arguments and, for methods, the
+    object it was called on."""
+
+    def __init__(self, mock, func, args, kwargs):
+        self._mock = mock
+        self.func = func
+        self.args = tuple(mock.wrap(arg) for arg in args)
+        self.kwargs = dict((key, mock.wrap(value)) for key, value in kwargs.items())
+        mock.constructed(self)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        mock = self._mock
+
+        def method(*args, **kwargs):
+            return Node(mock, name, (self,) + args, kwargs)
+        return method
+
+    def getInfo(self):
+        return self._mock.roundTrip('getInfo', self)
+
+    def getMapId(self, vizParams=None):
+        self._mock.roundTrip('getMapId', self)
+        return {'mapid': 'mock', 'token': 'mock'}
+
+    def children(self):
+        values = list(self.args) + list(self.kwargs.values())
+        while values:
+            value = values.pop()
+            if isinstance(value, Node):
+                yield value
+            elif isinstance(value, Function):
+                yield value.body
+            elif isinstance(value, (list, tuple)):
+                values.extend(value)
+            elif isinstance(value, dict):
+                values.extend(value.values())
+
+
+class Function(object):
+    """A Python function passed to ee (map, iterate), with the expression it
+    returned for placeholder arguments."""
+
+    def __init__(self, mock, function):
+        spec = inspect.getargspec(function)
+        count = len(spec.args) - (1 if inspect.ismethod(function) else 0)
+        self.body = mock.wrap(function(*[Node(mock, 'argument', (), {}) for i in range(count)]))
+
+
+class Constructor(object):
+    """ee.Image, ee.List, ...: calling it or its static methods builds nodes."""
+
+    def __init__(self, mock, name):
+        self._mock = mock
+        self._name = name
+
+    def __call__(self, *args, **kwargs):
+        return Node(self._mock, self._name, args, kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Constructor(self._mock, self._name + '.' + name)
+
+
+class MockTask(object):
+    """A batch task of ee.batch.Export."""
+
+    def __init__(self, mock):
+        self._mock = mock
+        self.id = 'MOCKTASK'
+
+    def start(self):
+        self._mock.roundTrip('startTask', None)
+
+    def status(self):
+        return {'id': self.id, 'state': 'READY'}
+
+
+class MockEE(types.ModuleType):
+    """Stands in for the ee module and records what is done with it."""
+
+    def __init__(self):
+        types.ModuleType.__init__(self, 'ee')
+        self.EEException = type('EEException', (Exception,), {})
+        self.latency = LATENCY
+        self._lock = threading.Lock()
+        self.reset()
+
+        mock = self
+
+        class Data(object):
+            def getInfo(self, asset_id):
+                mock.roundTrip('getAssetInfo', None)
+                return {'id': asset_id, 'updateTime': 'mock'}
+
+            def getTaskStatus(self, task_ids):
+                mock.roundTrip('getTaskStatus', None)
+                return [{'id': task_id, 'state': 'COMPLETED'} for task_id in task_ids]
+
+        class Export(object):
+            def __getattr__(self, name):
+                return self
+
+            def __call__(self, *args, **kwargs):
+                return MockTask(mock)
+
+        self.data = Data()
+        self.batch = types.ModuleType('ee.batch')
+        self.batch.Export = Export()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Constructor(self, name)
+
+    def Initialize(self, credentials=None):
+        pass
+
+    def ServiceAccountCredentials(self, account, key_file):
+        return None
+
+    def reset(self):
+        with self._lock:
+            self.nodes_constructed = 0
+            self.nodes_evaluated = 0
+            self.calls = {}
+
+    def wrap(self, value):
+        if callable(value) and not isinstance(value, (Node, Constructor, type)):
+            return Function(self, value)
+        return value
+
+    def constructed(self, node):
+        with self._lock:
+            self.nodes_constructed += 1
+
+    def roundTrip(self, kind, root):
+        nodes = countNodes(root) if root is not None else 0
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+            self.nodes_evaluated += nodes
+        time.sleep(self.latency)
+        return self.respond(root)
+
+    def recordGraph(self, root):
+        """Counts the expression root as evaluated, without a round trip."""
+        nodes = countNodes(Node(self, 'List', (root,), {}))
+        with self._lock:
+            self.nodes_evaluated += nodes
+
+    def respond(self, value):
+        """Returns a made up value of the shape EE would return for value:
+        reductions give a number for any band, mapped collections 12
+        features or elements, constructors with Python arguments their
+        arguments evaluated."""
+        if isinstance(value, dict):
+            return dict((key, self.respond(item)) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return [self.respond(item) for item in value]
+        if isinstance(value, Function):
+            return self.respond(value.body)
+        if not isinstance(value, Node):
+            return value
+
+        if value.func == 'Feature':
+            properties = value.args[1] if len(value.args) > 1 else {}
+            return {'type': 'Feature', 'geometry': None, 'properties': self.respond(properties)}
+        if value.func in CONSTRUCTORS and value.args:
+            return self.respond(value.args[0])
+        if value.func == 'map':
+            items = [self.respond(value.args[1]) for i in range(MAPPED_ELEMENTS)]
+            if items and isinstance(items[0], dict) and items[0].get('type') == 'Feature':
+                return {'type': 'FeatureCollection', 'features': items}
+            return items
+        if value.func == 'reduceRegion':
+            return BandValues()
+        if value.func == 'format':
+            return 'mock'
+        return 1.0
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'nodes_constructed': self.nodes_constructed,
+                'nodes_evaluated': self.nodes_evaluated,
+                'round_trips': sum(self.calls.values()),
+                'calls': dict(self.calls),
+            }
+
+
+class BandValues(dict):
+    """A reduceRegion result, with a value for every band."""
+
+    def __init__(self):
+        dict.__init__(self, ((band, 1.0) for band in ['b1', 'b2', 'b3', 'b4', 'b5', 'b6', 'oc', 'bc']))
+
+    def __missing__(self, key):
+        return 1.0
+
+
+def countNodes(root):
+    """Returns the number of distinct nodes of the expression root."""
+    seen = set([id(root)])
+    pending = [root]
+    while pending:
+        for child in pending.pop().children():
+            if id(child) not in seen:
+                seen.add(id(child))
+                pending.append(child)
+    return len(seen)
+
+
+def install():
+    """Installs MockEE as the ee module and returns it. Must run before
+    anything imports ee."""
+    if isinstance(sys.modules.get('ee'), MockEE):
+        return sys.modules['ee']
+    if 'ee' in sys.modules:
+        raise RuntimeError('ee was imported before the mock was installed')
+    sys.modules['ee'] = MockEE()
+    return sys.modules['ee']
+
+
+class Case(object):
+    """A benchmark case: a call of one of the request paths."""
+
+    def __init__(self, name, call):
+        self.name = name
+        self.call = call
+
+
+def scenarioCases():
+    """Returns the benchmark cases: the default scenario of every receptor,
+    every policy toggle, all toggles and province selections, for a GFED4
+    and a land cover transition scenario, and the land cover and health
+    paths."""
+    import emiss
+    import health
+    import land
+    import numpy as np
+    import server
+
+    def mapData(params):
+        return lambda: server.GetMapData(**params)
+
+    def emissions(params):
+        def call():
+            toggles = [params[layer] for layer in POLICY_LAYERS]
+            # nothing is evaluated here, count the graph that would be
+            sys.modules['ee'].recordGraph(list(emiss.getEmissions(params['scenario'], YEAR, YEAR, *toggles + [params['provinces']])))
+        return call
+
+    cases = []
+    for scenario in SCENARIOS:
+        def params(receptor='Singapore', toggles=(), provinces=()):
+            values = {'scenario': scenario, 'receptor': receptor, 'metYear': YEAR, 'emissYear': YEAR, 'provinces': list(provinces)}
+            for layer in POLICY_LAYERS:
+                values[layer] = layer in toggles
+            return values
+
+        variants = [(receptor + '/none', params(receptor)) for receptor in RECEPTORS]
+        variants += [('Singapore/' + layer, params(toggles=[layer])) for layer in POLICY_LAYERS]
+        variants += [('Singapore/all', params(toggles=POLICY_LAYERS))]
+        variants += [('Singapore/provinces_{}'.format(len(provinces)), params(provinces=provinces)) for provinces in [PROVINCES[:1], PROVINCES]]
+        variants += [('Singapore/all_provinces_{}'.format(len(PROVINCES)), params(toggles=POLICY_LAYERS, provinces=PROVINCES))]
+        for label, values in variants:
+            cases.append(Case('map_data/{}/{}'.format(scenario, label), mapData(values)))
+        # the emissions do not depend on the receptor
+        for label, values in variants[len(RECEPTORS) - 1:]:
+            cases.append(Case('emissions/{}/{}'.format(scenario, label.split('/', 1)[1]), emissions(values)))
+
+    cases.append(Case('landcover', land.getLandcoverData))
+    cases.append(Case('health/single', lambda: health.getAttributableMortality('Singapore', 10.0, 'adult')))
+    for count in [1, 1000]:
+        cases.append(Case('health/batch_{}'.format(count), lambda count=count: health.getAttributableMortalityBatch(np.linspace(0.0, 50.0, count))))
+    return cases
+
+
+def runCase(case):
+    """Runs case in a new process and returns its metrics."""
+    parent, child = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        try:
+            mock = sys.modules['ee']
+            mock.reset()
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            # keep the progress prints of the app out of the report
+            sys.stdout = open(os.devnull, 'w')
+            start = timeit.default_timer()
+            case.call()
+            wall = timeit.default_timer() - start
+            sys.stdout = sys.__stdout__
+            end = resource.getrusage(resource.RUSAGE_SELF)
+            metrics = mock.metrics()
+            metrics['cpu_seconds'] = (end.ru_utime + end.ru_stime) - (usage.ru_utime + usage.ru_stime)
+            metrics['wall_seconds'] = wall
+            metrics['peak_kb'] = end.ru_maxrss - peak
+            child.send(metrics)
+        except Exception as e:
+            child.send({'error': '{}: {}'.format(type(e).__name__, e)})
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    metrics = parent.recv()
+    process.join()
+    return metrics
+
+
+def compare(metrics, baseline):
+    """Returns the regressions of metrics against baseline, as strings."""
+    if 'error' in metrics:
+        return [metrics['error']]
+    regressions = []
+    for name in COUNT_METRICS:
+        if metrics[name] > baseline.get(name, metrics[name]):
+            regressions.append('{} {} > {}'.format(name, metrics[name], baseline[name]))
+    for name, slack in TIMED_METRICS:
+        if name in baseline and metrics[name] > baseline[name] * (1 + TOLERANCE) + slack:
+            regressions.append('{} {:.3f} > {:.3f}'.format(name, metrics[name], baseline[name]))
+    return regressions
+
+
+def main(command, pattern=''):
+    install()
+    import surface
+    # precomputed response surfaces would skip the scalar evaluation
+    surface.SURFACE_DIR = tempfile.mkdtemp()
+
+    baselines = {}
+    if os.path.exists(BASELINES_PATH):
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+
+    failed = 0
+    results = {}
+    for case in scenarioCases():
+        if pattern not in case.name:
+            continue
+        metrics = results[case.name] = runCase(case)
+        if 'error' in metrics:
+            print('{:55} ERROR {}'.format(case.name, metrics['error']))
+            failed += 1
+            continue
+        regressions = compare(metrics, baselines[case.name]) if case.name in baselines else []
+        print('{:55} nodes {:6d}/{:6d}  trips {:3d}  cpu {:7.3f} s  wall {:7.3f} s  peak {:7d} kB{}'.format(
+            case.name, metrics['nodes_evaluated'], metrics['nodes_constructed'], metrics['round_trips'],
+            metrics['cpu_seconds'], metrics['wall_seconds'], metrics['peak_kb'],
+            '' if case.name in baselines else '  (no baseline)'))
+        for regression in regressions:
+            print('    REGRESSION ' + regression)
+        failed += bool(regressions)
+
+    if command == 'update':
+        baselines.update((name, metrics) for name, metrics in results.items() if 'error' not in metrics)
+        with open(BASELINES_PATH, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print('updated {} baselines'.format(len(results)))
+        return 0
+    print('{} of {} cases failed'.format(failed, len(results)))
+    return 1 if failed else 0
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+# Simulated seconds per round trip.
+LATENCY = 0.05
+
+# Elements of every mapped collection or list in made up responses.
+MAPPED_ELEMENTS = 12
+
+# ee constructors that only cast their argument
+CONSTRUCTORS = ['Image', 'ImageCollection', 'List', 'Dictionary', 'FeatureCollection', 'Number', 'String', 'Date']
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+# Counts may not grow at all, times and memory by TOLERANCE plus a slack.
+COUNT_METRICS = ['nodes_constructed', 'nodes_evaluated', 'round_trips']
+TIMED_METRICS = [('cpu_seconds', 0.05), ('peak_kb', 4096)]
+TOLERANCE = 0.5
+
+# The scenario matrix: a GFED4 and a land cover transition scenario.
+SCENARIOS = ['GFED4', 'Miriam']
+YEAR = 2006
+RECEPTORS = ['Singapore', 'Malaysia', 'Indonesia', 'Population_weighted_SEAsia']
+POLICY_LAYERS = ['logging', 'oilpalm', 'timber', 'peatlands', 'conservation', 'BRGsites']
+PROVINCES = ['Riau', 'Jambi', 'Sumatera Selatan', 'Kalimantan Barat', 'Kalimantan Tengah', 'Kalimantan Selatan',
+             'Kalimantan Timur', 'Sumatera Utara', 'Kepulauan Riau', 'Bangka-Belitung', 'Lampung', 'Papua']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) in (2, 3) and sys.argv[1] in ('run', 'update'):
+        sys.exit(main(*sys.argv[1:]))
+    else:
+        print('usage: benchmark.py run|update [name filter]')
@@ -1,8 +1,17 @@
 #!/bin/bash
 
 # This Bash script (1) builds Python dependencies needed to run and deploy
-# the Trendy Lights application and (2) installs the Google App Engine
-# developer tools if they aren't found on the system.
+# the Trendy Lights application, (2) builds the region overlay tiles and (3)
+# installs the Google App Engine developer tools if they aren't found on the
+# system.
+#
+# With the argument "assets" it instead starts the exports of the Earth
+# Engine assets the app reads, see README.md for the build order.
+
+if [ "$1" == "assets" ]; then
+  python regrid.py build && python provinceids.py build && python emiss.py build
+  exit $?
+fi
 
 # Builds the specified dependency if it hasn't been built. Takes 3 parameters:
 #   1. The URL of the git repo.
@@ -32,6 +41,10 @@ BuildDep https://github.com/google/earthengine-api.git v0.1.60 python/ee
 # Build httplib2.
 BuildDep https://github.com/jcgregorio/httplib2.git tags/v0.9.1 python2/httplib2
 
+# Build the region overlay tiles, which are not in git but are deployed
+# (see .gcloudignore).
+python regiontiles.py build
+
 # Install the Google App Engine command line tools.
 if ! hash dev_appserver.py 2>/dev/null; then
   # Install the `gcloud` command line tool.
@@ -0,0 +1,120 @@
+""" Scenario result cache
+
+Stores the full response of a scenario (map ids, tokens, exposure, totals,
+mortality and emissions) so that repeated requests do not have to run
+GetMapData against Earth Engine again. Lookups go to a small in-process LRU
+first and then to memcache, which is shared between instances.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+def scenarioKey(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+    """Returns a canonical cache key for a set of scenario parameters.
+
+    Years are compared as integers, the policy toggles as booleans and the
+    provinces as a sorted list without duplicates, so that equivalent requests
+    always map to the same key.
+    """
+    params = {
+        'scenario': str(scenario),
+        'receptor': str(receptor),
+        'metYear': int(metYear),
+        'emissYear': int(emissYear),
+        'logging': bool(logging),
+        'oilpalm': bool(oilpalm),
+        'timber': bool(timber),
+        'peatlands': bool(peatlands),
+        'conservation': bool(conservation),
+        'BRGsites': bool(BRGsites),
+        'provinces': sorted(set(provinces)),
+    }
+    canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    return KEY_PREFIX + hashlib.sha1(canonical).hexdigest()
+
+
+class ScenarioCache(object):
+    """Two-tier (in-process LRU, then memcache) cache of scenario results."""
+
+    def __init__(self, max_age, token_lifetime, max_entries=None):
+        self.max_entries = max_entries or LRU_SIZE
+        self.max_age = max_age
+        self.token_lifetime = token_lifetime
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.memcache_hits = 0
+        self.misses = 0
+
+    def lifetime(self):
+        """Returns the number of seconds an entry stays valid.
+
+        Cached map ids are useless once their tokens expire, so entries never
+        outlive the token lifetime even if max_age is longer.
+        """
+        return min(self.max_age, self.token_lifetime)
+
+    def get(self, key):
+        """Returns the cached payload for key, or None if missing or expired."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry['expires'] > now:
+                    # move to the most recently used end
+                    del self._entries[key]
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return entry['payload']
+                del self._entries[key]
+
+        entry = memcache.get(key)
+        if entry is not None and entry['expires'] > now:
+            self._store(key, entry)
+            with self._lock:
+                self.memcache_hits += 1
+            return entry['payload']
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, payload):
+        """Stores payload in both tiers."""
+        lifetime = self.lifetime()
+        entry = {'expires': time.time() + lifetime, 'payload': payload}
+        self._store(key, entry)
+        memcache.set(key, entry, time=lifetime)
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Returns the hit/miss counts of this instance."""
+        with self._lock:
+            lookups = self.hits + self.memcache_hits + self.misses
+            return {'hits': self.hits,
+                    'memcache_hits': self.memcache_hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'hit_rate': (self.hits + self.memcache_hits) / float(lookups) if lookups else 0.0}
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+KEY_PREFIX = 'scenario:v1:'
+
+# number of scenario results kept in instance memory
+LRU_SIZE = 64
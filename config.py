@@ -15,4 +15,35 @@ EE_ACCOUNT = 'smoke-policy-tool@appspot.gserviceaccount.com'
 # openssl pkcs12 -in downloaded-privatekey.p12 -nodes -nocerts > privatekey.pem
 EE_PRIVATE_KEY_FILE = 'privatekey.pem'
 
-EE_CREDENTIALS = ee.ServiceAccountCredentials(EE_ACCOUNT, EE_PRIVATE_KEY_FILE)
+
+def getCredentials():
+    """Returns the service account credentials, created on first use so that
+    importing config does not read the key file."""
+    global _EE_CREDENTIALS
+    if _EE_CREDENTIALS is None:
+        _EE_CREDENTIALS = ee.ServiceAccountCredentials(EE_ACCOUNT, EE_PRIVATE_KEY_FILE)
+    return _EE_CREDENTIALS
+
+_EE_CREDENTIALS = None
+
+
+# When True, diagnostic-only EE evaluations (scales, band names, intermediate
+# totals) run and are printed for every request. Leave False in production;
+# a single request can still turn them on with ?debug=1 or the
+# X-Debug-Diagnostics header.
+DEBUG_DIAGNOSTICS = False
+
+# When True, every request reports the size of the EE expression graphs it
+# builds and sends (see graphprofile.py). Serializing the graphs is slow, so
+# leave False in production; a single request can turn it on with
+# ?profile=graphs or the X-Profile-Graphs header.
+PROFILE_GRAPHS = False
+
+# Where scenario jobs (/jobs, /export) run: 'taskqueue' for the App Engine
+# task queue, 'thread' for a pool of threads in the instance that received
+# the job (local runs only, App Engine stops such threads with the request).
+JOB_BACKEND = 'taskqueue'
+
+# Where computed scenario results are kept between instances and deploys:
+# 'datastore' on App Engine, 'sqlite' for local runs (see store.py).
+RESULT_STORE = 'datastore'
@@ -0,0 +1,256 @@
+""" Round-trip accounting for Earth Engine calls
+
+Every blocking call to the EE servers (getInfo, getMapId) should go through
+getInfo() and getMapId() below, which count and time the call against the
+current request. Values that are only printed for debugging go through
+debugInfo(), which skips the round trip entirely unless diagnostics are turned
+on for the request (config.DEBUG_DIAGNOSTICS, ?debug=1 or the
+X-Debug-Diagnostics header). With graph profiling on, the request also
+collects the expression graph sizes of graphprofile.py.
+
+The stages of a request are timed with stage(); endRequest logs them as one
+JSON line, and serverTiming() formats them for the Server-Timing header.
+Stages named with BUILD_PREFIX only construct EE expression graphs, which is
+client work; the evaluation of the graphs is timed by the stages that make
+the round trips (outputs, mapids, landcover).
+"""
+
+import contextlib
+import json
+import logging
+import threading
+import timeit
+
+import config
+
+
+class RequestContext(object):
+    """Round trips made while serving one request."""
+
+    def __init__(self, name, debug=False, profile_graphs=False):
+        self.name = name
+        self.debug = debug
+        self.profile_graphs = profile_graphs
+        self.started = timeit.default_timer()
+        self.calls = []
+        self.graphs = []
+        self.stages = []
+        self.fields = {}
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    def record(self, kind, label, seconds):
+        with self._lock:
+            self.calls.append((kind, label, seconds))
+
+    def recordStage(self, name, seconds):
+        with self._lock:
+            self.stages.append((name, seconds))
+
+    def stageTimes(self):
+        """Returns [name, seconds] of every stage, in the order the stages
+        first ran, adding up stages that ran more than once."""
+        with self._lock:
+            stages = list(self.stages)
+        names = []
+        totals = {}
+        for name, seconds in stages:
+            if name not in totals:
+                names.append(name)
+                totals[name] = 0.0
+            totals[name] += seconds
+        return [[name, totals[name]] for name in names]
+
+    def annotate(self, fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def recordGraph(self, entry):
+        with self._lock:
+            self.graphs.append(entry)
+
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    def roundTrips(self):
+        return len(self.calls)
+
+    def summary(self):
+        """Returns the totals of this request as a dictionary."""
+        with self._lock:
+            calls = list(self.calls)
+            skipped = self.skipped
+            graphs = list(self.graphs)
+            fields = dict(self.fields)
+        counts = {}
+        for kind, label, seconds in calls:
+            counts[kind] = counts.get(kind, 0) + 1
+        return {
+            'request': self.name,
+            'round_trips': len(calls),
+            'counts': counts,
+            'ee_seconds': sum(seconds for kind, label, seconds in calls),
+            'elapsed_seconds': timeit.default_timer() - self.started,
+            'skipped_diagnostics': skipped,
+            'calls': [{'kind': kind, 'label': label, 'seconds': round(seconds, 4)} for kind, label, seconds in calls],
+            'graphs': graphs,
+            'stages': self.stageTimes(),
+            'fields': fields,
+        }
+
+
+def startRequest(name, debug=False, profile_graphs=False):
+    """Starts accounting for a new request on the current thread."""
+    context = RequestContext(name, debug or config.DEBUG_DIAGNOSTICS, profile_graphs or config.PROFILE_GRAPHS)
+    bindContext(context)
+    return context
+
+
+def endRequest():
+    """Logs the summary of the current request and stops accounting."""
+    context = currentContext()
+    bindContext(None)
+    if context is None:
+        return None
+    summary = context.summary()
+    logging.info('EE round trips for %s: %d (%s) in %.3f s of %.3f s, %d diagnostics skipped',
+                 summary['request'], summary['round_trips'],
+                 ', '.join('%s=%d' % item for item in sorted(summary['counts'].items())),
+                 summary['ee_seconds'], summary['elapsed_seconds'], summary['skipped_diagnostics'])
+    if context.debug:
+        for call in summary['calls']:
+            logging.info('  %(kind)s %(label)s %(seconds).3f s', call)
+    logging.info('request timing %s', json.dumps({
+        'request': summary['request'],
+        'fields': summary['fields'],
+        'stages_ms': dict((name, round(seconds * 1000, 1)) for name, seconds in summary['stages']),
+        'round_trips': summary['round_trips'],
+        'ee_ms': round(summary['ee_seconds'] * 1000, 1),
+        'total_ms': round(summary['elapsed_seconds'] * 1000, 1),
+    }, sort_keys=True))
+    if summary['graphs']:
+        import graphprofile
+        logging.info('Expression graphs of %s:\n  %s', summary['request'], '\n  '.join(graphprofile.formatReport(summary['graphs'])))
+    return summary
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Times the block as the stage name of the current request."""
+    start = timeit.default_timer()
+    try:
+        yield
+    finally:
+        context = currentContext()
+        if context is not None:
+            context.recordStage(name, timeit.default_timer() - start)
+
+
+def annotate(**fields):
+    """Adds fields, e.g. the request parameters, to the timing log line of
+    the current request."""
+    context = currentContext()
+    if context is not None:
+        context.annotate(fields)
+
+
+def serverTiming(summary):
+    """Returns the Server-Timing header value of a request summary: every
+    stage, the time spent waiting for EE and the total, in milliseconds.
+    Stages that run concurrently (map ids) are added up, so they can exceed
+    the total."""
+    metrics = []
+    for name, seconds in summary['stages']:
+        desc = ';desc="graph construction"' if name.startswith(BUILD_PREFIX) else ''
+        metrics.append('{}{};dur={:.1f}'.format(name, desc, seconds * 1000))
+    metrics.append('ee;desc="EE round trips";dur={:.1f}'.format(summary['ee_seconds'] * 1000))
+    metrics.append('total;dur={:.1f}'.format(summary['elapsed_seconds'] * 1000))
+    return ', '.join(metrics)
+
+
+def currentContext():
+    """Returns the accounting context of the current thread, if any."""
+    return getattr(_LOCAL, 'context', None)
+
+
+def bindContext(context):
+    """Makes context the accounting context of the current thread.
+
+    Worker threads that make EE calls on behalf of a request bind the
+    request's context so that their calls are counted too.
+    """
+    _LOCAL.context = context
+
+
+def isDebug():
+    """Returns True if diagnostic-only evaluations should run."""
+    context = currentContext()
+    if context is None:
+        return config.DEBUG_DIAGNOSTICS
+    return context.debug
+
+
+def getInfo(obj, label):
+    """Evaluates obj on the EE servers and returns the result."""
+    _profileGraph(label, obj)
+    return _timed('getInfo', label, obj.getInfo)
+
+
+def getMapId(image, vizParams, label):
+    """Requests a map id for image from the EE servers."""
+    _profileGraph(label, image)
+    return _timed('getMapId', label, lambda: image.getMapId(vizParams))
+
+
+def startTask(task, label):
+    """Starts an EE batch task."""
+    return _timed('startTask', label, task.start)
+
+
+def getTaskStatus(task_ids, label):
+    """Requests the status of a list of EE batch tasks."""
+    import ee
+    return _timed('getTaskStatus', label, lambda: ee.data.getTaskStatus(task_ids))
+
+
+def getAssetInfo(asset_id, label):
+    """Requests the metadata of an EE asset."""
+    import ee
+    return _timed('getAssetInfo', label, lambda: ee.data.getInfo(asset_id))
+
+
+def debugInfo(label, obj):
+    """Prints the value of obj if diagnostics are on, and skips it otherwise."""
+    if not isDebug():
+        context = currentContext()
+        if context is not None:
+            context.skip()
+        return None
+    value = getInfo(obj, label)
+    print('{}: {}'.format(label, value))
+    return value
+
+
+def _profileGraph(label, obj):
+    context = currentContext()
+    if context is not None and context.profile_graphs:
+        import graphprofile
+        # attributed to the caller of getInfo or getMapId
+        graphprofile.record(label, obj, depth=3)
+
+
+def _timed(kind, label, call):
+    start = timeit.default_timer()
+    try:
+        return call()
+    finally:
+        context = currentContext()
+        if context is not None:
+            context.record(kind, label, timeit.default_timer() - start)
+
+
+# Prefix of the stages that only construct EE expression graphs.
+BUILD_PREFIX = 'build-'
+
+_LOCAL = threading.local()
@@ -1,70 +1,32 @@
 import ee
 
-def getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces, province_boundaries):
-    """Gets the dry matter emissions from GFED4 and converts to oc/bc using emission factors associated with GFED4"""
+import diagnostics
+import graphprofile
+import provinceids
+
+def getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces, backend='ee', source=None):
+    """Gets the dry matter emissions from GFED4 and converts to oc/bc using emission factors associated with GFED4
+
+    With backend='numpy' the same computation runs locally on the exported
+    rasters (see localemiss.py) and arrays are returned instead of EE objects.
+    source is an optional (peatmask, monthly_dm) pair from getSources, so that
+    scenarios evaluated together share the same source expressions.
+    """
+    if backend == 'numpy':
+        import localemiss
+        return localemiss.getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces)
 
     ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
-    print(ds_grid.projection().nominalScale().getInfo())
-    print("SCENARIO", scenario)
-    peatmask = getPeatlands()
-    print(peatmask.projection().nominalScale().getInfo())
-    if logging:
-        loggingmask = getLogging()
-    if oilpalm:
-        oilpalmmask = getOilPalm()
-    if timber:
-        timbermask = getTimber()
-    if conservation:
-        conservationmask = getConservation().reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale()).eq(1)
-        print(conservationmask.projection().nominalScale().getInfo())
-    if brg: 
-        brgmask = ee.Image('projects/IndonesiaPolicyTool/BRG_regridded')
-
-    for i, province in enumerate(provinces):
-        if i == 0:
-            provMask = province_boundaries.filterMetadata('NAME_1', 'equals', province).reduceToImage(['ID_0'], ee.Reducer.count())
-        else:
-            provMask = provMask.add(province_boundaries.filterMetadata('NAME_1', 'equals', province).reduceToImage(['ID_0'], ee.Reducer.count()))
-
-    if len(provinces) > 0:
-        provMask = provMask.eq(0)
-
-    # get emissions based on transitions or from GFED 
-    print("YEAR == ", year)
-    if scenario=='GFED4':
-        # gfed in kg DM
-        #monthly_dm = ee.ImageCollection('users/tl2581/gfedv4s').filter(ee.Filter.rangeContains('system:index', 'DM_'+str(year)+'01', 'DM_'+str(year)+'12'))
-        monthly_dm = ee.ImageCollection('projects/IndonesiaPolicyTool/gfed4').filterDate(str(year) + '-01-1', str(year) + '-12-31').sort('system:time_start', True)
-    else:
-        monthly_dm = getDownscaled(year, metYear, peatmask)
+    diagnostics.debugInfo('ds_grid nominal scale', ds_grid.projection().nominalScale())
+    peatmask, monthly_dm = source or getSources(scenario, year, metYear)
+    diagnostics.debugInfo('peatmask nominal scale', peatmask.projection().nominalScale())
 
     #monthly_dm = ee.ImageCollection('users/tl2581/gfedv4s').filterDate('2008-01-01', '2009-01-01').sort('system:time_start', True) 
 
     # map comes from IAV file
     #monthly_dm = (emissions * map)   # Gg to Tg 
 
-    # mask out emissions
-    def mask_emissions(ems):
-        # first mask out data from regions that are turned off
-        if logging:
-            maskedEmissions = ems.updateMask(loggingmask)
-        else:
-            maskedEmissions = ems
-        if oilpalm:
-            maskedEmissions = maskedEmissions.updateMask(oilpalmmask)
-        if timber:
-            maskedEmissions = maskedEmissions.updateMask(timbermask)
-        if peatlands:
-            maskedEmissions = maskedEmissions.updateMask(peatmask)
-        if conservation:
-            maskedEmissions = maskedEmissions.updateMask(conservationmask)
-        if brg:
-            maskedEmissions = maskedEmissions.updateMask(brgmask)
-
-        # province masking
-        if len(provinces) > 0: 
-            maskedEmissions = maskedEmissions.updateMask(provMask)
-        return maskedEmissions
+    mask_emissions = getMaskFunction(logging, oilpalm, timber, peatlands, conservation, brg, provinces)
 
     # function to compute oc and bc emissions from dm
     def get_oc_bc(dm_emissions):
@@ -74,8 +36,8 @@ def getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, c
         #bands = ['b5', 'b4', 'b6', 'b1', 'b3', 'b2']
         bands = ['b1', 'b2', 'b3', 'b4', 'b5', 'b6']
         
-        oc_ef = [2.62, 9.6, 9.6, 4.71, 6.02, 2.3]
-        bc_ef = [0.37, 0.5, 0.5, 0.52, 0.04, 0.75]
+        oc_ef = OC_EF
+        bc_ef = BC_EF
         
         total_oc = ee.Image(0).rename(['b1'])
         total_bc = ee.Image(0).rename(['b1'])
@@ -86,8 +48,8 @@ def getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, c
 
             band_number = bands[land_type]
 
-            oc_fine = maskedEmissions.select(band_number).multiply(ee.Image(oc_scale))  # g OC
-            bc_fine = maskedEmissions.select(band_number).multiply(ee.Image(bc_scale))  # g BC
+            oc_fine = dm_emissions.select(band_number).multiply(ee.Image(oc_scale))  # g OC
+            bc_fine = dm_emissions.select(band_number).multiply(ee.Image(bc_scale))  # g BC
 
             # interpolate to current grid (is this necessary in earth engine?)
             # sum up the total for each type
@@ -136,35 +98,173 @@ def getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, c
 
     #total_emissions = monthly_dm.sum().reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale()).multiply(ee.Image.pixelArea()).reduceRegion(reducer=ee.Reducer.sum().unweighted(), geometry=ee.Geometry.Rectangle([90,-20,150,10]), scale=ee.Image(emissions_masked.first()).projection().nominalScale(), maxPixels=1e9)
     total_emissions = ee.Image(emissions_masked.iterate(sum_collection, ee.Image(0))).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale()).multiply(ee.Image.pixelArea()).reduceRegion(reducer=ee.Reducer.sum().unweighted(), geometry=ee.Geometry.Rectangle([90,-20,150,10]), crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale(), maxPixels=1e9)
-    print('total emissions: {}'.format(total_emissions.getInfo()))
+    diagnostics.debugInfo('total emissions', total_emissions)
+    graphprofile.record('source emissions', monthly_dm)
+    graphprofile.record('emissions', emissions)
+    graphprofile.record('total emissions', total_emissions)
 
     return emissions, total_emissions
 
 
+def getMaskFunction(logging, oilpalm, timber, peatlands, conservation, brg, provinces):
+    """Returns a function that masks out the emissions of an image in the
+    policy layers and provinces that are switched off."""
+    mask = None
+    toggles = policyBitmask(logging, oilpalm, timber, peatlands, conservation, brg)
+    if toggles:
+        # kept where none of the switched off layers has its bit set
+        mask = getPolicyBits().bitwiseAnd(toggles).eq(0)
+
+    # 0 in the selected provinces, one remap of the province id raster
+    provMask = provinceids.getExclusionMask(provinces)
+    if provMask is not None:
+        mask = provMask if mask is None else mask.And(provMask)
+    if mask is not None:
+        graphprofile.record('emission mask', mask)
+
+    def mask_emissions(ems):
+        if mask is None:
+            return ems
+        return ems.updateMask(mask)
+
+    return mask_emissions
+
+
+def getEmissionComponents(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces):
+    """Returns the monthly emissions of a scenario split by emission factor.
+
+    Every image has one band per GFED4 land type (COMPONENT_BANDS) with the
+    masked emissions before the emission factor is applied: dry matter for
+    GFED4, the transition rates without emission factor for land cover
+    scenarios. OC (BC) emissions are the sum over bands of band times OC_EF
+    (BC_EF), which lets the emission factors vary without going back to EE.
+    """
+    peatmask = getPeatlands()
+    mask_emissions = getMaskFunction(logging, oilpalm, timber, peatlands, conservation, brg, provinces)
+
+    if scenario=='GFED4':
+        monthly_dm = getSourceEmissions(scenario, year, metYear, peatmask).select(['b1', 'b2', 'b3', 'b4', 'b5', 'b6'], COMPONENT_BANDS)
+        return monthly_dm.map(mask_emissions)
+
+    start_asset, end_asset = getLandcoverPeriod(year)
+    components = getTransitionComponents(ee.Image(start_asset), ee.Image(end_asset), peatmask, year=(metYear-2005))
+
+    def mask_transition(image):
+        # masked transition emissions count as zero, like convert_transition_emissions
+        return mask_emissions(image).unmask()
+
+    return components.map(mask_transition)
+
+
+def getTransitionComponents(initialLandcover, finalLandcover, peatmask, year):
+    """Returns the monthly transition emissions of getTransition with one band
+    per emission factor index (COMPONENT_BANDS) instead of oc and bc."""
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
+
+    classes = getTransitionClasses(initialLandcover, finalLandcover, peatmask)
+
+    emissions_all_months = ee.List([])
+    for month in range(0,12):
+        bands = []
+        for ef_index in range(len(COMPONENT_BANDS)):
+            unit_ef = [1.0 if i == ef_index else 0.0 for i in range(len(COMPONENT_BANDS))]
+            codes, rates, _ = getTransitionRates(month+12*year, oc_ef=unit_ef, bc_ef=unit_ef)
+            if codes:
+                bands.append(classes.remap(codes, rates).unmask().toFloat())
+            else:
+                bands.append(ee.Image(0.0).toFloat())
+        image = ee.Image.cat(bands).rename(COMPONENT_BANDS).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
+        emissions_all_months = emissions_all_months.add(image)
+
+    return ee.ImageCollection(emissions_all_months)
+
+
+def getSources(scenario, year, metYear):
+    """Returns the peat mask and the unmasked source emissions of a scenario."""
+    peatmask = getPeatlands()
+    # get emissions based on transitions or from GFED 
+    return peatmask, getSourceEmissions(scenario, year, metYear, peatmask)
+
+
+def getSourceEmissions(scenario, year, metYear, peatmask):
+    """Returns the unmasked monthly emissions of a scenario before the OC/BC
+    split: GFED4 dry matter (bands b1..b6) or transition oc and bc."""
+    if scenario=='GFED4':
+        # gfed in kg DM
+        #monthly_dm = ee.ImageCollection('users/tl2581/gfedv4s').filter(ee.Filter.rangeContains('system:index', 'DM_'+str(year)+'01', 'DM_'+str(year)+'12'))
+        return ee.ImageCollection('projects/IndonesiaPolicyTool/gfed4').filterDate(str(year) + '-01-1', str(year) + '-12-31').sort('system:time_start', True)
+    else:
+        return getDownscaled(year, metYear, peatmask)
+
+
+def getPolicyBits():
+    """Returns an integer image on the emissions grid with bit i (see
+    POLICY_LAYERS) set where the mask of policy layer i removes emissions."""
+    return ee.Image(POLICY_BITS_ASSET)
+
+
+def computePolicyBits():
+    """Computes the image of getPolicyBits from the policy layer masks."""
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
+    masks = {
+        'logging': getLogging(),
+        'oilpalm': getOilPalm(),
+        'timber': getTimber(),
+        'peatlands': getPeatlands(),
+        'conservation': getConservation().reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale()).eq(1),
+        'BRGsites': ee.Image('projects/IndonesiaPolicyTool/BRG_regridded'),
+    }
+
+    bits = ee.Image(0)
+    for i, layer in enumerate(POLICY_LAYERS):
+        # updateMask removes pixels that are zero or masked; unmasked beyond
+        # the layer's footprint too, so the bits are defined on the whole grid
+        bits = bits.add(masks[layer].unmask(0, False).eq(0).multiply(1 << i))
+    return bits.int()
+
+
+def buildPolicyBits():
+    """Starts the export of the policy bits asset. Returns the started task."""
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid').projection()
+    task = ee.batch.Export.image.toAsset(computePolicyBits().reproject(ds_grid), POLICY_BITS_ASSET.split('/')[-1], assetId=POLICY_BITS_ASSET,
+                                         region=ee.Geometry.Rectangle([90, -20, 150, 10]), crs=ds_grid.crs().getInfo(),
+                                         scale=ds_grid.nominalScale().getInfo(), maxPixels=1e10)
+    task.start()
+    return task
+
+
+def totalOcBc(total_emissions):
+    """Returns the (oc, bc) of an evaluated total_emissions of getEmissions:
+    the oc and bc bands of transition scenarios, or the GFED4 dry matter
+    bands b1..b6 times OC_EF and BC_EF, as get_oc_bc computes them."""
+    if 'oc' in total_emissions:
+        return total_emissions['oc'], total_emissions.get('bc')
+    bands = ['b1', 'b2', 'b3', 'b4', 'b5', 'b6']
+    if any(total_emissions.get(band) is None for band in bands):
+        return None, None
+    oc = sum(total_emissions[band] * ef for band, ef in zip(bands, OC_EF))
+    bc = sum(total_emissions[band] * ef for band, ef in zip(bands, BC_EF))
+    return oc, bc
+
+
+def policyBitmask(logging, oilpalm, timber, peatlands, conservation, brg):
+    """Returns the bits of getPolicyBits that are switched on by a scenario."""
+    toggles = [logging, oilpalm, timber, peatlands, conservation, brg]
+    return sum(1 << i for i, toggle in enumerate(toggles) if toggle)
+
+
 def getDownscaled(emissyear, metyear, peatmask):
     """Scales the transition emissions from the appropriate 5-year chunk by the IAV of the meteorological year"""
 
     # find closest year for land-use scenarios
-    if emissyear >= 2025:
-        start_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2025')
-        end_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2030')
-    elif emissyear >= 2020:
-        start_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2020')
-        end_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2025')
-    elif emissyear >= 2015: 
-        start_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2015')
-        end_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2020')
-    elif emissyear >= 2010: 
-        start_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2010')
-        end_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2015')
-    elif emissyear >= 2005:
-        start_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS2005')
-        end_landcover = ee.Image('projects/IndonesiaPolicyTool/marHanS2010')
+    start_asset, end_asset = getLandcoverPeriod(emissyear)
+    start_landcover = ee.Image(start_asset)
+    end_landcover = ee.Image(end_asset)
 
     # get the transition emissions
     transition_emissions = getTransition(start_landcover, end_landcover, peatmask, year=(metyear-2005) )
 
-    print(ee.Image(transition_emissions.first()).bandNames().getInfo())
+    diagnostics.debugInfo('transition bands', ee.Image(transition_emissions.first()).bandNames())
 
     # scale transition emissions based on IAV
     def scale_IAV(emissions):
@@ -175,86 +275,131 @@ def getDownscaled(emissyear, metyear, peatmask):
     
     return scaled_emissions
 
+def getLandcoverPeriod(emissyear):
+    """Returns the asset ids of the land cover maps at the start and end of
+    the 5-year chunk that contains emissyear."""
+    if emissyear >= 2025:
+        return ('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2025',
+                'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2030')
+    elif emissyear >= 2020:
+        return ('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2020',
+                'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2025')
+    elif emissyear >= 2015: 
+        return ('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2015',
+                'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2020')
+    elif emissyear >= 2010: 
+        return ('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2010',
+                'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2015')
+    elif emissyear >= FIRST_EMISS_YEAR:
+        return ('projects/IndonesiaPolicyTool/marHanS2005',
+                'projects/IndonesiaPolicyTool/marHanS2010')
+    raise ValueError('no land cover scenario for emissions year {}'.format(emissyear))
+
+
 def getTransition(initialLandcover, finalLandcover, peatmask, year):
-    """ Returns emissions due to land cover transitions at 1 km resolution in kg DM per grid cell"""
+    """ Returns emissions due to land cover transitions at 1 km resolution in kg DM per grid cell
+
+    Every pixel is given a single class code for its land cover transition,
+    island and peat class (see getTransitionClasses), so the OC and BC
+    emissions of a month are one remap of the class codes with the rates from
+    getTransitionRates.
+    """
     
     ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
-    
+
+    classes = getTransitionClasses(initialLandcover, finalLandcover, peatmask)
+
+    emissions_all_months = ee.List([])
+
+    for month in range(0,12):
+        codes, oc_rates, bc_rates = getTransitionRates(month+12*year)
+
+        # pixels without emissions are not in codes and come out masked
+        oc = classes.remap(codes, oc_rates).unmask().reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
+        bc = classes.remap(codes, bc_rates).unmask().reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
+        emissions_all_months = emissions_all_months.add(oc.addBands(bc).rename(['oc', 'bc']))
+
+    graphprofile.record('transition emissions', emissions_all_months)
+    return ee.ImageCollection(emissions_all_months)
+
+
+def getTransitionClasses(initialLandcover, finalLandcover, peatmask):
+    """Returns an image of transition class codes on the emissions grid.
+
+    code = transition + 9 * (island + 3 * (peat + 3 * indonesia)), where
+    transition indexes TRANSITION_INITIAL/TRANSITION_FINAL, island is 0 (none),
+    1 (Sumatra) or 2 (Kalimantan), peat is 0 (no peat data), 1 (non-peat) or
+    2 (peat) and indonesia is 1 inside the Indonesia mask. Pixels whose land
+    cover change is not one of the transitions are masked.
+    """
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
+
     # get masks for the different islands
     islands = ee.Image('projects/IndonesiaPolicyTool/island_boundary_null').reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-
-    suma_mask = islands.eq(ee.Image(2)).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-    kali_mask = islands.eq(ee.Image(3)).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-    #indo_mask = islands.eq(ee.Image(1)).add(islands.gt(ee.Image(3))).gt(0).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
     indo_mask = ee.Image('projects/IndonesiaPolicyTool/indonesia').reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
     # print area
-    print("Area: {}".format(indo_mask.multiply(ee.Image.pixelArea()).reduceRegion(geometry=ee.Geometry.Rectangle([90,-20,150,10]), crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale(), reducer=ee.Reducer.sum(), maxPixels=1e9).getInfo()))
+    diagnostics.debugInfo('Area', indo_mask.multiply(ee.Image.pixelArea()).reduceRegion(geometry=ee.Geometry.Rectangle([90,-20,150,10]), crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale(), reducer=ee.Reducer.sum(), maxPixels=1e9))
 
-    initial_masks = []
-    final_masks = []
+    island_class = islands.eq(2).add(islands.eq(3).multiply(2)).unmask(0)
+    # peatmask is 1 outside peat and 0 on peat
+    peat_class = peatmask.eq(1).add(peatmask.eq(0).multiply(2)).unmask(0)
+    indo_class = indo_mask.neq(0).unmask(0)
 
-    # area of grid cell (m^2) and g to kg
-    scaling_factor = 1.0e-3
+    pairs = [initial * 10 + final for initial, final in zip(TRANSITION_INITIAL, TRANSITION_FINAL)]
+    transition = initialLandcover.multiply(10).add(finalLandcover).remap(pairs, range(len(pairs)))
 
-    reverse_peatmask = peatmask.subtract(ee.Image(1)).multiply(ee.Image(-1))
-    # order: DG, IN, NF, PL
-    for i in range(1,5):
-        initial_masks.append(initialLandcover.eq(ee.Image(i)))
-        final_masks.append(finalLandcover.eq(ee.Image(i)))
+    region = island_class.add(peat_class.multiply(3)).add(indo_class.multiply(9))
+    return transition.add(region.multiply(len(pairs))).int()
 
-#       in2in    in2dg     in2nf   in2pl  dg2dg    dg2nf   dg2pl   nf2nf   pl2pl
-    initial_index = [1, 1, 1, 1, 0, 0, 0, 2, 3]
-    final_index   = [1, 0, 2, 3, 0, 2, 3, 2, 3]
-    gfed_index    = [3, 3, 3, 3, 3, 3, 3, 0, 0]
 
-    #        SAVA  BORF TEMF DEFO  PEAT AGRI
-    oc_ef = [2.62, 9.6, 9.6, 4.71, 6.02, 2.3]
-    bc_ef = [0.37, 0.5, 0.5, 0.52, 0.04, 0.75]
+def getTransitionRates(index, oc_ef=None, bc_ef=None):
+    """Returns the class codes with non-zero emissions and their OC and BC
+    emissions (kg per grid cell) for one month of the transition rate tables.
 
-    emissions_all_months = ee.List([])
+    index is month + 12 * (metyear - 2005). Codes are those of
+    getTransitionClasses. A pixel gets the sum of the Kalimantan, Sumatra
+    (each peat or non-peat) and Indonesia non-peat rates that apply to it,
+    added in the same order as the original per-region accumulators.
+    """
+    oc_ef = oc_ef or OC_EF
+    bc_ef = bc_ef or BC_EF
 
-    for month in range(0,12):
-        kali_nonpeat_rates = KALI_NONPEAT[month+12*year]
-        kali_peat_rates = KALI_PEAT[month+12*year]
-        suma_nonpeat_rates = SUMA_NONPEAT[month+12*year]
-        suma_peat_rates = SUMA_PEAT[month+12*year]
-        indo_nonpeat_rates = INDO_NONPEAT[month+12*year] #INDO_NONPEAT[month]
-        #indo_peat_rates = INDO_PEAT[month+12*year] #INDO_PEAT[month]
-        #accumulate emissions    926.625433
-        kali_nonpeat_oc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(kali_nonpeat_rates[0] * scaling_factor * oc_ef[3]).updateMask(peatmask)).updateMask(kali_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        kali_nonpeat_bc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(kali_nonpeat_rates[0] * scaling_factor * bc_ef[3]).updateMask(peatmask)).updateMask(kali_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        kali_peat_oc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(kali_peat_rates[0] * scaling_factor * oc_ef[4]).updateMask(reverse_peatmask)).updateMask(kali_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        kali_peat_bc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(kali_peat_rates[0] * scaling_factor * bc_ef[4]).updateMask(reverse_peatmask)).updateMask(kali_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        suma_nonpeat_oc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(suma_nonpeat_rates[0] * scaling_factor * oc_ef[3]).updateMask(peatmask)).updateMask(suma_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        suma_nonpeat_bc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(suma_nonpeat_rates[0] * scaling_factor * bc_ef[3]).updateMask(peatmask)).updateMask(suma_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        suma_peat_oc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(suma_peat_rates[0] * scaling_factor * oc_ef[4]).updateMask(reverse_peatmask)).updateMask(suma_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        suma_peat_bc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(suma_peat_rates[0] * scaling_factor * bc_ef[4]).updateMask(reverse_peatmask)).updateMask(suma_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        indo_nonpeat_oc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(indo_nonpeat_rates[0] * scaling_factor * oc_ef[3])).updateMask(indo_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        indo_nonpeat_bc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(indo_nonpeat_rates[0] * scaling_factor * bc_ef[3])).updateMask(indo_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        #indo_peat_oc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(indo_peat_rates[0] * scaling_factor * oc_ef[4]).updateMask(reverse_peatmask)).updateMask(indo_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        #indo_peat_bc = initial_masks[1].multiply(final_masks[1]).multiply(ee.Image(indo_peat_rates[0] * scaling_factor * bc_ef[4]).updateMask(reverse_peatmask)).updateMask(indo_mask).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        for transition_index in range(1, 9):
-            kali_nonpeat_oc = kali_nonpeat_oc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(kali_nonpeat_rates[transition_index] * scaling_factor * oc_ef[gfed_index[transition_index]])))
-            kali_nonpeat_bc = kali_nonpeat_bc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(kali_nonpeat_rates[transition_index] * scaling_factor * bc_ef[gfed_index[transition_index]])))
-            kali_peat_oc = kali_peat_oc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(kali_peat_rates[transition_index] * scaling_factor * oc_ef[4])))
-            kali_peat_bc = kali_peat_bc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(kali_peat_rates[transition_index] * scaling_factor * bc_ef[4])))
-            suma_nonpeat_oc = suma_nonpeat_oc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(suma_nonpeat_rates[transition_index] * scaling_factor * oc_ef[gfed_index[transition_index]])))
-            suma_nonpeat_bc = suma_nonpeat_bc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(suma_nonpeat_rates[transition_index] * scaling_factor * bc_ef[gfed_index[transition_index]])))
-            suma_peat_oc = suma_peat_oc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(suma_peat_rates[transition_index] * scaling_factor * oc_ef[4])))
-            suma_peat_bc = suma_peat_bc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(suma_peat_rates[transition_index] * scaling_factor * bc_ef[4])))
-            indo_nonpeat_oc = indo_nonpeat_oc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(indo_nonpeat_rates[transition_index] * scaling_factor * oc_ef[gfed_index[transition_index]])))
-            indo_nonpeat_bc = indo_nonpeat_bc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(indo_nonpeat_rates[transition_index] * scaling_factor * bc_ef[gfed_index[transition_index]])))
-            #indo_peat_oc = indo_peat_oc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(indo_peat_rates[transition_index] * scaling_factor * oc_ef[4])))
-            #indo_peat_bc = indo_peat_bc.add(initial_masks[initial_index[transition_index]].multiply(final_masks[final_index[transition_index]]).multiply(ee.Image(indo_peat_rates[transition_index] * scaling_factor * bc_ef[4])))
-
-        # add to collection
-        oc = kali_peat_oc.unmask().add(kali_nonpeat_oc.unmask()).add(indo_nonpeat_oc.unmask()).add(suma_peat_oc.unmask()).add(suma_nonpeat_oc.unmask()).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        #oc = kali_peat_oc.unmask().add(kali_nonpeat_oc.unmask()).add(indo_peat_oc.unmask()).add(indo_nonpeat_oc.unmask()).add(suma_peat_oc.unmask()).add(suma_nonpeat_oc.unmask()).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        bc = kali_peat_bc.unmask().add(kali_nonpeat_bc.unmask()).add(indo_nonpeat_bc.unmask()).add(suma_peat_bc.unmask()).add(suma_nonpeat_bc.unmask()).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        #bc = kali_peat_bc.unmask().add(kali_nonpeat_bc.unmask()).add(indo_peat_bc.unmask()).add(indo_nonpeat_bc.unmask()).add(suma_peat_bc.unmask()).add(suma_nonpeat_bc.unmask()).reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale())
-        emissions_all_months = emissions_all_months.add(oc.addBands(bc).rename(['oc', 'bc']))
+    # area of grid cell (m^2) and g to kg
+    scaling_factor = 1.0e-3
 
-    return ee.ImageCollection(emissions_all_months)
+    num_transitions = len(TRANSITION_INITIAL)
+    codes = []
+    oc_rates = []
+    bc_rates = []
+    for indo in range(2):
+        for peat in range(3):
+            for island in range(3):
+                # (rate table, uses peat emission factor) in summation order
+                tables = []
+                if island == 2 and peat == 2:
+                    tables.append((KALI_PEAT, True))
+                if island == 2 and peat == 1:
+                    tables.append((KALI_NONPEAT, False))
+                if indo == 1:
+                    tables.append((INDO_NONPEAT, False))
+                if island == 1 and peat == 2:
+                    tables.append((SUMA_PEAT, True))
+                if island == 1 and peat == 1:
+                    tables.append((SUMA_NONPEAT, False))
+
+                for transition in range(num_transitions):
+                    oc = 0.0
+                    bc = 0.0
+                    for table, is_peat in tables:
+                        ef_index = 4 if is_peat else TRANSITION_GFED_INDEX[transition]
+                        oc += table[index][transition] * scaling_factor * oc_ef[ef_index]
+                        bc += table[index][transition] * scaling_factor * bc_ef[ef_index]
+                    if oc != 0 or bc != 0:
+                        codes.append(transition + num_transitions * (island + 3 * (peat + 3 * indo)))
+                        oc_rates.append(oc)
+                        bc_rates.append(bc)
+
+    return codes, oc_rates, bc_rates
 
 
 def getLogging():
@@ -298,6 +443,32 @@ def getConservation():
     return mask
 
 
+# The first emissions year with a land cover scenario, see getLandcoverPeriod
+FIRST_EMISS_YEAR = 2005
+
+# Policy layers in the bit order of getPolicyBits
+POLICY_LAYERS = ['logging', 'oilpalm', 'timber', 'peatlands', 'conservation', 'BRGsites']
+
+# The policy layer bits on the emissions grid, built with
+#     python emiss.py build
+POLICY_BITS_ASSET = 'projects/IndonesiaPolicyTool/policy_bits'
+
+# Emission factors (g OC or BC per kg DM), indexed like the GFED4 bands
+#        SAVA  BORF TEMF DEFO  PEAT AGRI
+OC_EF = [2.62, 9.6, 9.6, 4.71, 6.02, 2.3]
+BC_EF = [0.37, 0.5, 0.5, 0.52, 0.04, 0.75]
+
+# Bands of getEmissionComponents, one per entry of OC_EF and BC_EF
+COMPONENT_BANDS = ['ef0', 'ef1', 'ef2', 'ef3', 'ef4', 'ef5']
+
+# Land cover transitions, as (initial, final) land cover values
+# (1 degraded, 2 intact, 3 non-forest, 4 plantation), in the column order of
+# the rate tables below, and the emission factor used for each.
+#                      in2in in2dg in2nf in2pl dg2dg dg2nf dg2pl nf2nf pl2pl
+TRANSITION_INITIAL    = [2,    2,    2,    2,    1,    1,    1,    3,    4]
+TRANSITION_FINAL      = [2,    1,    3,    4,    1,    3,    4,    3,    4]
+TRANSITION_GFED_INDEX = [3,    3,    3,    3,    3,    3,    3,    0,    0]
+
 # Data for land cover emissions
 #       in2in             in2dg          in2nf        in2pl         dg2dg          dg2nf        dg2pl         nf2nf         pl2pl
 INDO_NONPEAT = [
@@ -685,3 +856,13 @@ SUMA_PEAT = [
 [0,0.522881148061311,91.5805527169861,18.8542504469889,1.3113065492843,19.2941837408137,4.07123388469904,8.75404212631724,31.7481817344671],
 [0,0,0,0,0.599756213094353,6.81715950734931,2.00042417723543,0.570235972208493,0.790599830892157],
 [0,0,0,0,0.248479664506278,1.04462965072496,1.60339025606065,0.527884464315228,0.213413077373596] ]
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) == 2 and sys.argv[1] == 'build':
+        import config
+        ee.Initialize(config.getCredentials())
+        print(buildPolicyBits().status())
+    else:
+        print('usage: emiss.py build')
@@ -0,0 +1,294 @@
+""" Earth Engine export manager
+
+Starts image exports to Cloud Storage without waiting for them. Export
+records live in an ExportStore, memcache by default so that any instance can
+report any export, and the states of all unfinished exports are fetched with
+one status request. Polling backs off exponentially while nothing changes and
+starts over when an export is added or changes state, so frequent progress
+requests do not turn into frequent EE requests. The polling schedule is kept
+in the store as well, so it is shared by all instances.
+
+The EE task service is pluggable: EETaskService talks to Earth Engine,
+MockTaskService completes tasks after a few polls for local testing.
+"""
+
+import functools
+import threading
+import time
+
+import diagnostics
+import parallel
+
+
+class ExportManager(object):
+    """Starts exports and tracks their state."""
+
+    def __init__(self, service, store=None):
+        self.service = service
+        self.store = store or MemoryExportStore()
+
+    def start(self, image, name, **kwargs):
+        """Starts one export and returns its record."""
+        return self.startMany([(image, name, kwargs)])[0]
+
+    def startMany(self, exports):
+        """Starts exports concurrently.
+
+        exports is a list of (image, name, kwargs) with the keyword arguments
+        of EETaskService.start. Returns the export records in the same
+        order, failed starts have state FAILED and an error.
+        """
+        calls = []
+        for i, (image, name, kwargs) in enumerate(exports):
+            calls.append((i, functools.partial(self.service.start, image, name, **kwargs)))
+        results, errors = parallel.runConcurrently(calls)
+
+        records = []
+        now = time.time()
+        for i, (image, name, kwargs) in enumerate(exports):
+            records.append({
+                'id': results.get(i),
+                'name': name,
+                'state': READY if i in results else FAILED,
+                'error': str(errors[i]) if i in errors else None,
+                'destinations': None,
+                'started': now,
+                'updated': now,
+            })
+        self.store.putMany([record for record in records if record['id'] is not None])
+
+        self._resetPolling()
+        return records
+
+    def get(self, export_id):
+        """Returns the record of an export, or None if it is unknown or expired."""
+        self.refresh()
+        return self.store.get(export_id)
+
+    def list(self):
+        """Returns the records of all exports, newest first."""
+        self.refresh()
+        records = self.store.getMany(self.store.ids()).values()
+        return sorted(records, key=lambda record: record['started'], reverse=True)
+
+    def refresh(self, force=False):
+        """Updates the unfinished exports if the polling interval is over."""
+        schedule = self.store.getSchedule() or {'interval': POLL_INITIAL, 'next_poll': 0}
+        if not force and time.time() < schedule['next_poll']:
+            return
+        # back off until something changes
+        self.store.putSchedule({
+            'interval': min(schedule['interval'] * 2, POLL_MAX),
+            'next_poll': time.time() + schedule['interval'],
+        })
+        records = self.store.getMany(self.store.ids())
+        active = [export_id for export_id, record in records.items() if record['state'] in ACTIVE_STATES]
+        if not active:
+            return
+
+        statuses = self.service.statuses(active)
+        changed = False
+        for export_id, status in statuses.items():
+            record = records[export_id]
+            if status['state'] != record['state']:
+                changed = True
+            record['state'] = status['state']
+            record['error'] = status.get('error_message')
+            record['destinations'] = status.get('destination_uris')
+            record['updated'] = time.time()
+        self.store.putMany([records[export_id] for export_id in statuses])
+        if changed:
+            self._resetPolling()
+
+    def wait(self, export_ids=None, timeout=None):
+        """Blocks until the exports (all by default) are finished, for
+        command line use. Returns their records."""
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            self.refresh()
+            records = self.store.getMany(export_ids if export_ids is not None else self.store.ids()).values()
+            wait = self.store.getSchedule()['next_poll'] - time.time()
+            if all(record['state'] not in ACTIVE_STATES for record in records):
+                return records
+            if deadline is not None and time.time() + wait > deadline:
+                return records
+            time.sleep(max(wait, 0))
+
+    def _resetPolling(self):
+        self.store.putSchedule({'interval': POLL_INITIAL, 'next_poll': time.time() + POLL_INITIAL})
+
+
+class MemcacheExportStore(object):
+    """Keeps export records and the polling schedule in memcache, visible to
+    all instances. The ids of the known exports are kept in an index entry
+    that is updated with compare-and-set."""
+
+    def __init__(self, expiration=None):
+        self.expiration = expiration or EXPORT_EXPIRATION
+
+    def get(self, export_id):
+        from google.appengine.api import memcache
+        return memcache.get(KEY_PREFIX + export_id)
+
+    def getMany(self, export_ids):
+        from google.appengine.api import memcache
+        return memcache.get_multi(export_ids, key_prefix=KEY_PREFIX)
+
+    def putMany(self, records):
+        from google.appengine.api import memcache
+        if not records:
+            return
+        memcache.set_multi(dict((record['id'], record) for record in records), key_prefix=KEY_PREFIX, time=self.expiration)
+        self._addIds([record['id'] for record in records])
+
+    def ids(self):
+        from google.appengine.api import memcache
+        return memcache.get(INDEX_KEY) or []
+
+    def getSchedule(self):
+        from google.appengine.api import memcache
+        return memcache.get(SCHEDULE_KEY)
+
+    def putSchedule(self, schedule):
+        from google.appengine.api import memcache
+        memcache.set(SCHEDULE_KEY, schedule, time=self.expiration)
+
+    def _addIds(self, export_ids):
+        from google.appengine.api import memcache
+        client = memcache.Client()
+        for i in range(CAS_RETRIES):
+            index = client.gets(INDEX_KEY)
+            if index is None:
+                if client.add(INDEX_KEY, list(export_ids), time=self.expiration):
+                    return
+                continue
+            # drop the ids of expired records while the index is rewritten
+            present = set(self.getMany(index))
+            index = [export_id for export_id in index if export_id in present and export_id not in export_ids] + list(export_ids)
+            if client.cas(INDEX_KEY, index, time=self.expiration):
+                return
+        print('export index update failed for {}'.format(export_ids))
+
+
+class MemoryExportStore(object):
+    """Keeps export records and the polling schedule in this instance, for
+    command line use and tests."""
+
+    def __init__(self):
+        self._exports = {}
+        self._schedule = None
+        self._lock = threading.Lock()
+
+    def get(self, export_id):
+        with self._lock:
+            record = self._exports.get(export_id)
+            return dict(record) if record is not None else None
+
+    def getMany(self, export_ids):
+        with self._lock:
+            return dict((export_id, dict(self._exports[export_id])) for export_id in export_ids if export_id in self._exports)
+
+    def putMany(self, records):
+        with self._lock:
+            for record in records:
+                self._exports[record['id']] = dict(record)
+
+    def ids(self):
+        with self._lock:
+            return list(self._exports)
+
+    def getSchedule(self):
+        with self._lock:
+            return dict(self._schedule) if self._schedule is not None else None
+
+    def putSchedule(self, schedule):
+        with self._lock:
+            self._schedule = dict(schedule)
+
+
+class EETaskService(object):
+    """Starts EE batch exports and reads their states from EE."""
+
+    def start(self, image, name, bucket=None, prefix=None, region=None, scale=None):
+        """Starts the export of image to Cloud Storage, returns the task id."""
+        import ee
+        task = ee.batch.Export.image.toCloudStorage(image, name, bucket=bucket or BUCKET, fileNamePrefix=prefix or name, region=region or REGION, scale=scale or SCALE)
+        diagnostics.startTask(task, 'export ' + name)
+        return task.id
+
+    def statuses(self, task_ids):
+        """Returns {task id: status dictionary} for task_ids, in one request."""
+        statuses = diagnostics.getTaskStatus(task_ids, '{} exports'.format(len(task_ids)))
+        return dict((status['id'], status) for status in statuses)
+
+
+class MockTaskService(object):
+    """Stands in for EETaskService in local tests: tasks are READY on the
+    first poll, RUNNING for the next polls_to_complete - 1 polls and then
+    COMPLETED, or FAILED if their name is in fail."""
+
+    def __init__(self, polls_to_complete=3, fail=()):
+        self.polls_to_complete = polls_to_complete
+        self.fail = set(fail)
+        self.started = []
+        self.status_requests = 0
+        self._polls = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def start(self, image, name, **kwargs):
+        with self._lock:
+            task_id = 'MOCK{}'.format(len(self.started))
+            self.started.append((task_id, name, kwargs))
+            self._polls[task_id] = 0
+            self._names[task_id] = name
+        return task_id
+
+    def statuses(self, task_ids):
+        with self._lock:
+            self.status_requests += 1
+            statuses = {}
+            for task_id in task_ids:
+                self._polls[task_id] += 1
+                polls = self._polls[task_id]
+                if polls < self.polls_to_complete:
+                    state = READY if polls == 1 else RUNNING
+                    statuses[task_id] = {'id': task_id, 'state': state}
+                elif self._names[task_id] in self.fail:
+                    statuses[task_id] = {'id': task_id, 'state': FAILED, 'error_message': 'mock failure'}
+                else:
+                    statuses[task_id] = {'id': task_id, 'state': COMPLETED, 'destination_uris': ['gs://mock/' + self._names[task_id]]}
+            return statuses
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+# EE task states
+READY = 'READY'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+ACTIVE_STATES = [READY, RUNNING, 'CANCEL_REQUESTED']
+
+# Seconds between status polls: POLL_INITIAL after a change, doubling up to
+# POLL_MAX while nothing changes.
+POLL_INITIAL = 2
+POLL_MAX = 60
+
+KEY_PREFIX = 'export:v1:'
+INDEX_KEY = 'export-index:v1'
+SCHEDULE_KEY = 'export-schedule:v1'
+
+# Seconds an export record is kept after its last update.
+EXPORT_EXPIRATION = 60 * 60 * 24
+
+# Attempts at updating the index of export ids.
+CAS_RETRIES = 5
+
+# Export defaults, as used by exportTif
+BUCKET = 'smoke_app_output'
+REGION = [[90, -20], [90, 10], [150, 10], [150, -20]]
+SCALE = 927.662423277
@@ -0,0 +1,143 @@
+""" Expression graph size profiling
+
+Every EE computation is sent as a serialized expression graph, and large or
+highly repetitive graphs are slow to serialize on the client and to
+evaluate on the server. record() measures an intermediate ee object of the
+pipeline and adds it to the report of the current request (see
+diagnostics.py), attributed to the module and function that called it:
+
+  - nodes: function invocations of the fully expanded graph,
+  - bytes: size of the serialized graph as it is sent to EE, with shared
+    subgraphs sent once,
+  - repeated: distinct subgraphs that occur more than once in the expanded
+    graph, and repeated_nodes the invocations that are repeats.
+
+Serializing is expensive, so record() does nothing unless graph profiling is
+on for the request (config.PROFILE_GRAPHS, ?profile=graphs or the
+X-Profile-Graphs header). diagnostics.getInfo and getMapId record every
+graph they send. The report of a scenario can also be printed without
+serving a request, which still needs EE credentials for the API
+signatures:
+
+    python graphprofile.py GFED4 Singapore 2006 2006 [policy layer ...]
+"""
+
+import hashlib
+import inspect
+import json
+import sys
+import timeit
+
+import ee
+
+import diagnostics
+
+
+def record(label, obj, depth=1):
+    """Adds the graph of obj to the report of the current request, if graph
+    profiling is on. The graph is attributed to the caller, or to the
+    caller depth frames up."""
+    context = diagnostics.currentContext()
+    if context is None or not context.profile_graphs:
+        return
+    frame = inspect.currentframe()
+    for i in range(depth):
+        frame = frame.f_back
+    source = '{}.{}:{}'.format(frame.f_globals.get('__name__'), frame.f_code.co_name, frame.f_lineno)
+    del frame
+
+    start = timeit.default_timer()
+    try:
+        entry = measure(obj)
+    except Exception as e:
+        # a profiler must not fail the request it profiles
+        print('graph profile of {} failed: {}'.format(label, e))
+        return
+    entry['label'] = label
+    entry['source'] = source
+    entry['seconds'] = timeit.default_timer() - start
+    context.recordGraph(entry)
+
+
+def measure(obj):
+    """Returns the node count, serialized size and repeated subgraphs of the
+    graph of obj."""
+    # the expanded graph, shared subgraphs inlined wherever they occur
+    tree = ee.serializer.encode(obj, False)
+    counts = {}
+    nodes = _countSubgraphs(tree, counts)
+
+    repeated = [(count, size, name) for count, size, name in counts.values() if count > 1]
+    repeated.sort(key=lambda item: (item[0] - 1) * item[1], reverse=True)
+    return {
+        'nodes': nodes,
+        'bytes': len(ee.serializer.toJSON(obj)),
+        'repeated': len(repeated),
+        # invocations beyond the first occurrence of every subgraph
+        'repeated_nodes': nodes - len(counts),
+        'top_repeated': [{'function': name, 'count': count, 'nodes': size} for count, size, name in repeated[:TOP_REPEATED]],
+    }
+
+
+def _countSubgraphs(value, counts):
+    """Returns the invocations in value and counts the occurrences of every
+    invocation subgraph in counts: {hash: [count, invocations, function]}."""
+    if isinstance(value, dict):
+        nodes = sum(_countSubgraphs(item, counts) for item in value.values())
+        # legacy ({'functionName': ...}) and Cloud API
+        # ({'functionInvocationValue': {'functionName': ...}}) encodings
+        if 'functionName' in value:
+            nodes += 1
+            key = hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+            entry = counts.setdefault(key, [0, nodes, value['functionName']])
+            entry[0] += 1
+        return nodes
+    if isinstance(value, list):
+        return sum(_countSubgraphs(item, counts) for item in value)
+    return 0
+
+
+def formatReport(graphs):
+    """Returns the lines of the report of a request: every recorded graph,
+    then the totals by source."""
+    lines = []
+    for graph in graphs:
+        lines.append('{label}: {nodes} nodes, {bytes} bytes, {repeated} repeated subgraphs '
+                     '(+{repeated_nodes} nodes) from {source}, {seconds:.3f} s'.format(**graph))
+        for subgraph in graph['top_repeated']:
+            lines.append('    {count} x {function} ({nodes} nodes)'.format(**subgraph))
+
+    totals = {}
+    for graph in graphs:
+        source = graph['source'].rsplit(':', 1)[0]
+        total = totals.setdefault(source, {'graphs': 0, 'nodes': 0, 'bytes': 0})
+        total['graphs'] += 1
+        total['nodes'] += graph['nodes']
+        total['bytes'] += graph['bytes']
+    for source, total in sorted(totals.items(), key=lambda item: -item[1]['nodes']):
+        lines.append('{}: {graphs} graphs, {nodes} nodes, {bytes} bytes'.format(source, **total))
+    return lines
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+# Repeated subgraphs listed per graph, most repeated invocations first.
+TOP_REPEATED = 5
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 5:
+        import server
+        ee.Initialize(server.config.getCredentials())
+        params = dict(server.DEFAULT_SCENARIO)
+        params.update({'scenario': sys.argv[1], 'receptor': sys.argv[2], 'metYear': int(sys.argv[3]), 'emissYear': int(sys.argv[4])})
+        for layer in sys.argv[5:]:
+            params[layer] = True
+        diagnostics.startRequest('graph profile', profile_graphs=True)
+        record('scenario scalars', server.ScenarioScalars(server.BuildScenarioImages(**params)))
+        for line in formatReport(diagnostics.endRequest()['graphs']):
+            print(line)
+    else:
+        print('usage: graphprofile.py scenario receptor metYear emissYear [policy layer ...]')
@@ -1,133 +1,140 @@
-import math
-
-def getAttributableMortality(receptor, exposure, age):
-    year = '2005'
-
-    if age=='adult':
-        CR_25, CR, CR_97 = concentrationResponse(exposure)
-    else:
-        CR_25, CR, CR_97 = concentrationResponseChild(exposure)
-
-    print('exposure {}'.format(exposure))
-    #mortality_rate = {'2005': {'Indonesia': 0.0099759, 'Malaysia': 0.0078068, 'Singapore': 0.0076863}}
-    #population = {'Indonesia': 257563815, 'Malaysia': 30331007, 'Singapore': 5603740}
-   
-    mortality_rate = {'earlyneonatal': {'2005': {'Indonesia': 2449.447916, 'Malaysia': 307.822903, 'Singapore': 138.625514},
-            '2010': {'Indonesia': 1766.350721, 'Malaysia': 277.366607, 'Singapore': 136.436176},
-            '2015': {'Indonesia': 1178.856507, 'Malaysia': 188.300136, 'Singapore': 108.775055}},
-            'lateneonatal': {'2005': {'Indonesia': 855.656908, 'Malaysia': 81.248922, 'Singapore': 78.940460},
-            '2010': {'Indonesia': 568.458840, 'Malaysia': 82.687460, 'Singapore': 67.082849},
-            '2015': {'Indonesia': 370.369132, 'Malaysia': 69.624377, 'Singapore': 60.953660}}, 
-            'postneonatal': {'2005': {'Indonesia': 515.194821, 'Malaysia': 47.331711, 'Singapore': 21.578431},
-            '2010': {'Indonesia': 369.668706, 'Malaysia': 47.202972, 'Singapore': 17.500542},
-            '2015': {'Indonesia': 226.980567, 'Malaysia': 34.900627, 'Singapore': 16.539159}},
-            '1-4': {'2005': {'Indonesia': 37.127353, 'Malaysia': 5.014201, 'Singapore': 3.114068},
-            '2010': {'Indonesia': 25.623974, 'Malaysia': 4.512403, 'Singapore': 2.762267},
-            '2015': {'Indonesia': 15.716153, 'Malaysia': 3.141835, 'Singapore': 2.381157}},
-            'adult': {'2005': {'Indonesia': 1011.9828048701391, 'Malaysia': 815.8937975144682, 'Singapore': 655.2733557232674},
-                '2010': {'Indonesia': 969.1379707140164, 'Malaysia': 816.5572076382289, 'Singapore': 625.100419900918},
-                '2015': {'Indonesia': 938.4151032648493, 'Malaysia': 808.1916221236238, 'Singapore': 663.1716655688783}}}
-
-    population = {'earlyneonatal': {'2005': {'Indonesia': 9.263730e4, 'Malaysia': 8.895073e3, 'Singapore': 7.186277e2},
-                '2010': {'Indonesia': 9.698937e4, 'Malaysia': 9.045705e3, 'Singapore': 7.280622e2},
-                '2015': {'Indonesia': 9.620548e4, 'Malaysia': 9.752598e3, 'Singapore': 7.255022e2}},
-                'lateneonatal': {'2005': {'Indonesia': 2.752874e5, 'Malaysia': 2.665513e4, 'Singapore': 2.153700e3}, 
-                '2010': {'Indonesia': 2.886072e5, 'Malaysia': 2.707535e4, 'Singapore': 2.186420e3},
-                '2015': {'Indonesia': 2.870570e5, 'Malaysia': 2.920269e4, 'Singapore': 2.175771e3}},
-                'postneonatal':  {'2005': {'Indonesia': 4.347065e6, 'Malaysia': 4.303966e5, 'Singapore': 3.439537e4},
-                '2010': {'Indonesia': 4.581694e6, 'Malaysia': 4.309730e5, 'Singapore': 3.579362e4},
-                '2015': {'Indonesia': 4.598456e6, 'Malaysia': 4.650476e5, 'Singapore': 3.498836e4}},
-                '1-4': {'2005': {'Indonesia': 1.792731e7, 'Malaysia': 1.973355e6, 'Singapore': 1.613114e5},
-                '2010': {'Indonesia': 1.919759e7, 'Malaysia': 1.834883e6, 'Singapore': 1.557840e5}, 
-                '2015': {'Indonesia': 1.981817e7, 'Malaysia': 1.937488e6, 'Singapore': 1.539489e5}},
-                'adult': {'2005': {'Indonesia': 115498024.0, 'Malaysia': 12979736.0, 'Singapore': 2394994.0},
-                '2010': {'Indonesia': 130274546.0, 'Malaysia': 14755444.0, 'Singapore': 2632253.0},
-                '2015': {'Indonesia': 142321069.0, 'Malaysia': 17214991.0, 'Singapore': 2768488.6953899995}}}
-
-    total_deaths_25 = mortality_rate[age][year][receptor] * population[age][year][receptor] * CR_25 / 100000.0 
-    total_deaths = mortality_rate[age][year][receptor] * population[age][year][receptor] * CR / 100000.0
-    total_deaths_97 = mortality_rate[age][year][receptor] * population[age][year][receptor] * CR_97 / 100000.0 
-
-    return [total_deaths_25, total_deaths, total_deaths_97]
+import numpy as np
 
 
-def concentrationResponse(dExposure):
-    def FullLin25CI(x):
-        return ((0.0059 * 1.8) - (1.96 * 0.004)) * x
-
-    def FullLin(x):
-        return (0.0059 * 1.8) * x 
+def getAttributableMortality(receptor, exposure, age, year=None):
+    """Returns the 2.5, 50 and 97.5 percentile attributable deaths of one age
+    group at a receptor for an annual mean PM exposure, in DEFAULT_YEAR unless
+    year is given."""
+    deaths = getAttributableMortalityBatch(exposure, ages=[age], years=[year or DEFAULT_YEAR], receptors=[receptor])
+    return deaths.ravel().tolist()
 
-    def FullLin975CI(x):
-        return ((0.0059 * 1.8) + (1.96 * 0.004)) * x
 
-    def LinTo50(x):
-        if x > 50:
-            return FullLin(50)
-        else:
-            return FullLin(x) 
+def getAttributableMortalityBatch(exposures, ages=None, years=None, receptors=None):
+    """Returns the attributable deaths for many exposures at once.
 
-    def Lin50HalfLin(x):
-        if x <= 50:
-            return FullLin(x)
-        else: 
-            return (FullLin(x) + FullLin(50)) * 0.5
+    Args:
+      exposures: a number or array of annual mean PM exposures.
+      ages, years, receptors: the rows of the tables to evaluate, all of
+          AGES, YEARS and RECEPTORS by default.
 
-    def FullLog(x):
-        return 1 - (1/math.exp(0.00575 * 1.8 * x))
+    Returns:
+      An array of shape exposures.shape + (3, ages, years, receptors), the
+      first new axis is the 2.5, 50 and 97.5 percentile estimate. Every
+      exposure is applied to every receptor.
+    """
+    ages = ages or AGES
+    years = [str(year) for year in (years or YEARS)]
+    receptors = receptors or RECEPTORS
 
-    def FullLog225CI(x):
-        return 1 - (1/math.exp(((0.0059 * 1.8) - (1.96 * 0.004)) * x)) 
+    exposures = np.asarray(exposures, dtype=float)
+    x = exposures.ravel()
+    baseline = BASELINE_DEATHS[np.ix_([AGES.index(age) for age in ages],
+                                      [YEARS.index(year) for year in years],
+                                      [RECEPTORS.index(receptor) for receptor in receptors])]
 
-    def FullLog2(x):
-        return 1 - (1/math.exp(0.0059 * 1.8 * x))
+    # (2, 3, n): child and adult curves, three estimates each
+    curves = np.array([lin50Log(x, CR_SLOPES['child']), lin50Log(x, CR_SLOPES['adult'])])
+    response = curves[[1 if age == 'adult' else 0 for age in ages]]
 
-    def FullLog2975CI(x):
-        return 1 - (1/math.exp(((0.0059 * 1.8) + (1.96 * 0.004)) * x))
+    # (ages, 3, years, receptors, n) -> (n, 3, ages, years, receptors)
+    deaths = response[:, :, np.newaxis, np.newaxis, :] * baseline[:, np.newaxis, :, :, np.newaxis]
+    deaths = deaths.transpose(4, 1, 0, 2, 3)
+    return deaths.reshape(exposures.shape + deaths.shape[1:])
 
-    def Lin50Log(x):
-        if x <= 50: 
-            return FullLin(x)
-        else:
-            return FullLin(50) + FullLog(x) - FullLog(50)
 
-    if dExposure <= 50:
-        Lin50Log225CI = FullLin25CI(dExposure)
-        Lin50Log2 = FullLin(dExposure)
-        Lin50Log2975CI = FullLin975CI(dExposure)
-    else:
-        Lin50Log225CI = FullLin25CI(50) + FullLog225CI(dExposure) - FullLog225CI(50)
-        Lin50Log2 = FullLin(50) + FullLog2(dExposure) - FullLog2(50)
-        Lin50Log2975CI = FullLin975CI(50) + FullLog2975CI(dExposure) - FullLog2975CI(50)
-    return Lin50Log225CI, Lin50Log2, Lin50Log2975CI
+def lin50Log(x, slopes):
+    """Linear response up to 50 ug/m3, log-linear above, for each slope.
 
+    Returns an array of shape (len(slopes),) + x.shape.
+    """
+    x = np.asarray(x, dtype=float)
+    slopes = np.asarray(slopes, dtype=float).reshape((-1,) + (1,) * x.ndim)
+    return responseCurve(x, slopes)
 
-def concentrationResponseChild(dExposure):
-    def FullLin25CI(x):
-        return 0.003 * x
-
-    def FullLin(x):
-        return 0.012 * x
 
-    def FullLin975CI(x):
-        return 0.03 * x
+def responseCurve(x, slope):
+    """The lin50Log response, elementwise for broadcastable x and slope."""
+    linear = slope * x
+    # FullLin(50) + FullLog(x) - FullLog(50), with FullLog(x) = 1 - exp(-slope x)
+    log = slope * 50 + np.exp(-slope * 50.0) - np.exp(-slope * x)
+    return np.where(x <= 50, linear, log)
 
-    def FullLog(x):
-        return 1 - (1/math.exp(0.012 * x))
 
-    def FullLog25CI(x):
-        return 1 - (1/math.exp(0.003 * x )) 
-
-    def FullLog975CI(x):
-        return 1 - (1/math.exp(0.03 * x))
+def concentrationResponse(dExposure):
+    """Returns the 2.5, 50 and 97.5 percentile adult concentration response
+    for a number or an array of exposures."""
+    return _estimates(lin50Log(dExposure, CR_SLOPES['adult']))
 
-    if dExposure <= 50:
-        Lin50Log25CI = FullLin25CI(dExposure)
-        Lin50Log = FullLin(dExposure)
-        Lin50Log975CI = FullLin975CI(dExposure)
-    else:
-        Lin50Log25CI = FullLin25CI(50) + FullLog25CI(dExposure) - FullLog25CI(50)
-        Lin50Log = FullLin(50) + FullLog(dExposure) - FullLog(50)
-        Lin50Log975CI = FullLin975CI(50) + FullLog975CI(dExposure) - FullLog975CI(50)
-    return Lin50Log25CI, Lin50Log, Lin50Log975CI
 
+def concentrationResponseChild(dExposure):
+    """Returns the 2.5, 50 and 97.5 percentile child concentration response
+    for a number or an array of exposures."""
+    return _estimates(lin50Log(dExposure, CR_SLOPES['child']))
+
+
+def _estimates(response):
+    if response.ndim == 1:
+        return tuple(float(value) for value in response)
+    return response[0], response[1], response[2]
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+AGES = ['earlyneonatal', 'lateneonatal', 'postneonatal', '1-4', 'adult']
+YEARS = ['2005', '2010', '2015']
+COUNTRIES = ['Indonesia', 'Malaysia', 'Singapore']
+
+# Population_weighted_SEAsia pools the three countries: its population is
+# their sum and its mortality rate their population-weighted mean.
+RECEPTORS = COUNTRIES + ['Population_weighted_SEAsia']
+
+DEFAULT_YEAR = '2005'
+
+# Concentration response slopes (2.5, 50, 97.5 percentile) of lin50Log.
+CR_SLOPES = {
+    'adult': [(0.0059 * 1.8) - (1.96 * 0.004), 0.0059 * 1.8, (0.0059 * 1.8) + (1.96 * 0.004)],
+    'child': [0.003, 0.012, 0.03],
+}
+
+# baseline mortality per 100000 and population, by age, year and country
+MORTALITY_RATE_TABLE = {'earlyneonatal': {'2005': {'Indonesia': 2449.447916, 'Malaysia': 307.822903, 'Singapore': 138.625514},
+        '2010': {'Indonesia': 1766.350721, 'Malaysia': 277.366607, 'Singapore': 136.436176},
+        '2015': {'Indonesia': 1178.856507, 'Malaysia': 188.300136, 'Singapore': 108.775055}},
+        'lateneonatal': {'2005': {'Indonesia': 855.656908, 'Malaysia': 81.248922, 'Singapore': 78.940460},
+        '2010': {'Indonesia': 568.458840, 'Malaysia': 82.687460, 'Singapore': 67.082849},
+        '2015': {'Indonesia': 370.369132, 'Malaysia': 69.624377, 'Singapore': 60.953660}},
+        'postneonatal': {'2005': {'Indonesia': 515.194821, 'Malaysia': 47.331711, 'Singapore': 21.578431},
+        '2010': {'Indonesia': 369.668706, 'Malaysia': 47.202972, 'Singapore': 17.500542},
+        '2015': {'Indonesia': 226.980567, 'Malaysia': 34.900627, 'Singapore': 16.539159}},
+        '1-4': {'2005': {'Indonesia': 37.127353, 'Malaysia': 5.014201, 'Singapore': 3.114068},
+        '2010': {'Indonesia': 25.623974, 'Malaysia': 4.512403, 'Singapore': 2.762267},
+        '2015': {'Indonesia': 15.716153, 'Malaysia': 3.141835, 'Singapore': 2.381157}},
+        'adult': {'2005': {'Indonesia': 1011.9828048701391, 'Malaysia': 815.8937975144682, 'Singapore': 655.2733557232674},
+            '2010': {'Indonesia': 969.1379707140164, 'Malaysia': 816.5572076382289, 'Singapore': 625.100419900918},
+            '2015': {'Indonesia': 938.4151032648493, 'Malaysia': 808.1916221236238, 'Singapore': 663.1716655688783}}}
+
+POPULATION_TABLE = {'earlyneonatal': {'2005': {'Indonesia': 9.263730e4, 'Malaysia': 8.895073e3, 'Singapore': 7.186277e2},
+            '2010': {'Indonesia': 9.698937e4, 'Malaysia': 9.045705e3, 'Singapore': 7.280622e2},
+            '2015': {'Indonesia': 9.620548e4, 'Malaysia': 9.752598e3, 'Singapore': 7.255022e2}},
+            'lateneonatal': {'2005': {'Indonesia': 2.752874e5, 'Malaysia': 2.665513e4, 'Singapore': 2.153700e3},
+            '2010': {'Indonesia': 2.886072e5, 'Malaysia': 2.707535e4, 'Singapore': 2.186420e3},
+            '2015': {'Indonesia': 2.870570e5, 'Malaysia': 2.920269e4, 'Singapore': 2.175771e3}},
+            'postneonatal':  {'2005': {'Indonesia': 4.347065e6, 'Malaysia': 4.303966e5, 'Singapore': 3.439537e4},
+            '2010': {'Indonesia': 4.581694e6, 'Malaysia': 4.309730e5, 'Singapore': 3.579362e4},
+            '2015': {'Indonesia': 4.598456e6, 'Malaysia': 4.650476e5, 'Singapore': 3.498836e4}},
+            '1-4': {'2005': {'Indonesia': 1.792731e7, 'Malaysia': 1.973355e6, 'Singapore': 1.613114e5},
+            '2010': {'Indonesia': 1.919759e7, 'Malaysia': 1.834883e6, 'Singapore': 1.557840e5},
+            '2015': {'Indonesia': 1.981817e7, 'Malaysia': 1.937488e6, 'Singapore': 1.539489e5}},
+            'adult': {'2005': {'Indonesia': 115498024.0, 'Malaysia': 12979736.0, 'Singapore': 2394994.0},
+            '2010': {'Indonesia': 130274546.0, 'Malaysia': 14755444.0, 'Singapore': 2632253.0},
+            '2015': {'Indonesia': 142321069.0, 'Malaysia': 17214991.0, 'Singapore': 2768488.6953899995}}}
+
+
+def _table(table):
+    return np.array([[[table[age][year][country] for country in COUNTRIES] for year in YEARS] for age in AGES])
+
+# deaths per unit of concentration response, (age, year, receptor)
+BASELINE_DEATHS = _table(MORTALITY_RATE_TABLE) * _table(POPULATION_TABLE) / 100000.0
+BASELINE_DEATHS = np.concatenate([BASELINE_DEATHS, BASELINE_DEATHS.sum(axis=2)[:, :, np.newaxis]], axis=2)
@@ -0,0 +1,204 @@
+""" Background scenario jobs
+
+A scenario can be submitted as a job instead of being computed inside the
+request: submit() stores the job and returns its id at once, a worker runs it
+later and records its stage and result, and the client polls get() (the
+/jobs/<id> endpoint) until the job is done or failed.
+
+Where the work happens is up to the queue backend. ThreadPoolBackend runs
+jobs on a pool of threads of the same instance, for local runs and tests.
+TaskQueueBackend pushes every job to an App Engine task queue, whose request
+then calls JobQueue.run, so the front-end instances only store and report
+jobs. Job records live in a JobStore, memcache by default so that any
+instance can report any job.
+"""
+
+import Queue
+import threading
+import time
+import traceback
+import uuid
+
+import diagnostics
+
+
+class JobQueue(object):
+    """Submits jobs to a backend and keeps track of them in a store.
+
+    function is called as function(params, progress) and returns the job
+    result; progress(stage) records the stage the job has reached.
+    """
+
+    def __init__(self, function, backend, store):
+        self.function = function
+        self.backend = backend
+        self.store = store
+
+    def submit(self, params):
+        """Queues a job and returns its record."""
+        now = time.time()
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': QUEUED,
+            'stage': None,
+            'params': params,
+            'result': None,
+            'error': None,
+            'submitted': now,
+            'updated': now,
+        }
+        self.store.put(job)
+        self.backend.enqueue(self, job['id'])
+        return job
+
+    def get(self, job_id):
+        """Returns the record of a job, or None if it is unknown or expired."""
+        return self.store.get(job_id)
+
+    def run(self, job_id):
+        """Runs a queued job. Called by the backend's worker.
+
+        A job that is still running after TASK_DEADLINE was interrupted
+        without its worker noticing, and is run again. A job that was
+        interrupted MAX_ATTEMPTS times fails.
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        if job['status'] == RUNNING and time.time() - job.get('started', job['updated']) > TASK_DEADLINE:
+            if job.get('attempts', 0) >= MAX_ATTEMPTS:
+                self._update(job, status=FAILED, error='interrupted {} times'.format(job['attempts']))
+                return
+            print('job {} interrupted, running it again'.format(job_id))
+        elif job['status'] != QUEUED:
+            return
+
+        def progress(stage):
+            self._update(job, stage=stage)
+
+        attempts = job.get('attempts', 0) + 1
+        self._update(job, status=RUNNING, started=time.time(), attempts=attempts)
+        diagnostics.startRequest('job ' + job_id)
+        try:
+            result = self.function(job['params'], progress)
+            self._update(job, status=DONE, stage=None, result=result)
+        except Exception as e:
+            traceback.print_exc()
+            self._update(job, status=FAILED, error=str(e))
+        finally:
+            # still running: a BaseException such as the request deadline
+            # interrupted the job, let the task be retried while attempts last
+            if job['status'] == RUNNING:
+                if attempts < MAX_ATTEMPTS:
+                    self._update(job, status=QUEUED, stage=None, error='interrupted')
+                else:
+                    self._update(job, status=FAILED, error='interrupted {} times'.format(attempts))
+            diagnostics.endRequest()
+
+    def _update(self, job, **changes):
+        job.update(changes)
+        job['updated'] = time.time()
+        self.store.put(job)
+
+
+class ThreadPoolBackend(object):
+    """Runs jobs on a pool of threads in this instance."""
+
+    def __init__(self, workers=None):
+        self.workers = workers or POOL_WORKERS
+        self._pending = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def enqueue(self, queue, job_id):
+        self._pending.put((queue, job_id))
+        with self._lock:
+            # threads are started on first use, not at import
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            queue, job_id = self._pending.get()
+            queue.run(job_id)
+
+
+class TaskQueueBackend(object):
+    """Pushes jobs to an App Engine task queue that posts them to url."""
+
+    def __init__(self, url, queue_name='default'):
+        self.url = url
+        self.queue_name = queue_name
+
+    def enqueue(self, queue, job_id):
+        from google.appengine.api import taskqueue
+        taskqueue.add(url=self.url, params={'id': job_id}, queue_name=self.queue_name)
+
+
+class MemcacheJobStore(object):
+    """Keeps job records in memcache, visible to all instances."""
+
+    def __init__(self, expiration=None):
+        self.expiration = expiration or JOB_EXPIRATION
+
+    def get(self, job_id):
+        from google.appengine.api import memcache
+        return memcache.get(KEY_PREFIX + job_id)
+
+    def put(self, job):
+        from google.appengine.api import memcache
+        memcache.set(KEY_PREFIX + job['id'], job, time=self.expiration)
+
+
+class MemoryJobStore(object):
+    """Keeps job records in a dictionary of this instance."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def put(self, job):
+        with self._lock:
+            self._jobs[job['id']] = dict(job)
+
+
+def createBackend(name, url):
+    """Returns the queue backend called name ('thread' or 'taskqueue')."""
+    if name == 'taskqueue':
+        return TaskQueueBackend(url)
+    elif name == 'thread':
+        return ThreadPoolBackend()
+    raise ValueError('unknown job backend {}'.format(name))
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+KEY_PREFIX = 'job:v1:'
+
+# Seconds a job record is kept after its last update.
+JOB_EXPIRATION = 60 * 60 * 3
+
+# Seconds a task queue request may run, after which a running job is
+# considered interrupted.
+TASK_DEADLINE = 10 * 60
+
+# Runs of a job before an interrupted job fails.
+MAX_ATTEMPTS = 3
+
+# Number of threads of the in-process backend.
+POOL_WORKERS = 2
@@ -1,6 +1,50 @@
+import threading
+import time
+
 import ee
 
+import diagnostics
+
 def getLandcoverData():
+    """Returns the map ids and tokens of the land cover layers.
+
+    The land cover images and their styling never change, so the map ids are
+    fetched once per instance and served from memory afterwards. Once they get
+    close to expiring the next request fetches new ones, while concurrent
+    requests keep being served the current ones. Without usable map ids a
+    request waits for a fetch that is already in flight rather than starting
+    another one.
+    """
+    with _FETCHED:
+        while True:
+            age = time.time() - _LANDCOVER['fetched']
+            usable = _LANDCOVER['mapids'] is not None and age < LANDCOVER_EXPIRATION
+            if usable and (age < LANDCOVER_REFRESH or _LANDCOVER['fetching']):
+                return list(_LANDCOVER['mapids']), list(_LANDCOVER['tokens'])
+            if not _LANDCOVER['fetching']:
+                break
+            _FETCHED.wait()
+        _LANDCOVER['fetching'] = True
+
+    # this request fetches, stale map ids are served to the others meanwhile
+    try:
+        mapids, tokens = fetchLandcoverData()
+    except Exception:
+        if not usable:
+            raise
+        mapids, tokens = list(_LANDCOVER['mapids']), list(_LANDCOVER['tokens'])
+        print('land cover refresh failed, serving the current map ids')
+    else:
+        _storeLandcoverData(mapids, tokens)
+    finally:
+        with _FETCHED:
+            _LANDCOVER['fetching'] = False
+            _FETCHED.notify_all()
+    return list(mapids), list(tokens)
+
+
+def fetchLandcoverData():
+    """Requests new map ids and tokens for the land cover layers from EE."""
     present = ee.Image('projects/IndonesiaPolicyTool/marHanS2005')
     BAU2010 = ee.Image('projects/IndonesiaPolicyTool/marHanS2010')
     BAU2015 = ee.Image('projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2015')
@@ -20,25 +64,40 @@ def getLandcoverData():
     vizParams = { 'min': '0', 'max': '255', 'format': 'png' }
 
     image = present.updateMask(present).sldStyle(sld_ramp)
-    presentMapID = image.getMapId(vizParams)
+    presentMapID = diagnostics.getMapId(image, vizParams, 'landcover present')
 
     image = BAU2010.updateMask(BAU2010).sldStyle(sld_ramp)
-    BAU2010MapID = image.getMapId(vizParams)
+    BAU2010MapID = diagnostics.getMapId(image, vizParams, 'landcover BAU2010')
 
     image = BAU2015.updateMask(BAU2015).sldStyle(sld_ramp)
-    BAU2015MapID = image.getMapId(vizParams) 
+    BAU2015MapID = diagnostics.getMapId(image, vizParams, 'landcover BAU2015')
 
     image = BAU2020.updateMask(BAU2020).sldStyle(sld_ramp)
-    BAU2020MapID = image.getMapId(vizParams) 
+    BAU2020MapID = diagnostics.getMapId(image, vizParams, 'landcover BAU2020')
 
     image = BAU2025.updateMask(BAU2025).sldStyle(sld_ramp)
-    BAU2025MapID = image.getMapId(vizParams) 
+    BAU2025MapID = diagnostics.getMapId(image, vizParams, 'landcover BAU2025')
 
     image = BAU2030.updateMask(BAU2030).sldStyle(sld_ramp)
-    BAU2030MapID = image.getMapId(vizParams)  
-   
+    BAU2030MapID = diagnostics.getMapId(image, vizParams, 'landcover BAU2030')
+
     mapids = [presentMapID['mapid'], BAU2010MapID['mapid'], BAU2015MapID['mapid'], BAU2020MapID['mapid'], BAU2025MapID['mapid'], BAU2030MapID['mapid']]
     tokens = [presentMapID['token'], BAU2010MapID['token'], BAU2015MapID['token'], BAU2020MapID['token'], BAU2025MapID['token'], BAU2030MapID['token']]
     return mapids, tokens
 
 
+def _storeLandcoverData(mapids, tokens):
+    with _FETCHED:
+        _LANDCOVER['mapids'] = mapids
+        _LANDCOVER['tokens'] = tokens
+        _LANDCOVER['fetched'] = time.time()
+
+
+# Map ids are refreshed after LANDCOVER_REFRESH seconds and no longer served
+# after LANDCOVER_EXPIRATION seconds, before their tokens stop working.
+LANDCOVER_REFRESH = 60 * 60 * 2
+LANDCOVER_EXPIRATION = 60 * 60 * 3
+
+# notified when a fetch ends
+_FETCHED = threading.Condition(threading.Lock())
+_LANDCOVER = {'mapids': None, 'tokens': None, 'fetched': 0, 'fetching': False}
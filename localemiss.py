@@ -0,0 +1,234 @@
+""" Offline NumPy backend for the emissions pipeline
+
+Runs the same computation as emiss.getEmissions (GFED4 and land cover
+transition scenarios, all policy masks, OC/BC hydrophilic/hydrophobic split)
+on the local rasters from rasters.py, so scenarios can be evaluated and
+benchmarked without Earth Engine. Use it through
+emiss.getEmissions(..., backend='numpy') or directly.
+
+Masked EE pixels are NaN here. The GFED4 path keeps masked pixels masked, the
+transition path zeroes them, as in emiss.
+
+checkParity compares both backends on a small tile, which needs EE:
+
+    python localemiss.py parity GFED4 2006 2006 peatlands Riau
+"""
+
+import numpy as np
+
+import emiss
+import provinceids
+import rasters
+
+
+def getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces):
+    """Returns (emissions, total_emissions) for a scenario.
+
+    emissions is a float32 array of shape (12, 2, rows, columns) with the
+    monthly hydrophilic (b1) and hydrophobic (b2) OC+BC emissions in kg per
+    grid cell. total_emissions is the dictionary emiss' total_emissions
+    evaluates to: annual emissions per band of the masked source data (GFED4
+    dry matter bands b1..b6, or transition oc and bc) times the pixel area.
+    """
+    keep = getPolicyMask(logging, oilpalm, timber, peatlands, conservation, brg, provinces)
+
+    if scenario == 'GFED4':
+        # gfed in kg DM
+        monthly_dm = rasters.load(rasters.gfedName(year))
+        band_names = ['b1', 'b2', 'b3', 'b4', 'b5', 'b6']
+    else:
+        monthly_dm = getDownscaled(year, metYear)
+        band_names = ['oc', 'bc']
+
+    emissions = np.empty((12, 2) + keep.shape, dtype=np.float32)
+    annual = np.zeros((len(band_names),) + keep.shape, dtype=np.float64)
+    for month in range(12):
+        masked = np.where(keep, monthly_dm[month], np.nan)
+        annual += masked
+
+        if scenario == 'GFED4':
+            emissions[month] = get_oc_bc(masked)
+        else:
+            emissions[month] = convert_transition_emissions(masked)
+
+    area = rasters.load('pixel_area')
+    totals = {}
+    for i, band in enumerate(band_names):
+        totals[band] = float(np.nansum(annual[i] * area))
+
+    return emissions, totals
+
+
+def get_oc_bc(dm_emissions):
+    """Converts the six GFED4 dry matter bands to hydrophilic and hydrophobic
+    OC+BC, like get_oc_bc in emiss.getEmissions."""
+    total_oc = np.zeros(dm_emissions.shape[1:])
+    total_bc = np.zeros(dm_emissions.shape[1:])
+    for land_type in range(len(emiss.OC_EF)):
+        total_oc += dm_emissions[land_type] * emiss.OC_EF[land_type]  # g OC
+        total_bc += dm_emissions[land_type] * emiss.BC_EF[land_type]  # g BC
+
+    return split_oc_bc(total_oc, total_bc)
+
+
+def convert_transition_emissions(oc_bc_emissions):
+    """Converts transition OC and BC to hydrophilic and hydrophobic OC+BC,
+    like convert_transition_emissions in emiss.getEmissions."""
+    # need to unmask to make mask values zero
+    oc_bc_emissions = np.nan_to_num(oc_bc_emissions)
+    return split_oc_bc(oc_bc_emissions[0], oc_bc_emissions[1])
+
+
+def split_oc_bc(total_oc, total_bc):
+    # split into GEOS-Chem hydrophobic and hydrophilic fractions
+    ocpo = total_oc * (0.5 * 2.1)  # g OA
+    ocpi = total_oc * (0.5 * 2.1)  # g OA
+    bcpo = total_bc * 0.8          # g BC
+    bcpi = total_bc * 0.2          # g BC
+
+    emissions_philic = (ocpi + bcpi) * 1.0e-3  # to kg OC/BC
+    emissions_phobic = (ocpo + bcpo) * 1.0e-3
+    return np.array([emissions_philic, emissions_phobic])
+
+
+def getPolicyMask(logging, oilpalm, timber, peatlands, conservation, brg, provinces):
+    """Returns a boolean array, True where emissions are kept after the policy
+    and province masks of mask_emissions in emiss.getEmissions."""
+    bits = rasters.load(rasters.assetName(emiss.POLICY_BITS_ASSET))
+    keep = np.ones(bits.shape, dtype=bool)
+    toggles = emiss.policyBitmask(logging, oilpalm, timber, peatlands, conservation, brg)
+    if toggles:
+        # kept where none of the switched off layers has its bit set; like
+        # updateMask on EE, cells without bits are removed
+        keep &= np.isfinite(bits)
+        keep &= np.bitwise_and(np.nan_to_num(bits).astype(np.int32), toggles) == 0
+
+    # province masking, unknown provinces are skipped like on EE
+    if len(provinces) > 0:
+        index = rasters.loadIndex(provinceids.LOCAL_INDEX)
+        province_ids = rasters.load(rasters.assetName(provinceids.PROVINCE_IDS_ASSET))
+        keep &= np.isfinite(province_ids)
+        keep &= ~np.in1d(province_ids.ravel(), [index[province] for province in provinces if province in index]).reshape(province_ids.shape)
+    return keep
+
+
+def checkParity(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces, bounds=None):
+    """Compares this backend with emiss.getEmissions on EE over a small tile
+    of the grid, bounds [west, south, east, north] (PARITY_TILE by default).
+
+    Compared are the number of cells the masks keep and the annual b1 and b2
+    emissions of the tile. Returns (name, local value, EE value) for every
+    quantity, and whether they all agree within PARITY_TOLERANCE.
+    """
+    import ee
+
+    bounds = bounds or PARITY_TILE
+    emissions = getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces)[0]
+    keep = getPolicyMask(logging, oilpalm, timber, peatlands, conservation, brg, provinces)
+    rows, columns = tileSlices(keep.shape, bounds)
+    local = {
+        'kept cells': float(keep[rows, columns].sum()),
+        'b1': float(np.nansum(emissions[:, 0, rows, columns])),
+        'b2': float(np.nansum(emissions[:, 1, rows, columns])),
+    }
+
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid').projection()
+    mask_emissions = emiss.getMaskFunction(logging, oilpalm, timber, peatlands, conservation, brg, provinces)
+    ee_emissions = emiss.getEmissions(scenario, year, metYear, logging, oilpalm, timber, peatlands, conservation, brg, provinces)[0]
+    tile = ee.Geometry.Rectangle(bounds)
+    kept = mask_emissions(ee.Image(1).rename(['kept'])).reproject(ds_grid).reduceRegion(ee.Reducer.count(), tile, crs=ds_grid, maxPixels=1e8)
+    annual = ee_emissions.sum().reproject(ds_grid).reduceRegion(ee.Reducer.sum(), tile, crs=ds_grid, maxPixels=1e8)
+    remote = ee.Dictionary(annual).set('kept cells', ee.Dictionary(kept).get('kept')).getInfo()
+
+    comparison = [(name, local[name], remote.get(name) or 0.0) for name in ['kept cells', 'b1', 'b2']]
+    agree = all(abs(value - ee_value) <= PARITY_TOLERANCE * max(abs(ee_value), 1.0) for name, value, ee_value in comparison)
+    return comparison, agree
+
+
+def tileSlices(shape, bounds):
+    """Returns the row and column slices of the raster cells within bounds,
+    for rasters that cover rasters.EXPORT_BOUNDS."""
+    west, south, east, north = rasters.EXPORT_BOUNDS
+    cell_x = (east - west) / float(shape[-1])
+    cell_y = (north - south) / float(shape[-2])
+    columns = slice(int(round((bounds[0] - west) / cell_x)), int(round((bounds[2] - west) / cell_x)))
+    rows = slice(int(round((north - bounds[3]) / cell_y)), int(round((north - bounds[1]) / cell_y)))
+    return rows, columns
+
+
+def getDownscaled(emissyear, metyear):
+    """Returns the monthly transition emissions as a (12, 2, rows, columns)
+    array of oc and bc, like emiss.getDownscaled."""
+    start_asset, end_asset = emiss.getLandcoverPeriod(emissyear)
+    return getTransition(rasters.load(rasters.assetName(start_asset)), rasters.load(rasters.assetName(end_asset)), rasters.load('peatlands'), year=(metyear-2005))
+
+
+def getTransition(initialLandcover, finalLandcover, peatmask, year):
+    """Returns the monthly oc and bc emissions due to land cover transitions,
+    a lookup of the class codes of getTransitionClasses in the rate tables of
+    emiss.getTransitionRates."""
+    classes = getTransitionClasses(initialLandcover, finalLandcover, peatmask)
+
+    emissions = np.empty((12, 2) + classes.shape, dtype=np.float32)
+    for month in range(12):
+        codes, oc_rates, bc_rates = emiss.getTransitionRates(month+12*year)
+
+        # the last entry is for pixels without a transition
+        oc_table = np.zeros(NUM_CLASSES + 1)
+        bc_table = np.zeros(NUM_CLASSES + 1)
+        oc_table[codes] = oc_rates
+        bc_table[codes] = bc_rates
+
+        emissions[month, 0] = oc_table[classes]
+        emissions[month, 1] = bc_table[classes]
+    return emissions
+
+
+def getTransitionClasses(initialLandcover, finalLandcover, peatmask):
+    """Returns the class codes of emiss.getTransitionClasses as an integer
+    array, with NUM_CLASSES where the EE image is masked."""
+    islands = rasters.load('island_boundary_null')
+    indo_mask = rasters.load('indonesia')
+
+    island_class = (islands == 2) + (islands == 3) * 2
+    # peatmask is 1 outside peat and 0 on peat
+    peat_class = (peatmask == 1) + (peatmask == 0) * 2
+    indo_class = np.nan_to_num(indo_mask) != 0
+
+    num_transitions = len(emiss.TRANSITION_INITIAL)
+    transition = np.empty(initialLandcover.shape, dtype=np.int16)
+    transition.fill(-1)
+    pairs = np.nan_to_num(initialLandcover) * 10 + np.nan_to_num(finalLandcover)
+    for i, (initial, final) in enumerate(zip(emiss.TRANSITION_INITIAL, emiss.TRANSITION_FINAL)):
+        transition[pairs == initial * 10 + final] = i
+
+    region = island_class + peat_class * 3 + indo_class * 9
+    classes = (transition + region * num_transitions).astype(np.int16)
+    classes[transition < 0] = NUM_CLASSES
+    return classes
+
+
+# number of transition class codes
+NUM_CLASSES = len(emiss.TRANSITION_INITIAL) * 3 * 3 * 2
+
+# The tile of checkParity, in Riau where every policy layer has cells, and
+# the relative difference it tolerates.
+PARITY_TILE = [101.0, 0.0, 102.0, 1.0]
+PARITY_TOLERANCE = 1e-3
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) >= 5 and sys.argv[1] == 'parity':
+        import config
+        import ee
+        ee.Initialize(config.getCredentials())
+        toggles = [layer in sys.argv[5:] for layer in emiss.POLICY_LAYERS]
+        provinces = [name for name in sys.argv[5:] if name not in emiss.POLICY_LAYERS]
+        comparison, agree = checkParity(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), *(toggles + [provinces]))
+        for name, value, ee_value in comparison:
+            print('{}: local {} EE {}'.format(name, value, ee_value))
+        if not agree:
+            sys.exit('local and EE emissions differ by more than {}'.format(PARITY_TOLERANCE))
+    else:
+        print('usage: localemiss.py parity scenario year metYear [policy layer | province ...]')
@@ -0,0 +1,109 @@
+""" Offline receptor PM engine
+
+Computes receptor PM like server.getMonthlyPM, on the local rasters from
+rasters.py: emissions are averaged over the cells of the coarse sensitivity
+grid, and the PM of a month is the sum over coarse cells of sensitivity x
+coarse emissions x SCALE_FACTOR x pixel area, for the hydrophilic and the
+hydrophobic band.
+
+That sum is a dot product with a fixed weight vector per receptor, month and
+band. PMEngine keeps those weights as float32, for the coarse cells where any
+of them is non-zero only, and evaluates many emission fields and receptors
+with one matrix product per month:
+
+    engine = localpm.getEngine(['Singapore', 'Malaysia'], 2006)
+    monthly = engine.monthlyPM(coarse_emissions)   # (fields, 12, receptors)
+
+Sweeps that vary the emissions only need to aggregate each field once (see
+regrid.py), or can assemble coarse fields from precomputed parts, since PM is
+linear in the emissions.
+"""
+
+import threading
+
+import numpy as np
+
+import localemiss
+import rasters
+import regrid
+import surface
+
+
+class PMEngine(object):
+    """Receptor PM of coarse emission fields, for the sensitivities of some
+    receptors and one meteorological year."""
+
+    def __init__(self, receptors, metYear):
+        self.receptors = list(receptors)
+        self.metYear = metYear
+        area = np.nan_to_num(np.asarray(rasters.load('coarse_pixel_area'), dtype=np.float64)).ravel()
+
+        # (receptors, 12, 2, coarse cells)
+        weights = np.array([np.nan_to_num(np.asarray(rasters.load(rasters.sensitivityName(receptor, metYear)), dtype=np.float64)).reshape((12, 2, -1)) * area * SCALE_FACTOR
+                            for receptor in self.receptors])
+        self.num_cells = weights.shape[-1]
+        self.cells = np.flatnonzero((weights != 0).reshape((-1, self.num_cells)).any(axis=0))
+        # (12, 2 * used cells, receptors), b1 weights first
+        used = weights[:, :, :, self.cells].reshape((len(self.receptors), 12, -1))
+        self.weights = np.ascontiguousarray(used.transpose(1, 2, 0), dtype=np.float32)
+
+    def monthlyPM(self, coarse_emissions):
+        """Returns the monthly receptor PM of coarse emission fields.
+
+        coarse_emissions has shape (..., 12, 2, coarse cells), the hydrophilic
+        and hydrophobic emissions of every month as returned by aggregate. The
+        result has shape (..., 12, receptors).
+        """
+        coarse_emissions = np.asarray(coarse_emissions, dtype=np.float32)
+        lead = coarse_emissions.shape[:-3]
+        fields = coarse_emissions[..., self.cells].reshape((-1, 12, 2 * len(self.cells)))
+        pm = np.empty((fields.shape[0], 12, len(self.receptors)))
+        for month in range(12):
+            pm[:, month] = np.dot(fields[:, month], self.weights[month])
+        return pm.reshape(lead + (12, len(self.receptors)))
+
+
+def aggregate(emissions):
+    """Averages fine emissions (..., rows, columns) over the coarse cells,
+    like regrid.aggregate in server.getMonthlyPM. Returns an array of shape
+    (..., coarse cells)."""
+    return regrid.getOperator().apply(emissions)
+
+
+def exposure(monthly):
+    """Returns the exposure time series, seasonal and annual PM of the
+    monthly PM of one field and receptor, in the formats of GetMapData."""
+    monthly = [float(value) for value in monthly]
+    return ([[str(month), monthly[month]] for month in range(12)],
+            {'b1': sum(monthly[month] for month in surface.SEASON) / len(surface.SEASON)},
+            {'b1': sum(monthly) / 12.0})
+
+
+def evaluate(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+    """Returns exposure, totalPM, annualPM and total emissions of a scenario,
+    computed locally with localemiss and the PM engine."""
+    emissions, totalE = localemiss.getEmissions(scenario, emissYear, metYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    monthly = getEngine([receptor], metYear).monthlyPM(aggregate(emissions))
+    timeseries, totalPM, annualPM = exposure(monthly[:, 0])
+    return timeseries, totalPM, annualPM, totalE
+
+
+def getEngine(receptors, metYear):
+    """Returns the PM engine of some receptors and a meteorological year,
+    loading the sensitivities on first use."""
+    key = (tuple(receptors), int(metYear))
+    with _LOCK:
+        if key not in _ENGINES:
+            _ENGINES[key] = PMEngine(receptors, int(metYear))
+        return _ENGINES[key]
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+# as server.SCALE_FACTOR
+SCALE_FACTOR = 1.0 / (24.0 * 24.0 * 3.0)
+
+_LOCK = threading.Lock()
+_ENGINES = {}
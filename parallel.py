@@ -0,0 +1,114 @@
+""" Bounded thread pool for independent EE requests
+
+Most of the time spent on an EE request is network wait, so calls that do not
+depend on each other (e.g. getMapId for different layers) are dispatched from
+a small pool of threads. Each call runs with the round-trip accounting context
+of the request that submitted it.
+"""
+
+import Queue
+import threading
+import time
+
+import diagnostics
+
+
+class CallTimeout(Exception):
+    """Raised in place of the result of a call that took too long."""
+
+
+def runConcurrently(calls, max_workers=None, timeout=None):
+    """Runs the functions in calls concurrently.
+
+    Args:
+      calls: a list of (key, function) pairs, functions take no arguments.
+      max_workers: the maximum number of threads, MAX_WORKERS by default.
+      timeout: seconds a single call may run before it is abandoned,
+          CALL_TIMEOUT by default.
+
+    Returns:
+      A (results, errors) pair of dictionaries keyed by the call keys. A call
+      that raised or timed out has an exception in errors instead of a result,
+      the other calls are not affected.
+    """
+    max_workers = max_workers or MAX_WORKERS
+    timeout = timeout or CALL_TIMEOUT
+    context = diagnostics.currentContext()
+
+    pending = Queue.Queue()
+    jobs = []
+    for key, function in calls:
+        job = _Job(key, function)
+        jobs.append(job)
+        pending.put(job)
+
+    def worker():
+        diagnostics.bindContext(context)
+        while True:
+            try:
+                job = pending.get_nowait()
+            except Queue.Empty:
+                return
+            job.run()
+
+    def startWorker():
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for i in range(min(max_workers, len(jobs))):
+        startWorker()
+
+    results = {}
+    errors = {}
+    for job in jobs:
+        while not job.done.is_set():
+            if job.started is None:
+                # still queued behind other calls
+                job.done.wait(POLL_INTERVAL)
+                continue
+            remaining = job.started + timeout - time.time()
+            if remaining <= 0:
+                break
+            job.done.wait(remaining)
+
+        if not job.done.is_set():
+            errors[job.key] = CallTimeout('{} took longer than {} s'.format(job.key, timeout))
+            # the abandoned call keeps its thread, so replace it for the queue
+            if not pending.empty():
+                startWorker()
+        elif job.error is not None:
+            errors[job.key] = job.error
+        else:
+            results[job.key] = job.result
+
+    return results, errors
+
+
+class _Job(object):
+
+    def __init__(self, key, function):
+        self.key = key
+        self.function = function
+        self.started = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        try:
+            self.result = self.function()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+
+# Number of threads used to dispatch one request's calls.
+MAX_WORKERS = 6
+
+# Seconds a single call may take before it is reported as failed.
+CALL_TIMEOUT = 45
+
+POLL_INTERVAL = 0.05
@@ -0,0 +1,94 @@
+""" Province id raster
+
+Province selections used to be rasterized from the province boundary Fusion
+Table on every request, one reduceToImage per selected province. Instead
+PROVINCE_IDS_ASSET stores the id of the province of every emissions grid
+cell (0 outside the provinces), and its 'names' property the province names
+in id order (id = position + 1), so that any set of provinces becomes one
+remap of the ids. The local backend reads the same ids from the raster store
+(rasters.py) and the name to id index written next to them.
+
+The asset and the local index are built once with
+
+    python provinceids.py build
+"""
+
+import json
+import os
+import sys
+
+import ee
+
+
+def getProvinceIds():
+    """Returns the province id image on the emissions grid."""
+    return ee.Image(PROVINCE_IDS_ASSET)
+
+
+def getProvinceNames():
+    """Returns the province names in id order, as an ee.List."""
+    return ee.String(getProvinceIds().get('names')).split(NAME_SEPARATOR)
+
+
+def getExclusionMask(provinces):
+    """Returns an image that is 0 in the given provinces and 1 elsewhere, for
+    updateMask, or None if no province is given."""
+    if not provinces:
+        return None
+    names = getProvinceNames()
+    # unknown names would get id 0, which is outside the provinces
+    ids = ee.List(list(provinces)).map(lambda province: names.indexOf(province).add(1)).removeAll([0])
+    return getProvinceIds().remap(ids, ee.List.repeat(0, ids.size()), 1)
+
+
+def buildAssets():
+    """Starts the export of the province id asset from the boundary Fusion
+    Table and writes the name to id index of the local backend. Returns the
+    started task."""
+    import rasters
+
+    boundaries = ee.FeatureCollection(BOUNDARY_TABLE)
+    names = ee.List(boundaries.aggregate_array('NAME_1')).distinct().sort()
+
+    def setId(feature):
+        return feature.set('pid', names.indexOf(feature.get('NAME_1')).add(1))
+    ids = boundaries.map(setId).reduceToImage(['pid'], ee.Reducer.first()).unmask(0).int().set('names', names.join(NAME_SEPARATOR))
+
+    projection = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid').projection()
+    task = ee.batch.Export.image.toAsset(ids.reproject(projection), rasters.assetName(PROVINCE_IDS_ASSET), assetId=PROVINCE_IDS_ASSET,
+                                         region=ee.Geometry.Rectangle([90, -20, 150, 10]), crs=projection.crs().getInfo(),
+                                         scale=projection.nominalScale().getInfo(), maxPixels=1e10)
+    task.start()
+
+    index = dict((name, i + 1) for i, name in enumerate(names.getInfo()))
+    if not os.path.isdir(rasters.DATA_DIR):
+        os.makedirs(rasters.DATA_DIR)
+    with open(os.path.join(rasters.DATA_DIR, LOCAL_INDEX + '.json'), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    return task
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+PROVINCE_IDS_ASSET = 'projects/IndonesiaPolicyTool/province_ids'
+
+# name of the name to id index in the local raster store
+LOCAL_INDEX = 'province_index'
+
+# separates the names in the 'names' property of the asset (a regular
+# expression for ee.String.split)
+NAME_SEPARATOR = ';'
+
+# The province boundaries, only read by buildAssets.
+BOUNDARY_TABLE = 'ft:19JY_hNX1c_zk7UVlt4LC8cj7Qv3wKqnKJHN84wWs'
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'build':
+        import config
+        ee.Initialize(config.getCredentials())
+        print(buildAssets().status())
+    else:
+        print('usage: provinceids.py build')
@@ -0,0 +1,195 @@
+""" Local copies of the EE rasters used by the offline backends
+
+The offline backends (see localemiss.py and localpm.py) read the same inputs
+as the EE pipeline from .npy files in DATA_DIR instead of from Earth Engine. All rasters are on the dsGFEDgrid emissions grid, stored as float32
+with NaN where the EE image is masked, and are opened memory-mapped so that
+only the pixels actually used are read. The exceptions are the sensitivities,
+coarse_pixel_area and the coarse cell ids of regrid.py, which are on the
+coarse grid of the sensitivities.
+
+Exporting is a one-off job: exportRasters() starts GeoTIFF exports of every
+raster to Cloud Storage, and once they are downloaded convertGeoTiff() turns
+each of them into the .npy file the backends read.
+
+    python rasters.py export
+    python rasters.py convert peatlands.tif peatlands
+"""
+
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+
+
+def load(name):
+    """Returns the raster called name as a read-only, memory-mapped array."""
+    with _LOCK:
+        if name not in _OPEN:
+            path = rasterPath(name)
+            if not os.path.exists(path):
+                raise IOError('missing local raster {} (export it with rasters.py)'.format(path))
+            _OPEN[name] = np.load(path, mmap_mode='r')
+        return _OPEN[name]
+
+
+def loadIndex(name):
+    """Returns the JSON index stored next to the rasters, e.g. the province
+    name to id mapping of the province raster."""
+    with open(os.path.join(DATA_DIR, name + '.json')) as f:
+        return json.load(f)
+
+
+def rasterPath(name):
+    return os.path.join(DATA_DIR, name + '.npy')
+
+
+def gfedName(year):
+    """Returns the raster name of one year of GFED4 dry matter, stored as
+    (12 months, 6 bands, rows, columns)."""
+    return 'gfed4_' + str(year)
+
+
+def sensitivityName(receptor, year):
+    """Returns the raster name of the monthly sensitivities of a receptor,
+    divided by ndays^2 like server.getSensitivity and stored as (12 months,
+    2 bands, rows, columns) on the coarse grid."""
+    return 'sensitivity_{}_{}'.format(receptor, year)
+
+
+def assetName(asset_id):
+    """Returns the raster name of an EE image asset."""
+    return asset_id.split('/')[-1]
+
+
+def exportRasters(names=None, bucket='smoke_app_output'):
+    """Starts EE exports of the local rasters to Cloud Storage.
+
+    Every raster is exported on the dsGFEDgrid projection, except the coarse
+    grid rasters, which keep the projection of the sensitivities. Returns the
+    started tasks.
+    """
+    import ee
+    import regrid
+    import server
+
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
+    west, south, east, north = EXPORT_BOUNDS
+    region = [[west, south], [west, north], [east, north], [east, south]]
+
+    images = {}
+    for asset_id in RASTER_ASSETS:
+        images[assetName(asset_id)] = ee.Image(asset_id)
+    images['pixel_area'] = ee.Image.pixelArea()
+    for year in GFED_YEARS:
+        monthly_dm = ee.ImageCollection('projects/IndonesiaPolicyTool/gfed4').filterDate(str(year) + '-01-1', str(year) + '-12-31').sort('system:time_start', True)
+        images[gfedName(year)] = monthly_dm.toBands()
+
+    # coarse grid rasters
+    coarse_projections = {}
+    for receptor in SENSITIVITY_RECEPTORS:
+        for year in SENSITIVITY_YEARS:
+            sensitivities = server.getSensitivity(receptor, year)
+            images[sensitivityName(receptor, year)] = sensitivities.select(['b1', 'b2']).toBands()
+            coarse_projections[sensitivityName(receptor, year)] = ee.Image(sensitivities.first()).projection()
+    coarse = coarse_projections[sensitivityName(SENSITIVITY_RECEPTORS[0], SENSITIVITY_YEARS[0])]
+    images['coarse_pixel_area'] = ee.Image.pixelArea().reproject(coarse)
+    coarse_projections['coarse_pixel_area'] = coarse
+    # the cell ids of the regridding operator, see regrid.py
+    images[regrid.FINE_CELLS_RASTER] = ee.Image(regrid.FINE_CELLS_ASSET)
+    images[regrid.COARSE_CELLS_RASTER] = ee.Image(regrid.COARSE_CELLS_ASSET)
+    coarse_projections[regrid.COARSE_CELLS_RASTER] = coarse
+
+    tasks = []
+    for name in sorted(names or images.keys()):
+        projection = coarse_projections.get(name, ds_grid.projection())
+        image = images[name].toFloat().reproject(crs=projection, scale=projection.nominalScale())
+        task = ee.batch.Export.image.toCloudStorage(image, name, bucket=bucket, fileNamePrefix='rasters/' + name, region=region, crs=projection.crs().getInfo(), scale=projection.nominalScale().getInfo())
+        task.start()
+        tasks.append(task)
+    return tasks
+
+
+def convertGeoTiff(tif_path, name):
+    """Converts an exported GeoTIFF into the .npy raster called name.
+
+    Needs the GDAL Python bindings, which are only required on the machine
+    that prepares the local data.
+    """
+    from osgeo import gdal
+
+    dataset = gdal.Open(tif_path)
+    bands = []
+    for i in range(1, dataset.RasterCount + 1):
+        band = dataset.GetRasterBand(i)
+        data = band.ReadAsArray().astype(np.float32)
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            data[data == nodata] = np.nan
+        bands.append(data)
+
+    data = np.array(bands)
+    if name.startswith('gfed4_'):
+        # bands come as month 1 b1..b6, month 2 b1..b6, ...
+        data = data.reshape((12, 6) + data.shape[1:])
+    elif name.startswith('sensitivity_'):
+        # bands come as month 1 b1, b2, month 2 b1, b2, ...
+        data = data.reshape((12, 2) + data.shape[1:])
+    elif data.shape[0] == 1:
+        data = data[0]
+
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    np.save(rasterPath(name), data)
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+# Directory of the local rasters, can be set with the POLICY_TOOL_DATA
+# environment variable.
+DATA_DIR = os.environ.get('POLICY_TOOL_DATA', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+# [west, south, east, north] of the exported rasters
+EXPORT_BOUNDS = [90, -20, 150, 10]
+
+# Image assets copied to the local store, under their last path component.
+RASTER_ASSETS = [
+    'projects/IndonesiaPolicyTool/marHanS2005',
+    'projects/IndonesiaPolicyTool/marHanS2010',
+    'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2010',
+    'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2015',
+    'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2020',
+    'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2025',
+    'projects/IndonesiaPolicyTool/marHanS_future/future_LULC_MarHanS_2030',
+    'projects/IndonesiaPolicyTool/peatlands',
+    'projects/IndonesiaPolicyTool/policy_bits',
+    'projects/IndonesiaPolicyTool/island_boundary_null',
+    'projects/IndonesiaPolicyTool/indonesia',
+    'projects/IndonesiaPolicyTool/province_ids',
+]
+
+# Years of GFED4 dry matter emissions copied to the local store.
+GFED_YEARS = range(2005, 2016)
+
+# Receptors and meteorological years of the sensitivities in the local store.
+SENSITIVITY_RECEPTORS = ['Singapore', 'Malaysia', 'Indonesia', 'Population_weighted_SEAsia']
+SENSITIVITY_YEARS = range(2005, 2010)
+
+_LOCK = threading.Lock()
+_OPEN = {}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        import config
+        import ee
+        ee.Initialize(config.getCredentials())
+        for task in exportRasters(sys.argv[2:] or None):
+            print(task.status())
+    elif len(sys.argv) == 4 and sys.argv[1] == 'convert':
+        convertGeoTiff(sys.argv[2], sys.argv[3])
+    else:
+        print('usage: rasters.py export [name ...] | rasters.py convert file.tif name')
@@ -0,0 +1,273 @@
+""" Zoom-dependent region overlay tiles
+
+The region overlays in static/regions are large GeoJSON files. build() cuts
+them into web mercator tiles for zoom levels MIN_ZOOM to MAX_ZOOM, so that
+the client only downloads the features in its viewport, at a level of detail
+that fits the zoom:
+
+  - rings are simplified with Douglas-Peucker to half a screen pixel of the
+    zoom level, and polygons smaller than that are dropped,
+  - coordinates are quantized to a quarter pixel and stored as delta encoded
+    integers in TopoJSON,
+  - only the properties the client styles by (KEPT_PROPERTIES) are kept,
+  - every tile is stored gzipped, and served as is to clients accepting gzip.
+
+A feature is put whole into every tile its bounding box touches, under the
+same id, so the client's data layer replaces rather than duplicates it. The
+geometry is not clipped to the tile, which would draw the tile edges as
+outlines. MAX_ZOOM tiles carry the detail of DETAIL_ZOOM and are used for all
+closer zooms.
+
+    python regiontiles.py build
+"""
+
+import gzip
+import json
+import math
+import os
+import shutil
+import sys
+
+
+def build(regions=None):
+    """Builds the tiles of the GeoJSON regions in REGION_PATH (all by
+    default) into TILE_PATH."""
+    if regions is None:
+        regions = sorted(name[:-len('.json')] for name in os.listdir(REGION_PATH) if name.endswith('.json'))
+    for region in regions:
+        with open(os.path.join(REGION_PATH, region + '.json')) as f:
+            collection = json.load(f)
+        region_path = os.path.join(TILE_PATH, region)
+        if os.path.isdir(region_path):
+            shutil.rmtree(region_path)
+        for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+            tiles = buildZoom(region, collection['features'], zoom)
+            for (x, y), topology in tiles.items():
+                writeTile(region, zoom, x, y, topology)
+            print('{} zoom {}: {} tiles'.format(region, zoom, len(tiles)))
+
+
+def buildZoom(region, features, zoom):
+    """Returns {(x, y): TopoJSON topology} of the tiles of one zoom level."""
+    detail_zoom = DETAIL_ZOOM if zoom == MAX_ZOOM else zoom
+    tolerance = pixelDegrees(detail_zoom) * SIMPLIFY_PIXELS
+    step = pixelDegrees(detail_zoom) / QUANTIZE_PER_PIXEL
+
+    tiles = {}
+    for index, feature in enumerate(features):
+        polygons = simplifyGeometry(feature['geometry'], tolerance)
+        if not polygons:
+            continue
+        west, south, east, north = boundingBox(polygons)
+        x0, y0 = tileOf(west, north, zoom)
+        x1, y1 = tileOf(east, south, zoom)
+        properties = dict((key, feature['properties'].get(key)) for key in KEPT_PROPERTIES)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                if (x, y) not in tiles:
+                    tiles[(x, y)] = _Tile(region, zoom, x, y, step)
+                tiles[(x, y)].add('{}:{}'.format(region, index), properties, polygons)
+    return dict((key, tile.topology()) for key, tile in tiles.items())
+
+
+def writeTile(region, zoom, x, y, topology):
+    path = tilePath(region, zoom, x, y)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with gzip.open(path, 'wb') as f:
+        f.write(json.dumps(topology, separators=(',', ':')).encode('utf-8'))
+
+
+def readTile(region, zoom, x, y):
+    """Returns the gzipped TopoJSON of a tile, or None if it has no features."""
+    path = tilePath(region, zoom, x, y)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def tiledRegions():
+    """Returns the names of the regions that have tiles."""
+    if not os.path.isdir(TILE_PATH):
+        return []
+    return sorted(name for name in os.listdir(TILE_PATH) if os.path.isdir(os.path.join(TILE_PATH, name)))
+
+
+def tilePath(region, zoom, x, y):
+    return os.path.join(TILE_PATH, region, str(zoom), str(x), '{}.json.gz'.format(y))
+
+
+def pixelDegrees(zoom):
+    """Degrees of longitude per screen pixel at a zoom level."""
+    return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+
+def tileOf(lon, lat, zoom):
+    """Returns the (x, y) web mercator tile containing a point."""
+    n = 2 ** zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(math.radians(lat)) + 1.0 / math.cos(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def boundingBox(polygons):
+    lons = [point[0] for polygon in polygons for point in polygon[0]]
+    lats = [point[1] for polygon in polygons for point in polygon[0]]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def simplifyGeometry(geometry, tolerance):
+    """Returns the polygons of a (Multi)Polygon as lists of simplified rings.
+    Rings that collapse are dropped, and polygons whose outer ring does."""
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        return []
+
+    simplified = []
+    for polygon in polygons:
+        rings = []
+        for i, ring in enumerate(polygon):
+            ring = simplifyRing(ring, tolerance)
+            if ring is None:
+                if i == 0:
+                    break
+                continue
+            rings.append(ring)
+        if rings:
+            simplified.append(rings)
+    return simplified
+
+
+def simplifyRing(ring, tolerance):
+    """Douglas-Peucker simplification of a closed ring, None if the ring is
+    smaller than tolerance."""
+    lons = [point[0] for point in ring]
+    lats = [point[1] for point in ring]
+    if max(lons) - min(lons) < tolerance and max(lats) - min(lats) < tolerance:
+        return None
+
+    keep = [False] * len(ring)
+    keep[0] = keep[-1] = True
+    # a closed ring has equal end points, so split it at its farthest point
+    farthest = max(range(len(ring)), key=lambda i: (ring[i][0] - ring[0][0]) ** 2 + (ring[i][1] - ring[0][1]) ** 2)
+    keep[farthest] = True
+    stack = [(0, farthest), (farthest, len(ring) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        index, distance = _farthestFromSegment(ring, first, last)
+        if distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    simplified = [ring[i] for i in range(len(ring)) if keep[i]]
+    if len(simplified) < 4:
+        return None
+    return simplified
+
+
+def _farthestFromSegment(ring, first, last):
+    ax, ay = ring[first][0], ring[first][1]
+    bx, by = ring[last][0], ring[last][1]
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    best, best_distance = first, -1.0
+    for i in range(first + 1, last):
+        px, py = ring[i][0], ring[i][1]
+        if length2 == 0:
+            distance = math.hypot(px - ax, py - ay)
+        else:
+            t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length2))
+            distance = math.hypot(px - ax - t * dx, py - ay - t * dy)
+        if distance > best_distance:
+            best, best_distance = i, distance
+    return best, best_distance
+
+
+class _Tile(object):
+    """Collects the features of one tile as quantized TopoJSON."""
+
+    def __init__(self, region, zoom, x, y, step):
+        self.region = region
+        self.step = step
+        # origin at the north west corner of the tile
+        n = 2.0 ** zoom
+        self.west = x / n * 360.0 - 180.0
+        self.north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+        self.arcs = []
+        self.geometries = []
+
+    def add(self, feature_id, properties, polygons):
+        arcs = []
+        for polygon in polygons:
+            polygon_arcs = []
+            for ring in polygon:
+                arc = self._encode(ring)
+                if arc is not None:
+                    polygon_arcs.append([len(self.arcs)])
+                    self.arcs.append(arc)
+            if polygon_arcs:
+                arcs.append(polygon_arcs)
+        if arcs:
+            self.geometries.append({'type': 'MultiPolygon', 'arcs': arcs, 'id': feature_id, 'properties': properties})
+
+    def topology(self):
+        return {
+            'type': 'Topology',
+            'transform': {'scale': [self.step, self.step], 'translate': [self.west, self.north]},
+            'objects': {self.region: {'type': 'GeometryCollection', 'geometries': self.geometries}},
+            'arcs': self.arcs,
+        }
+
+    def _encode(self, ring):
+        # delta encoded integer positions, repeated positions removed
+        arc = []
+        previous = None
+        px, py = 0, 0
+        for lon, lat in ((point[0], point[1]) for point in ring):
+            qx = int(round((lon - self.west) / self.step))
+            qy = int(round((lat - self.north) / self.step))
+            if (qx, qy) == previous:
+                continue
+            arc.append([qx - px, qy - py])
+            previous = (qx, qy)
+            px, py = qx, qy
+        if len(arc) < 4:
+            return None
+        return arc
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+REGION_PATH = os.path.join(BASE_PATH, 'static', 'regions')
+TILE_PATH = os.path.join(BASE_PATH, 'regiontiles')
+
+MIN_ZOOM = 4
+MAX_ZOOM = 8
+DETAIL_ZOOM = 11
+
+TILE_SIZE = 256
+SIMPLIFY_PIXELS = 0.5
+QUANTIZE_PER_PIXEL = 4
+
+# feature properties used by the client's layer styles
+KEPT_PROPERTIES = ['objectid_1']
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'build':
+        build(sys.argv[2:] or None)
+    else:
+        print('usage: regiontiles.py build [region ...]')
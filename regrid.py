@@ -0,0 +1,233 @@
+""" Fine to coarse regridding operator
+
+Emissions are computed on the dsGFEDgrid emissions grid and averaged over
+the cells of the coarse sensitivity grid before they are multiplied with the
+sensitivities. The cells used to be the features of a Fusion Table, and every
+month of every request reduced the emissions over all of them with
+reduceRegions and painted the result back with reduceToImage.
+
+The mapping between fine and coarse cells never changes, so it is stored
+once as two integer rasters: FINE_CELLS_ASSET has the cell id of every
+emissions grid cell, COARSE_CELLS_ASSET the cell id of every coarse grid
+cell. On EE, aggregate is then one grouped reduction over the fine cell ids
+and one remap of the coarse cell ids per band. A fine cell belongs to the
+coarse cell that contains its centre, as with reduceRegions.
+
+Locally (see localpm.py) the same rasters give an Operator, which averages
+any number of emission fields with one bincount.
+
+The assets are built once, from the Fusion Table grid, with
+
+    python regrid.py build
+
+and compareWithFusionTable checks aggregate against the reduceRegions path
+it replaced on one month of emissions, recording the differences in
+COMPARISON_FILE:
+
+    python regrid.py compare Miriam Singapore 2006 2006
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+import ee
+import numpy as np
+
+import graphprofile
+import rasters
+
+
+def aggregate(image, bands):
+    """Averages the bands of a fine emissions image over the cells of the
+    coarse sensitivity grid. Masked fine cells are left out of the averages,
+    coarse cells without any unmasked fine cell are masked."""
+    return _reduceToCoarse(image, bands, ee.Reducer.mean().unweighted(), 'mean')
+
+
+def count(image, bands):
+    """Counts the unmasked fine cells of the bands of image in every coarse
+    cell."""
+    return _reduceToCoarse(image, bands, ee.Reducer.count(), 'count')
+
+
+def _reduceToCoarse(image, bands, reducer, output):
+    fine_cells = ee.Image(FINE_CELLS_ASSET).rename(['cell'])
+    coarse_cells = ee.Image(COARSE_CELLS_ASSET)
+    projection = fine_cells.projection()
+
+    # one reduction for all bands and cells: {'cell': id, output: [per band]}
+    groups = ee.List(image.select(bands).addBands(fine_cells).reduceRegion(
+        reducer=reducer.repeat(len(bands)).group(groupField=len(bands), groupName='cell'),
+        geometry=ee.Geometry.Rectangle(REGION), crs=projection, scale=projection.nominalScale(), maxPixels=1e10).get('groups'))
+    ids = groups.map(lambda group: ee.Dictionary(group).get('cell'))
+
+    coarse = []
+    for i, band in enumerate(bands):
+        values = groups.map(lambda group: ee.List(ee.Dictionary(group).get(output)).get(i))
+        coarse.append(coarse_cells.remap(ids, values).rename([band]))
+    graphprofile.record('regrid ' + output, groups, depth=2)
+    return ee.Image.cat(coarse)
+
+
+class Operator(object):
+    """Local version of aggregate, for arrays on the local rasters.
+
+    fine_cells and coarse_cells are the cell id rasters of FINE_CELLS_ASSET
+    and COARSE_CELLS_ASSET, NaN or negative outside the grid.
+    """
+
+    def __init__(self, fine_cells, coarse_cells):
+        fine_cells = np.asarray(fine_cells, dtype=np.float64).ravel()
+        coarse_cells = np.asarray(coarse_cells, dtype=np.float64).ravel()
+        fine_cells[~np.isfinite(fine_cells)] = -1
+        coarse_cells[~np.isfinite(coarse_cells)] = -1
+
+        # renumber the cells 0 .. num_cells - 1, -1 outside the grid
+        ids = np.unique(coarse_cells[coarse_cells >= 0])
+        self.num_cells = len(ids)
+        self.fine = self._renumber(fine_cells, ids)
+        self.coarse = self._renumber(coarse_cells, ids)
+        self.inside = np.flatnonzero(self.fine >= 0)
+
+    @staticmethod
+    def _renumber(cells, ids):
+        position = np.minimum(np.searchsorted(ids, cells), len(ids) - 1)
+        return np.where((cells >= 0) & (ids[position] == cells), position, -1)
+
+    def apply(self, fine):
+        """Averages fine fields of shape (..., rows, columns) over the coarse
+        cells. NaN fine cells are left out, coarse cells without any valid
+        fine cell are 0. Returns an array of shape (..., coarse rows *
+        coarse columns)."""
+        fine = np.asarray(fine)
+        lead = fine.shape[:-2]
+        values = fine.reshape((-1, self.fine.size))[:, self.inside]
+
+        # one bincount over all fields, field i using bins i * num_cells ...
+        fields = values.shape[0]
+        bins = (self.fine[self.inside] + self.num_cells * np.arange(fields)[:, np.newaxis]).ravel()
+        valid = np.isfinite(values).ravel()
+        sums = np.bincount(bins[valid], weights=values.ravel()[valid], minlength=fields * self.num_cells)
+        counts = np.bincount(bins[valid], minlength=fields * self.num_cells)
+        means = np.where(counts > 0, sums / np.maximum(counts, 1), 0.0).reshape((fields, self.num_cells))
+
+        # back onto the coarse raster
+        coarse = np.zeros((fields, self.coarse.size))
+        coarse[:, self.coarse >= 0] = means[:, self.coarse[self.coarse >= 0]]
+        return coarse.reshape(lead + (self.coarse.size,))
+
+
+def getOperator():
+    """Returns the Operator of the local rasters, built on first use."""
+    with _LOCK:
+        if 'operator' not in _OPERATOR:
+            _OPERATOR['operator'] = Operator(rasters.load(FINE_CELLS_RASTER), rasters.load(COARSE_CELLS_RASTER))
+        return _OPERATOR['operator']
+
+
+def buildAssets(receptor='Singapore', year=2006):
+    """Starts the exports of the cell id assets from the Fusion Table grid,
+    the coarse one on the projection of the sensitivities of receptor and
+    year. Returns the started tasks."""
+    import server
+
+    grid = ee.FeatureCollection(GRID_TABLE)
+    ids = grid.aggregate_array('system:index')
+
+    def setId(feature):
+        return feature.set('cell', ids.indexOf(feature.get('system:index')))
+    cells = grid.map(setId).reduceToImage(['cell'], ee.Reducer.first()).int()
+
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid').projection()
+    coarse = ee.Image(server.getSensitivity(receptor, year).first()).projection()
+    tasks = []
+    for asset, projection in [(FINE_CELLS_ASSET, ds_grid), (COARSE_CELLS_ASSET, coarse)]:
+        task = ee.batch.Export.image.toAsset(cells.reproject(projection), rasters.assetName(asset), assetId=asset,
+                                             region=ee.Geometry.Rectangle(REGION), crs=projection.crs().getInfo(),
+                                             scale=projection.nominalScale().getInfo(), maxPixels=1e10)
+        task.start()
+        tasks.append(task)
+    return tasks
+
+
+def aggregateFusionTable(image, bands):
+    """The reduceRegions version of aggregate over the Fusion Table grid, as
+    it was before the cell id assets. Only used by compareWithFusionTable."""
+    grid = ee.FeatureCollection(GRID_TABLE)
+    regridded = image.reduceRegions(collection=grid, reducer=ee.Reducer.mean().unweighted(), scale=image.projection().nominalScale())
+    coarse = [regridded.reduceToImage(properties=ee.List([band]), reducer=ee.Reducer.mean().unweighted()).rename([band]) for band in bands]
+    return ee.Image.cat(coarse)
+
+
+def compareWithFusionTable(image, bands, projection):
+    """Returns the differences between aggregate and aggregateFusionTable of
+    image on the coarse projection: per band the largest absolute and
+    relative difference, and the coarse cells that only one of them masks."""
+    new = aggregate(image, bands)
+    old = aggregateFusionTable(image, bands)
+    region = ee.Geometry.Rectangle(REGION)
+
+    stats = {}
+    for band in bands:
+        difference = new.select(band).subtract(old.select(band)).abs()
+        relative = difference.divide(old.select(band).abs().max(ee.Image(RELATIVE_FLOOR)))
+        mismatch = new.select(band).mask().neq(old.select(band).mask()).unmask(1, False)
+        stats[band] = ee.Image.cat([difference.rename(['max_abs']), relative.rename(['max_rel'])]).reduceRegion(
+            ee.Reducer.max(), region, crs=projection, maxPixels=1e10).combine(
+            mismatch.rename(['mask_mismatch']).reduceRegion(ee.Reducer.sum().unweighted(), region, crs=projection, maxPixels=1e10))
+    return ee.Dictionary(stats).getInfo()
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+FINE_CELLS_ASSET = 'projects/IndonesiaPolicyTool/regrid_fine_cells'
+COARSE_CELLS_ASSET = 'projects/IndonesiaPolicyTool/regrid_coarse_cells'
+
+# their names in the local raster store
+FINE_CELLS_RASTER = rasters.assetName(FINE_CELLS_ASSET)
+COARSE_CELLS_RASTER = rasters.assetName(COARSE_CELLS_ASSET)
+
+# The coarse cells as a Fusion Table, only read by buildAssets.
+GRID_TABLE = 'ft:10zDDmOTT43LmBdYb8p93Ki6BbdXjQDLzdi01aF43'
+
+REGION = [90, -20, 150, 10]
+
+# The record of the last compareWithFusionTable run, and the magnitude below
+# which differences are compared absolutely rather than relatively.
+COMPARISON_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regrid_comparison.json')
+RELATIVE_FLOOR = 1e-12
+
+_LOCK = threading.Lock()
+_OPERATOR = {}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'build':
+        import config
+        ee.Initialize(config.getCredentials())
+        for task in buildAssets():
+            print(task.status())
+    elif len(sys.argv) == 6 and sys.argv[1] == 'compare':
+        import config
+        import emiss
+        import server
+        ee.Initialize(config.getCredentials())
+        scenario, receptor, metYear, emissYear = sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5])
+        emissions = emiss.getEmissions(scenario, emissYear, metYear, False, False, False, False, False, False, [])[0]
+        projection = ee.Image(server.getSensitivity(receptor, metYear).first()).projection()
+        record = {
+            'scenario': [scenario, receptor, metYear, emissYear],
+            'month': 'first',
+            'compared': time.strftime('%Y-%m-%d'),
+            'differences': compareWithFusionTable(ee.Image(emissions.first()), ['b1', 'b2'], projection),
+        }
+        with open(COMPARISON_FILE, 'w') as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        print(json.dumps(record, indent=2, sort_keys=True))
+    else:
+        print('usage: regrid.py build | regrid.py compare scenario receptor metYear emissYear')
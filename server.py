@@ -6,171 +6,233 @@ based on user clicks. Info from GAE is then passed to browser to be executed by
 javascript. Uses Jinja2 templating engine to pass info to browser. 
 """
 
+# first, so that its import time marks the start of the instance
+import startup
+
+import functools
+import gzip
+import hashlib
 import json
 import os
+import StringIO
 
 import config
 import ee               # earth engine API
 import jinja2           # templating engine
 import webapp2
-import math
-import time
 
+import cache
+import diagnostics
 import emiss
+import exports
+import graphprofile
 import health
+import jobs
 import land
-
-from google.appengine.api import memcache 
+import parallel
+import provinceids
+import regiontiles
+import regrid
+import store
+import surface
+import uncertainty
 
 ###############################################################################
 #                             Web request handlers.                           #
 ###############################################################################
 
 
-class MainHandler(webapp2.RequestHandler):
+class BaseHandler(webapp2.RequestHandler):
+  """Counts and times the EE round trips made while serving a request."""
+
+  def dispatch(self):
+    debug = self.request.get('debug') == '1' or bool(self.request.headers.get('X-Debug-Diagnostics'))
+    profile_graphs = self.request.get('profile') == 'graphs' or bool(self.request.headers.get('X-Profile-Graphs'))
+    diagnostics.startRequest(self.request.path, debug, profile_graphs)
+    try:
+      APP_INITIALIZED.get()
+      super(BaseHandler, self).dispatch()
+    finally:
+      summary = diagnostics.endRequest()
+      self.response.headers['X-EE-Round-Trips'] = str(summary['round_trips'])
+      self.response.headers['Server-Timing'] = diagnostics.serverTiming(summary)
+      cold_start = startup.recordResponse(self.request.path)
+      if cold_start is not None:
+        self.response.headers['X-Cold-Start'] = '%.3f' % cold_start
+
+  def writeJson(self, value):
+    """Writes value as the JSON response body.
+
+    The body is encoded once and gets an ETag of its content, so a client
+    that already has it gets an empty 304 response. Larger bodies are
+    gzipped for clients that accept it.
+    """
+    body = json.dumps(value, separators=(',', ':'))
+    etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.headers['ETag'] = etag
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.headers['Vary'] = 'Accept-Encoding'
+
+    # frontends may weaken the ETag when they compress, so compare without W/
+    client_etags = [tag.strip().replace('W/', '') for tag in self.request.headers.get('If-None-Match', '').split(',')]
+    if etag in client_etags or '*' in client_etags:
+      self.response.set_status(304)
+      return
+
+    if len(body) >= GZIP_MIN_BYTES and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+      buf = StringIO.StringIO()
+      with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(body)
+      body = buf.getvalue()
+      self.response.headers['Content-Encoding'] = 'gzip'
+    self.response.out.write(body)
+
+  def scenarioParams(self):
+    """Returns the scenario parameters of a /details style request as the
+    keyword arguments of GetScenarioResult."""
+    return {
+        'scenario': self.request.get('scenario'),
+        'receptor': self.request.get('receptor'),
+        'metYear': int(self.request.get('metYear')),
+        'emissYear': int(self.request.get('emissYear')),
+        'logging': self.request.get('logging') == 'true',
+        'oilpalm': self.request.get('oilpalm') == 'true',
+        'timber': self.request.get('timber') == 'true',
+        'peatlands': self.request.get('peatlands') == 'true',
+        'conservation': self.request.get('conservation') == 'true',
+        'BRGsites': self.request.get('BRGsites') == 'true',
+        'provinces': self.request.params.getall('provinces[]'),
+    }
+
+  def respondWithJob(self):
+    """Submits the scenario of the request as a job and writes its record."""
+    params = self.scenarioParams()
+    self.response.headers['Content-Type'] = 'application/json'
+    if params['receptor'] not in RECEPTORS:
+      self.response.set_status(400)
+      self.response.out.write(json.dumps({'error': 'Unrecognized receptor site: ' + params['receptor']}))
+      return
+    job = JOBS.submit(params)
+    self.response.set_status(202)
+    self.response.headers['Location'] = '/jobs/' + job['id']
+    self.response.out.write(json.dumps(job))
+
+
+class MainHandler(BaseHandler):
   """A servlet to handle requests to load the main web page."""
 
   def get(self, path=''):
     """Returns the main web page, populated with EE map."""
 
-    mapIds, tokens, exposure, totalPM, provtotal, mort, totalE = GetMapData('Miriam', 'Singapore', 2006, 2006, False, False, False, False, False, False, [])
+    result = GetScenarioResult(**DEFAULT_SCENARIO)
 
-    print(totalE['bc'])
-
-    print(provtotal)
     # Compute the totals for different provinces.
 
     template_values = {
-        'eeMapId': json.dumps(mapIds),
-        'eeToken': json.dumps(tokens),
-        'boundaries': json.dumps(REGION_IDS),
-        'totalPM' : totalPM['b1'],
-        'provincial': json.dumps(provtotal),
-        'timeseries': json.dumps(exposure),
-        'endeaths': json.dumps(mort[0]),
-        'lndeaths': json.dumps(mort[1]),
-        'pndeaths': json.dumps(mort[2]),
-        'a14deaths': json.dumps(mort[3]),
-        'adultdeaths': json.dumps(mort[4]),
-        'totalE': json.dumps(totalE)
+        'eeMapId': json.dumps(result['mapIds']),
+        'eeToken': json.dumps(result['tokens']),
+        'boundaries': json.dumps(RegionOverlays()),
+        'totalPM' : result['totalPM']['b1'],
+        'provincial': json.dumps(result['provincial']),
+        'timeseries': json.dumps(result['exposure']),
+        'endeaths': json.dumps(result['mort'][0]),
+        'lndeaths': json.dumps(result['mort'][1]),
+        'pndeaths': json.dumps(result['mort'][2]),
+        'a14deaths': json.dumps(result['mort'][3]),
+        'adultdeaths': json.dumps(result['mort'][4]),
+        'totalE': json.dumps(result['totalE'])
     }
-    template = JINJA2_ENVIRONMENT.get_template('index.html')
+    template = JINJA2_ENVIRONMENT.get().get_template('index.html')
     self.response.out.write(template.render(template_values))
 
 
-class ExportHandler(webapp2.RequestHandler):
-    """A servlet to handle requests for image exports."""
-    
-    def DoPost(self):
-        """Kicks off export of an image for the specified year and region.
-        HTTP Parameters:
-        coordinates: The coordinates of the polygon to export.
-        filename: The final filename of the file to create in the user's Drive.
-        client_id: The ID of the client (for the Channel API).
-        year: The year of the image, in "YYYY" format.
-        """
-
-        # Kick off an export runner to start and monitor the EE export task.
-        # Note: The work "task" is used by both Earth Engine and App Engine to refer
-        # to two different things. "TaskQueue" is an async App Engine service.
-        taskqueue.add(url='/details', params={
-            'scenario': self.request.get('scenario'),
-            'receptor': self.request.get('receptor'),
-            'metYear': self.request.get('metYear'),
-            'emissYear': self.request.get('emissYear'),
-            'logging': self.request.get('logging'),
-            'oilpalm': self.request.get('oilpalm'),
-            'timber': self.request.get('timber'),
-            'peatlands': self.request.get('peatlands'),
-            'conservation': self.request.get('conservation'),
-            'provinces': self.request.get('provinces[]'),
-            'BRGsites': self.request.get('BRGsites')}
-            )
-
-class DetailsHandler(webapp2.RequestHandler):
-    """A servlet to handle requests from UI."""
+class ExportHandler(BaseHandler):
+    """A servlet to handle requests for scenario exports."""
 
-    def get(self):
-        scenario = self.request.get('scenario')
-        receptor = self.request.get('receptor')
-        metYear = int(self.request.get('metYear'))
-        emissYear = int(self.request.get('emissYear'))
-        logging = self.request.get('logging')
-        oilpalm = self.request.get('oilpalm')
-        timber = self.request.get('timber')
-        peatlands = self.request.get('peatlands')
-        conservation = self.request.get('conservation')
-        provinces = self.request.params.getall('provinces[]')
-        BRGsites = self.request.get('BRGsites')
-
-        print('scenario', scenario)
-
-        print 'Receptor = ' + receptor
-        print 'Met year = ' + str(metYear)
-        print 'Emissions year = ' + str(emissYear)
-        print 'logging = ' + logging
-        print 'oil palm = ' + oilpalm
-        print 'timber = ' + timber
-        print 'peatlands = ' + peatlands 
-        print 'conservation = ' + conservation
-        print 'provinces = ' + ' '.join(p for p in provinces)
-        print 'brgsites = ' + BRGsites
-
-        # convert to boolean
-        if logging == 'true':
-            logging_bool = True 
-        else:
-            logging_bool = False
+    def post(self):
+        """Queues a scenario job and returns its id. HTTP parameters are
+        those of /details, poll /jobs/<id> for the result."""
+        self.respondWithJob()
 
-        if oilpalm == 'true':
-            oilpalm_bool = True 
-        else:
-            oilpalm_bool = False
 
-        if timber == 'true':
-            timber_bool = True 
-        else:
-            timber_bool = False
+class JobsHandler(BaseHandler):
+    """A servlet to submit scenario jobs."""
 
-        if peatlands == 'true':
-            peatlands_bool = True 
-        else:
-            peatlands_bool = False 
+    def post(self):
+        """Queues a scenario job with the /details parameters and returns its
+        id and status without waiting for the result."""
+        self.respondWithJob()
 
-        if conservation == 'true':
-            conservation_bool = True 
-        else:
-            conservation_bool = False
 
-        if BRGsites == 'true': 
-            BRGsites_bool = True
-        else:
-            BRGsites_bool = False
+class JobHandler(BaseHandler):
+    """A servlet to report the status, stage and result of a job."""
+
+    def get(self, job_id):
+        job = JOBS.get(job_id)
+        self.response.headers['Content-Type'] = 'application/json'
+        if job is None:
+            self.response.set_status(404)
+            self.response.out.write(json.dumps({'error': 'Unknown job: ' + job_id}))
+            return
+        self.response.out.write(json.dumps(job))
 
-        print(logging_bool)
 
-        if receptor in RECEPTORS:
+class JobRunHandler(webapp2.RequestHandler):
+    """Runs a job pushed to the task queue by jobs.TaskQueueBackend."""
 
-            mapIds, tokens, exposure, totalPM, provtotal, mort, totalE = GetMapData(scenario, receptor, metYear, emissYear, logging_bool, oilpalm_bool, timber_bool, peatlands_bool, conservation_bool, BRGsites_bool, provinces)
+    def post(self):
+        JOBS.run(self.request.get('id'))
+
+
+class DetailsHandler(BaseHandler):
+    """A servlet to handle requests from UI."""
+
+    def get(self):
+        params = self.scenarioParams()
+        diagnostics.annotate(**params)
+
+        # ?v=2 selects the compact response, the default is the original one
+        version = self.request.get('v') or '1'
+        # ?uncertainty=N adds Monte Carlo percentile bands from N draws
+        samples = self.request.get('uncertainty')
+        for name, value in [('v', version), ('uncertainty', samples)]:
+            if value and not (value.isdigit() and int(value) >= 1):
+                self.response.set_status(400)
+                self.writeJson({'error': '{} must be a positive integer: {}'.format(name, value)})
+                return
+        version = int(version)
+
+        if params['receptor'] in RECEPTORS:
+
+            result = GetScenarioResult(**params)
         else:
-            mapIds  = json.dumps({'error': 'Unrecognized receptor site: ' + receptor})
-            tokens = json.dumps({'error': 'Unrecognized receptor site: ' + receptor})
+            self.response.set_status(400)
+            self.writeJson({'error': 'Unrecognized receptor site: ' + params['receptor']})
+            return
 
         ## Make new map 
-        template_values = {
-            'eeMapId': json.dumps(mapIds),
-            'eeToken': json.dumps(tokens),
-            'totalPM': totalPM['b1'],
-            'provincial': json.dumps(provtotal),
-            'timeseries': json.dumps(exposure),
-            'endeaths': json.dumps(mort[0]),
-            'lndeaths': json.dumps(mort[1]),
-            'pndeaths': json.dumps(mort[2]),
-            'a14deaths': json.dumps(mort[3]),
-            'adultdeaths': json.dumps(mort[4]),
-            'totalE': json.dumps(totalE)
-        }
-        self.response.out.write(json.dumps(template_values))
+        if version >= 2:
+            template_values = CompactDetailsResponse(result)
+        else:
+            template_values = DetailsResponse(result)
+
+        if samples:
+            samples = min(int(samples), uncertainty.MAX_SAMPLES)
+            components = GetExposureComponentsCached(**params)
+            bands = uncertainty.propagate(components, params['receptor'], samples)
+            template_values['uncertainty'] = bands if version >= 2 else json.dumps(bands)
+
+        # ?resolution=daily adds the exposure of every day of the year
+        if self.request.get('resolution') == 'daily':
+            daily = GetDailyExposureCached(**params)
+            if version >= 2:
+                template_values['daily'] = [[date, _compact(value)] for date, value in daily]
+            else:
+                template_values['daily'] = json.dumps(daily)
+
+        self.writeJson(template_values)
         #self.response.headers['Content-Type'] = 'application/json'
         #self.response.out.write(content)
 
@@ -182,12 +244,132 @@ class DetailsHandler(webapp2.RequestHandler):
         #label = ui.Button('Click me!')
         #slider = ui.Slider()
 
+class BatchHandler(BaseHandler):
+    """A servlet to evaluate the numeric outputs of many scenarios at once."""
+
+    def post(self):
+        """Takes a JSON body {"scenarios": [...], "provincial": false} where
+        every scenario has the /details parameters, and returns a table with
+        a row per scenario (see BatchTable). No map layers are made."""
+        try:
+            body = json.loads(self.request.body)
+            scenarios = [BatchScenario(params) for params in body['scenarios']]
+        except (ValueError, KeyError, TypeError) as e:
+            self.response.set_status(400)
+            self.writeJson({'error': 'Invalid batch request: ' + str(e)})
+            return
+        if len(scenarios) > MAX_BATCH:
+            self.response.set_status(400)
+            self.writeJson({'error': 'At most {} scenarios per batch'.format(MAX_BATCH)})
+            return
+        for params in scenarios:
+            if params['receptor'] not in RECEPTORS:
+                self.response.set_status(400)
+                self.writeJson({'error': 'Unrecognized receptor site: ' + params['receptor']})
+                return
+
+        provincial = bool(body.get('provincial'))
+        self.writeJson(BatchTable(scenarios, EvaluateScenarios(scenarios, provincial), provincial))
+
+class ExportsHandler(BaseHandler):
+    """A servlet to start raster exports and report their progress."""
+
+    def get(self, export_id=None):
+        self.response.headers['Content-Type'] = 'application/json'
+        if export_id is None:
+            self.response.out.write(json.dumps(EXPORTS.list()))
+            return
+        record = EXPORTS.get(export_id)
+        if record is None:
+            self.response.set_status(404)
+            self.response.out.write(json.dumps({'error': 'Unknown export: ' + export_id}))
+            return
+        self.response.out.write(json.dumps(record))
+
+    def post(self, export_id=None):
+        """Starts the exports of the scenario given by /details parameters."""
+        params = self.scenarioParams()
+        self.response.headers['Content-Type'] = 'application/json'
+        if params['receptor'] not in RECEPTORS:
+            self.response.set_status(400)
+            self.response.out.write(json.dumps({'error': 'Unrecognized receptor site: ' + params['receptor']}))
+            return
+        self.response.set_status(202)
+        self.response.out.write(json.dumps(StartScenarioExports(**params)))
+
+class RegionTileHandler(webapp2.RequestHandler):
+    """Serves the precompressed region overlay tiles of regiontiles.py."""
+
+    def get(self, region, zoom, x, y):
+        tile = regiontiles.readTile(region, int(zoom), int(x), int(y))
+        if tile is None:
+            # no features in this tile
+            self.response.set_status(204)
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = 'public, max-age=86400'
+        self.response.headers['Vary'] = 'Accept-Encoding'
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.response.headers['Content-Encoding'] = 'gzip'
+            self.response.out.write(tile)
+        else:
+            self.response.out.write(gzip.GzipFile(fileobj=StringIO.StringIO(tile)).read())
+
+class WarmupHandler(BaseHandler):
+    """Prepares a new instance before App Engine sends it user requests:
+    connects to EE (in dispatch), fetches the land cover map ids and
+    computes the default scenario of the main page."""
+
+    def get(self):
+        land.getLandcoverData()
+        GetScenarioResult(**DEFAULT_SCENARIO)
+        JINJA2_ENVIRONMENT.get().get_template('index.html')
+        REGION_IDS.get()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(startup.stats()))
+
+class CacheStatsHandler(webapp2.RequestHandler):
+    """A servlet to report the hit/miss counts of the result cache and the
+    result store."""
+
+    def get(self):
+        stats = RESULT_CACHE.stats()
+        stats['store'] = RESULT_STORE.stats()
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(stats))
+
+class PrefillHandler(BaseHandler):
+    """Prefills the result store (see store.prefill). A GET queues the
+    prefill as a task, whose POST computes it. Admin only, see app.yaml."""
+
+    def get(self):
+        from google.appengine.api import taskqueue
+        taskqueue.add(url='/admin/prefill', retry_options=taskqueue.TaskRetryOptions(task_retry_limit=PREFILL_RETRIES))
+        self.response.set_status(202)
+        self.writeJson({'queued': True})
+
+    def post(self):
+        # store errors raise, so the task fails and is retried
+        counts, errors = store.prefill(EvaluateScenarios, RESULT_STORE.backend)
+        print('prefilled scenarios by source: {}, {} failed'.format(counts, len(errors)))
+        self.writeJson({'sources': counts, 'errors': errors})
+
 # Define webapp2 routing from URL paths to web request handlers. See:
 # http://webapp-improved.appspot.com/tutorials/quickstart.html
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
+    ('/_ah/warmup', WarmupHandler),
     ('/details', DetailsHandler),
-    ('/export', ExportHandler)
+    ('/batch', BatchHandler),
+    ('/export', ExportHandler),
+    ('/jobs', JobsHandler),
+    ('/jobs/run', JobRunHandler),
+    (r'/jobs/(\w+)', JobHandler),
+    ('/exports', ExportsHandler),
+    (r'/exports/(\w+)', ExportsHandler),
+    (r'/regions/(\w+)/(\d+)/(\d+)/(\d+)\.json', RegionTileHandler),
+    ('/cache/stats', CacheStatsHandler),
+    ('/admin/prefill', PrefillHandler)
 ], debug=True)
 
         
@@ -196,118 +378,537 @@ app = webapp2.WSGIApplication([
 ###############################################################################
 
 def exportTif(image, prefix, receptor):
-    llx = 90
-    lly = -20
-    urx = 150
-    ury = 10
-    geometry = [[llx,lly], [llx,ury], [urx,ury], [urx,lly]]
-    task = ee.batch.Export.image.toCloudStorage(image, 'sens',  bucket='smoke_app_output', fileNamePrefix=prefix + '_'+receptor, region=geometry, scale=927.662423277) 
-    task.start()
-    while task.active():
-        print(task.status())
-        time.sleep(10)
-    print(task.status())
-
-    return
-
-def GetMapData(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
-    """Returns two lists with mapids and tokens of the different map layers"""
-    # a list of ids for different layers
-    mapIds = []
-    tokens = []
-
-    # first layer is land cover
-    landcover_mapids, landcover_tokens = land.getLandcoverData()
-    mapIds.append(landcover_mapids)
-    tokens.append(landcover_tokens)
-
-    # second layer is emissions
-    prov = getProvinceBoundaries()
-    print 'BRGsites before emiss' + str(BRGsites)
-    emissions, total_emissions = emiss.getEmissions(scenario, emissYear, metYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces, prov)
-
-    if scenario == 'GFED4': 
-        scale = 1e9 * 2.592e-6 
+    """Starts the export of image to Cloud Storage and returns its export
+    record without waiting for it, see exports.py."""
+    return EXPORTS.start(image, 'sens', prefix=prefix + '_' + receptor)
+
+def StartScenarioExports(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+    """Starts exports of the emissions, seasonal PM and sensitivity rasters
+    of a scenario and returns their export records."""
+    images = BuildScenarioImages(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    key = cache.scenarioKey(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    name = '{}_{}_{}_{}'.format(scenario, receptor, metYear, emissYear)
+    suffix = key[len(cache.KEY_PREFIX):][:8]
+    return EXPORTS.startMany([
+        (images['emissions_display'], 'emissions', {'prefix': 'emissions_{}_{}'.format(name, suffix)}),
+        (images['seasonal_pm'].divide(ee.Image.pixelArea()), 'pm', {'prefix': 'PM_{}_{}'.format(name, suffix)}),
+        (images['sensitivity'], 'sens', {'prefix': 'sensitivity_{}_{}'.format(receptor, metYear)}),
+    ])
+
+def GetScenarioResult(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces, progress=None, timeout=None):
+    """Returns the full result of a scenario, from the result cache if possible.
+    progress(stage) is called as GetMapData reaches each stage, and timeout
+    is the seconds a single EE call of GetMapData may take.
+
+    Below the result cache is the result store (see store.py), which keeps
+    the numeric outputs but no map ids, so a stored scenario only needs new
+    map layers."""
+    key = cache.scenarioKey(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    result = RESULT_CACHE.get(key)
+    if result is not None:
+        # cached land cover map ids may be older than the ones of land.py
+        landcover_mapids, landcover_tokens = land.getLandcoverData()
+        result = dict(result, mapIds=[landcover_mapids] + result['mapIds'][1:], tokens=[landcover_tokens] + result['tokens'][1:])
     else:
-        scale = 1e9 * 2.592e-6 
+        params = {'scenario': scenario, 'receptor': receptor, 'metYear': metYear, 'emissYear': emissYear, 'logging': logging, 'oilpalm': oilpalm, 'timber': timber, 'peatlands': peatlands, 'conservation': conservation, 'BRGsites': BRGsites, 'provinces': provinces}
+        stored = RESULT_STORE.get(params)
+        mapIds, tokens, exposure, totalPM, provtotal, mort, totalE = GetMapData(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces, progress, stored, timeout)
+        result = {
+            'mapIds': mapIds,
+            'tokens': tokens,
+            'exposure': exposure,
+            'totalPM': totalPM,
+            'provincial': provtotal,
+            'mort': mort,
+            'totalE': totalE,
+            'source': ResultSource(scenario, receptor, metYear, emissYear, stored)
+        }
+        # don't keep results with failed map layers around
+        if all(mapid is not None for layers in mapIds for mapid in layers):
+            RESULT_CACHE.put(key, result)
+        # response surface results are approximate and cheap, only keep EE's
+        if result['source'] == 'ee':
+            RESULT_STORE.put(params, StoredOutputs(result))
+    return result
+
+def ResultSource(scenario, receptor, metYear, emissYear, stored):
+    """Returns where the numeric outputs of a scenario come from: 'store',
+    'surface' (approximate, see surface.py) or 'ee'."""
+    if stored is not None:
+        return 'store'
+    if surface.loadSurface(scenario, receptor, metYear, emissYear) is not None:
+        return 'surface'
+    return 'ee'
+
+def StoredOutputs(result):
+    """Returns the part of a scenario result that is kept in the result store."""
+    return dict((name, result[name]) for name in ['exposure', 'totalPM', 'provincial', 'mort', 'totalE'])
+
+def RegionOverlays():
+    """Returns the region overlays for the client: the regions served as
+    tiles (see regiontiles.py) and the remaining whole GeoJSON files."""
+    tiled = regiontiles.tiledRegions()
+    return {
+        'tiles': {'regions': tiled, 'minZoom': regiontiles.MIN_ZOOM, 'maxZoom': regiontiles.MAX_ZOOM},
+        'files': [region for region in REGION_IDS.get() if region not in tiled],
+    }
 
-    print(ee.Image(emissions.first()).bandNames().getInfo())
-    emissions_display = ee.Image(ee.ImageCollection(emissions.toList(1, 8)).first()).add(ee.Image(ee.ImageCollection(emissions.toList(1,9)).first())) 
-    #exportTif(emissions_display, 'emissions', receptor)
-    mapid = GetMapId(emissions_display.select('b1').add(emissions_display.select('b2')).multiply(scale), maxVal=10, maskValue=1e-6, color='FFFFFF, FFFF00, FFC100, FF7700, DE2700, 761200')
+def DetailsResponse(result):
+    """Returns the /details response of a scenario result."""
+    return {
+        'eeMapId': json.dumps(result['mapIds']),
+        'eeToken': json.dumps(result['tokens']),
+        'totalPM': result['totalPM']['b1'],
+        'provincial': json.dumps(result['provincial']),
+        'timeseries': json.dumps(result['exposure']),
+        'endeaths': json.dumps(result['mort'][0]),
+        'lndeaths': json.dumps(result['mort'][1]),
+        'pndeaths': json.dumps(result['mort'][2]),
+        'a14deaths': json.dumps(result['mort'][3]),
+        'adultdeaths': json.dumps(result['mort'][4]),
+        'totalE': json.dumps(result['totalE']),
+        'source': result.get('source', 'ee')
+    }
+
+def CompactDetailsResponse(result):
+    """Returns version 2 of the /details response of a scenario result.
+
+    Every field is plain JSON (nothing is encoded twice) and the series are
+    numeric arrays: timeseries has one value per month, provincial one value
+    per entry of provinces and deaths one [2.5, 50, 97.5 percentile] triple
+    per entry of ages. source is where the numbers come from, see
+    ResultSource.
+    """
+    return {
+        'version': 2,
+        'eeMapId': result['mapIds'],
+        'eeToken': result['tokens'],
+        'totalPM': _compact(result['totalPM']['b1']),
+        'provinces': [province for province, total in result['provincial']],
+        'provincial': [_compact(total) for province, total in result['provincial']],
+        'timeseries': [_compact(value) for index, value in result['exposure']],
+        'ages': health.AGES,
+        'deaths': [[_compact(value) for value in deaths] for deaths in result['mort']],
+        'totalE': dict((band, _compact(value)) for band, value in result['totalE'].items()),
+        'source': result.get('source', 'ee')
+    }
 
-    mapIds.append([mapid['mapid']])
-    tokens.append([mapid['token']])
+def _compact(value):
+    # 6 significant digits are far more than the inputs support
+    if value is None:
+        return None
+    return float('%.6g' % value)
+
+def RunScenarioJob(params, progress):
+    """Computes the scenario of a job, see jobs.JobQueue."""
+    APP_INITIALIZED.get()
+    # a job runs in a task queue request, with a longer deadline
+    return DetailsResponse(GetScenarioResult(progress=progress, timeout=JOB_CALL_TIMEOUT, **params))
+
+def GetExposureComponentsCached(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+    """Returns GetExposureComponents of a scenario, from the cache if possible."""
+    key = cache.scenarioKey(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces) + ':components'
+    components = COMPONENT_CACHE.get(key)
+    if components is None:
+        components = GetExposureComponents(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+        COMPONENT_CACHE.put(key, components)
+    return components
+
+def GetDailyExposureCached(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+    """Returns the daily exposure series of a scenario, [date, PM] for every
+    day of the meteorological year, from the cache if possible."""
+    key = cache.scenarioKey(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces) + ':daily'
+    daily = COMPONENT_CACHE.get(key)
+    if daily is None:
+        images = BuildScenarioImages(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+        daily_pm = getDailyPM(getSensitivity(receptor, metYear, monthly=False), images['emissions'], metYear)
+        daily = extractDailySeries(diagnostics.getInfo(getDailyTimeSeries(daily_pm), 'daily exposure'))
+        COMPONENT_CACHE.put(key, daily)
+    return daily
+
+def BuildScenarioImages(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces, source=None, sensitivities=None):
+    """Builds (without evaluating) the EE objects of a scenario that the map
+    layers, the numeric outputs and the exports are computed from.
+
+    source (see emiss.getSources) and sensitivities (see getSensitivity) can
+    be passed in to share them between scenarios."""
+    # boundaries of the provincial totals
+    with diagnostics.stage('build-provinces'):
+        prov = getProvinceBoundaries()
+
+    # emissions
+    with diagnostics.stage('build-emissions'):
+        emissions, total_emissions = emiss.getEmissions(scenario, emissYear, metYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces, source=source)
+
+        diagnostics.debugInfo('emission bands', ee.Image(emissions.first()).bandNames())
+        emissions_display = ee.Image(ee.ImageCollection(emissions.toList(1, 8)).first()).add(ee.Image(ee.ImageCollection(emissions.toList(1,9)).first()))
+        #exportTif(emissions_display, 'emissions', receptor)
+
+    # sensitivities and pm
+    with diagnostics.stage('build-sensitivities'):
+        if sensitivities is None:
+            sensitivities = getSensitivity(receptor, metYear)
+        meansens = sensitivities.filterDate(str(metYear)+'-07-01', str(metYear)+'-11-01').mean().set('system:footprint', ee.Image(sensitivities.first()).get('system:footprint'))
+        displaysens = ee.Image(meansens).select('b1').add(meansens.select('b2')).multiply(SCALE_FACTOR*1e3*30*31)
+        diagnostics.debugInfo('sensitivity bands', ee.Image(meansens).bandNames())
 
-    # third layer is sensitivities and pm
-    sensitivities = getSensitivity(receptor, metYear)
-    meansens = sensitivities.filterDate(str(metYear)+'-07-01', str(metYear)+'-11-01').mean().set('system:footprint', ee.Image(sensitivities.first()).get('system:footprint'))
-    displaysens = ee.Image(meansens).select('b1').add(meansens.select('b2')).multiply(SCALE_FACTOR*1e3*30*31)
-    print(ee.Image(meansens).bandNames().getInfo())
-
-    mapid = GetMapId(displaysens, maxVal=0.10, maskValue=0.001, color='FFFFFF, FE9CFF, FF00B4, CC00FF, 5F00E5, 0003AE')
-    mapIds.append([mapid['mapid']])
-    tokens.append([mapid['token']])
-    
-    # fourth layer is PM
     pm = getMonthlyPM(sensitivities, emissions)
 
-    # get pm exposure for every image
-    exposure = getExposureTimeSeries(pm)
+    with diagnostics.stage('build-pm'):
+        # we only want map for Sept + Oct
+        summer_pm = pm.filterDate(str(metYear)+'-07-01', str(metYear)+'-11-01')
+
+        totPM = summer_pm.mean().set('system:footprint', ee.Image(pm.first()).get('system:footprint'))
+        annualPM = pm.mean().set('system:footprint', ee.Image(pm.first()).get('system:footprint'))
+
+    return {
+        'provinces': prov,
+        'emissions': emissions,
+        'total_emissions': total_emissions,
+        'emissions_display': emissions_display,
+        'sensitivities': sensitivities,
+        'sensitivity': displaysens,
+        'pm': pm,
+        'seasonal_pm': totPM,
+        'annual_pm': annualPM,
+    }
 
-    # we only want map for Sept + Oct
-    summer_pm = pm.filterDate(str(metYear)+'-07-01', str(metYear)+'-11-01')
+def ScenarioScalars(images, provincial=True):
+    """Returns an ee.Dictionary of the numeric outputs of a scenario built by
+    BuildScenarioImages, to be fetched in a single evaluation."""
+    pm = images['pm']
+    proj = ee.Image(pm.first()).select('b1').projection()
+    scalars = {}
+    with diagnostics.stage('build-exposure'):
+        # get pm exposure for every image
+        scalars['exposure'] = getExposureTimeSeries(pm)
+    with diagnostics.stage('build-totals'):
+        # the total Jun - Nov mean exposure at receptor
+        scalars['totalPM'] = computeTotal(images['seasonal_pm'], proj)
+        scalars['annualPM'] = computeTotal(images['annual_pm'], proj)
+        scalars['totalE'] = images['total_emissions']
+    if provincial:
+        with diagnostics.stage('build-provincial'):
+            # get provincial totals
+            scalars['provincial'] = computeRegionalTotal(images['seasonal_pm'], images['provinces'], proj)
+    for name, value in sorted(scalars.items()):
+        graphprofile.record(name, value)
+    return ee.Dictionary(scalars)
+
+def EvaluateScenarios(scenarios, provincial=False, result_store=None):
+    """Returns the numeric outputs of many scenarios, a dictionary per scenario.
+
+    Scenarios in the result cache, the result store or with a response
+    surface are answered without EE. The others are sorted by their shared inputs, so that the
+    sensitivities are built once per receptor and meteorological year and
+    the source emissions once per scenario, emissions year and
+    meteorological year, and are evaluated BATCH_SIZE at a time with one
+    getInfo each. EE computes a subexpression that several scenarios of one
+    request share only once. The batches run concurrently. New EE results
+    with provincial totals go to result_store, RESULT_STORE by default.
+    """
+    result_store = result_store or RESULT_STORE
+    outputs = [None] * len(scenarios)
+    uncached = []
+    for i, params in enumerate(scenarios):
+        cached = RESULT_CACHE.get(cache.scenarioKey(**params))
+        if cached is not None:
+            outputs[i] = {'source': 'cache', 'totalPM': cached['totalPM']['b1'], 'totalE': cached['totalE'], 'provincial': cached['provincial'], 'mort': cached['mort']}
+        else:
+            uncached.append(i)
+
+    pending = []
+    stored_outputs = result_store.getMany([scenarios[i] for i in uncached]) if uncached else []
+    for i, stored in zip(uncached, stored_outputs):
+        params = scenarios[i]
+        if stored is not None:
+            outputs[i] = {'source': 'store', 'totalPM': stored['totalPM']['b1'], 'totalE': stored['totalE'], 'provincial': stored['provincial'], 'mort': stored['mort']}
+            continue
+        response_surface = surface.loadSurface(params['scenario'], params['receptor'], params['metYear'], params['emissYear'])
+        if response_surface is not None:
+            exposure, totalPM, annualPM, provtotal, totalE = response_surface.evaluate(params['logging'], params['oilpalm'], params['timber'], params['peatlands'], params['conservation'], params['BRGsites'], params['provinces'])
+            outputs[i] = {'source': 'surface', 'totalPM': totalPM['b1'], 'annualPM': annualPM['b1'], 'totalE': totalE, 'provincial': provtotal}
+            continue
+        pending.append(i)
+
+    def sourceKey(params):
+        return params['scenario'], params['emissYear'], params['metYear']
+
+    def sensitivityKey(params):
+        return params['receptor'], params['metYear']
+
+    pending.sort(key=lambda i: (sourceKey(scenarios[i]), sensitivityKey(scenarios[i])))
+    sources = {}
+    sensitivities = {}
+    calls = []
+    for start in range(0, len(pending), BATCH_SIZE):
+        batch = pending[start:start + BATCH_SIZE]
+        scalars = []
+        for i in batch:
+            params = scenarios[i]
+            if sourceKey(params) not in sources:
+                sources[sourceKey(params)] = emiss.getSources(*sourceKey(params))
+            if sensitivityKey(params) not in sensitivities:
+                sensitivities[sensitivityKey(params)] = getSensitivity(*sensitivityKey(params))
+            images = BuildScenarioImages(source=sources[sourceKey(params)], sensitivities=sensitivities[sensitivityKey(params)], **params)
+            scalars.append(ScenarioScalars(images, provincial))
+        calls.append((tuple(batch), functools.partial(diagnostics.getInfo, ee.List(scalars), '{} batch scenarios'.format(len(batch)))))
+
+    results, errors = parallel.runConcurrently(calls)
+    for batch, values in results.items():
+        for i, value in zip(batch, values):
+            outputs[i] = {
+                'source': 'ee',
+                'exposure': extractTimeSeries(value['exposure']),
+                'totalPM': value['totalPM']['b1'],
+                'annualPM': value['annualPM']['b1'],
+                'totalE': value['totalE'],
+                'provincial': extractRegionalTotals(value['provincial']) if provincial else None,
+            }
+    for batch, error in errors.items():
+        print('batch of {} scenarios failed: {}'.format(len(batch), error))
+        for i in batch:
+            outputs[i] = {'source': 'ee', 'error': str(error)}
+
+    # deaths of all new results in one pass, each with its own receptor
+    new = [i for i in range(len(scenarios)) if 'annualPM' in outputs[i]]
+    if new:
+        receptors = sorted(set(scenarios[i]['receptor'] for i in new))
+        deaths = health.getAttributableMortalityBatch([outputs[i]['annualPM'] for i in new], years=[health.DEFAULT_YEAR], receptors=receptors)
+        for row, i in enumerate(new):
+            outputs[i]['mort'] = deaths[row, :, :, 0, receptors.index(scenarios[i]['receptor'])].T.tolist()
+
+    # EE results with provincial totals are complete enough to store
+    if provincial:
+        result_store.putMany([(scenarios[i], {
+            'exposure': outputs[i]['exposure'],
+            'totalPM': {'b1': outputs[i]['totalPM']},
+            'provincial': outputs[i]['provincial'],
+            'mort': outputs[i]['mort'],
+            'totalE': outputs[i]['totalE'],
+        }) for i in new if outputs[i]['source'] == 'ee'])
+    return outputs
+
+def BatchTable(scenarios, outputs, provincial=False):
+    """Returns the /batch response: the column names and a row per scenario.
+
+    oc and bc are the annual emissions of every scenario, for GFED4 derived
+    from the dry matter bands (emiss.totalOcBc). Deaths are the 50 percentile estimate of every age group (health.AGES),
+    with the 2.5 and 97.5 percentile estimates in the _low and _high
+    columns.
+    """
+    columns = BATCH_PARAMS + ['source', 'error', 'totalPM', 'oc', 'bc']
+    for age in health.AGES:
+        columns += [age + '_deaths', age + '_deaths_low', age + '_deaths_high']
+    if provincial:
+        columns.append('provincial')
+
+    rows = []
+    for params, output in zip(scenarios, outputs):
+        row = [params[name] for name in BATCH_PARAMS] + [output['source'], output.get('error')]
+        if 'error' in output:
+            row += [None] * (len(columns) - len(row))
+        else:
+            oc, bc = emiss.totalOcBc(output['totalE'])
+            row += [_compact(output['totalPM']), _compact(oc), _compact(bc)]
+            for low, mid, high in output['mort']:
+                row += [_compact(mid), _compact(low), _compact(high)]
+            if provincial:
+                row.append(dict((province, _compact(total)) for province, total in output['provincial']))
+        rows.append(row)
+    return {'columns': columns, 'rows': rows}
+
+def BatchScenario(params):
+    """Returns the GetScenarioResult arguments of a scenario of a /batch
+    request. Policy toggles default to off and provinces to none. Raises
+    ValueError for invalid parameters."""
+    emissYear = int(params['emissYear'])
+    if emissYear < emiss.FIRST_EMISS_YEAR:
+        raise ValueError('no emissions before {}: {}'.format(emiss.FIRST_EMISS_YEAR, emissYear))
+    scenario = {
+        'scenario': str(params['scenario']),
+        'receptor': str(params['receptor']),
+        'metYear': int(params['metYear']),
+        'emissYear': emissYear,
+        'provinces': [str(province) for province in params.get('provinces', [])],
+    }
+    for layer in emiss.POLICY_LAYERS:
+        scenario[layer] = _batchToggle(layer, params.get(layer))
+    return scenario
+
+def _batchToggle(layer, value):
+    # JSON booleans or the 'true'/'false' strings of /details
+    if value is True or value == 'true':
+        return True
+    if value is None or value is False or value == 'false':
+        return False
+    raise ValueError('{} must be true or false: {!r}'.format(layer, value))
+
+def GetMapData(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces, progress=None, stored=None, timeout=None):
+    """Returns two lists with mapids and tokens of the different map layers
+
+    With the stored outputs of the scenario (see StoredOutputs) only the map
+    layers are computed. A single EE call may take timeout seconds,
+    parallel.CALL_TIMEOUT by default."""
+    progress = progress or (lambda stage: None)
 
-    totPM = summer_pm.mean().set('system:footprint', ee.Image(pm.first()).get('system:footprint'))
-    annualPM = pm.mean().set('system:footprint', ee.Image(pm.first()).get('system:footprint'))
-    mapid = GetMapId(totPM.divide(ee.Image.pixelArea()).multiply(ee.Image(55.5*74*1000*1000)), maxVal=0.05, color='FFFFFF, FE9CFF, FF00B4, CC00FF, 5F00E5, 0003AE')
-    mapIds[2].append(mapid['mapid'])
-    tokens[2].append(mapid['token'])
-   
-    #exportTif(totPM.divide(ee.Image.pixelArea()), 'Peatprotect_PM', receptor)
+    # second layer is emissions
+    progress('emissions')
+    images = BuildScenarioImages(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    emissions_display = images['emissions_display']
+    displaysens = images['sensitivity']
+    totPM = images['seasonal_pm']
 
-    ## Compute the total Jun - Nov mean exposure at receptor
-    proj = ee.Image(pm.first()).select('b1').projection()
-    totalPM = computeTotal(totPM, proj)
-    annual_PM = computeTotal(annualPM, proj)
+    if scenario == 'GFED4': 
+        scale = 1e9 * 2.592e-6 
+    else:
+        scale = 1e9 * 2.592e-6 
 
-    # get provincial totals
-    provtotal = computeRegionalTotal(totPM, prov, proj)
+    #exportTif(totPM.divide(ee.Image.pixelArea()), 'Peatprotect_PM', receptor)
 
     # fourth layer is health impacts
     pop_img = getPopulationDensity('2010')
-    mapid = GetMapId(pop_img, maxVal=1000, color='FFFFFF, a5ffd8, 3cff00, 30ce00, 218b00, 124000')
-    mapIds.append([mapid['mapid']])
-    tokens.append([mapid['token']])
-
     baseline_mortality = getBaselineMortality()
-    mapid = GetMapId(baseline_mortality, maxVal=1e-2, color='FFFFFF, a5ffd8, 3cff00, 30ce00, 218b00, 124000')
-    mapIds[3].append(mapid['mapid'])
-    tokens[3].append(mapid['token'])
-
-    print('annual pm {}'.format(annual_PM['b1']))
 
-    earlyneonatal_mortality = health.getAttributableMortality(receptor, annual_PM['b1'], 'earlyneonatal')
-    lateneonatal_mortality = health.getAttributableMortality(receptor, annual_PM['b1'], 'lateneonatal')
-    postneonatal_mortality = health.getAttributableMortality(receptor, annual_PM['b1'], 'postneonatal')
-    age14_mortality = health.getAttributableMortality(receptor, annual_PM['b1'], '1-4')
-    adult_mortality = health.getAttributableMortality(receptor, annual_PM['b1'], 'adult')
+    # none of these depend on each other, so they are requested concurrently
+    calls = [
+        ('emissions', functools.partial(GetMapId, emissions_display.select('b1').add(emissions_display.select('b2')).multiply(scale), maxVal=10, maskValue=1e-6, color='FFFFFF, FFFF00, FFC100, FF7700, DE2700, 761200', label='emissions')),
+        ('sensitivity', functools.partial(GetMapId, displaysens, maxVal=0.10, maskValue=0.001, color='FFFFFF, FE9CFF, FF00B4, CC00FF, 5F00E5, 0003AE', label='sensitivity')),
+        ('seasonal PM', functools.partial(GetMapId, totPM.divide(ee.Image.pixelArea()).multiply(ee.Image(55.5*74*1000*1000)), maxVal=0.05, color='FFFFFF, FE9CFF, FF00B4, CC00FF, 5F00E5, 0003AE', label='seasonal PM')),
+        ('population', functools.partial(GetMapId, pop_img, maxVal=1000, color='FFFFFF, a5ffd8, 3cff00, 30ce00, 218b00, 124000', label='population')),
+        ('baseline mortality', functools.partial(GetMapId, baseline_mortality, maxVal=1e-2, color='FFFFFF, a5ffd8, 3cff00, 30ce00, 218b00, 124000', label='baseline mortality')),
+    ]
+
+    # with a precomputed response surface EE is only needed for the maps
+    response_surface = surface.loadSurface(scenario, receptor, metYear, emissYear)
+    if stored is None and response_surface is None:
+        # all numeric outputs are fetched together in a single evaluation
+        scalars = ScenarioScalars(images)
+
+        def evaluateScalars():
+            # exposure series, totals and provincial totals in one evaluation
+            with diagnostics.stage('outputs'):
+                return diagnostics.getInfo(scalars, 'scalar outputs')
+        calls.append(('scalars', evaluateScalars))
+
+    def getLandcoverData():
+        # first layer is land cover, fetched inline when it is due for refresh
+        with diagnostics.stage('landcover'):
+            return land.getLandcoverData()
+    calls.append(('landcover', getLandcoverData))
+
+    progress('map layers')
+    results, errors = parallel.runConcurrently(calls, timeout=timeout)
+    if 'scalars' in errors:
+        raise errors['scalars']
+    if 'landcover' in errors:
+        raise errors['landcover']
+    landcover_mapids, landcover_tokens = results['landcover']
+    for layer, error in errors.items():
+        print('map layer {} failed: {}'.format(layer, error))
+
+    # a list of ids for different layers, a failed layer gets None
+    mapIds = [landcover_mapids]
+    tokens = [landcover_tokens]
+    for group in MAP_LAYERS:
+        mapIds.append([results[layer]['mapid'] if layer in results else None for layer in group])
+        tokens.append([results[layer]['token'] if layer in results else None for layer in group])
+
+    if stored is not None:
+        return mapIds, tokens, stored['exposure'], stored['totalPM'], stored['provincial'], stored['mort'], stored['totalE']
+
+    if response_surface is not None:
+        with diagnostics.stage('surface'):
+            exposure, totalPM, annual_PM, provtotal, totalE = response_surface.evaluate(logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    else:
+        values = results['scalars']
+        exposure = extractTimeSeries(values['exposure'])
+        totalPM = values['totalPM']
+        annual_PM = values['annualPM']
+        provtotal = extractRegionalTotals(values['provincial'])
+        totalE = values['totalE']
+
+    diagnostics.annotate(annual_pm=annual_PM['b1'])
+
+    progress('health')
+    with diagnostics.stage('health'):
+        # 2.5/50/97.5 percentile deaths of every age group (health.AGES) in one pass
+        deaths = health.getAttributableMortalityBatch(annual_PM['b1'], years=[health.DEFAULT_YEAR], receptors=[receptor])
+        attributable_mortality = deaths[:, :, 0, 0].T.tolist()
+    return mapIds, tokens, exposure, totalPM, provtotal, attributable_mortality, totalE
+
+
+def BuildResponseSurface(scenario, receptor, metYear, emissYear):
+    """Computes the response surface of a scenario (see surface.py).
+
+    For every class of emission cells (policy bits and province) this stores
+    the monthly PM contribution at the receptor and the annual source
+    emissions. Each fine cell contributes its emissions times the sensitivity
+    of its coarse cell, scaled like getMonthlyPM and divided by the number of
+    fine cells averaged into the coarse cell.
+    """
+    if not surface.hasSurface(scenario):
+        raise ValueError('no response surfaces for {} scenarios'.format(scenario))
+    ds_grid = ee.Image('projects/IndonesiaPolicyTool/dsGFEDgrid')
+    region = ee.Geometry.Rectangle([90,-20,150,10])
+
+    # class codes: policy bits and province id (0 outside provinces)
+    names = provinceids.getProvinceNames()
+    classes = emiss.getPolicyBits().multiply(surface.PROVINCE_STRIDE).add(provinceids.getProvinceIds()).int().rename(['class'])
+
+    # emissions without any policy or province masks
+    emissions, total_emissions = emiss.getEmissions(scenario, emissYear, metYear, False, False, False, False, False, False, [])
+    sensitivities = getSensitivity(receptor, metYear)
+    prj = ee.Image(sensitivities.first()).projection()
+    coarse_area = ee.Image.pixelArea().reproject(prj)
 
-    attributable_mortality = [earlyneonatal_mortality, lateneonatal_mortality, postneonatal_mortality, age14_mortality, adult_mortality]
-    return mapIds, tokens, exposure, totalPM, provtotal, attributable_mortality, total_emissions.getInfo() #ee.Feature(None, {'bc': total_emissions.get('bc')}).getInfo()['properties']
+    def contribution(data):
+        sensitivity = ee.Image(ee.List(data).get(0))
+        emission = ee.Image(ee.List(data).get(1))
+        count_image = regrid.count(emission, ['b1'])
+        pm = sensitivity.select('b1').multiply(emission.select('b1')).add(sensitivity.select('b2').multiply(emission.select('b2'))).multiply(ee.Image(SCALE_FACTOR)).multiply(coarse_area).divide(count_image)
+        return pm.rename(['pm']).addBands(classes).reduceRegion(reducer=ee.Reducer.sum().group(groupField=1, groupName='class'), geometry=region, crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale(), maxPixels=1e10).get('groups')
+
+    monthly = sensitivities.toList(12).zip(emissions.toList(12)).map(contribution)
+
+    # annual source emissions per class, as total_emissions in emiss.getEmissions
+    bands = ['b1', 'b2', 'b3', 'b4', 'b5', 'b6'] if scenario == 'GFED4' else ['oc', 'bc']
+    source = emiss.getSourceEmissions(scenario, emissYear, metYear, emiss.getPeatlands()).sum().select(bands)
+    source_totals = source.reproject(crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale()).multiply(ee.Image.pixelArea()).addBands(classes).reduceRegion(reducer=ee.Reducer.sum().repeat(len(bands)).group(groupField=len(bands), groupName='class'), geometry=region, crs=ds_grid.projection(), scale=ds_grid.projection().nominalScale(), maxPixels=1e10).get('groups')
+
+    info = diagnostics.getInfo(ee.Dictionary({'provinces': names, 'monthly': monthly, 'emissions': source_totals}), 'response surface')
+
+    codes = sorted(set(group['class'] for month in info['monthly'] for group in month) | set(group['class'] for group in info['emissions']))
+    pm = dict((code, [0.0] * 12) for code in codes)
+    for month, groups in enumerate(info['monthly']):
+        for group in groups:
+            pm[group['class']][month] = group['sum']
+    source_by_class = dict((group['class'], group['sum']) for group in info['emissions'])
+
+    return {
+        'scenario': scenario,
+        'receptor': receptor,
+        'metYear': metYear,
+        'emissYear': emissYear,
+        'provinces': info['provinces'],
+        'classes': codes,
+        'pm': [pm[code] for code in codes],
+        'emissions': dict((band, [source_by_class.get(code, [0.0] * len(bands))[i] for code in codes]) for i, band in enumerate(bands)),
+    }
 
 
-def GetMapId(image, maxVal=0.1, maskValue=0.000000000001, color='FFFFFF, 220066'):
+def GetMapId(image, maxVal=0.1, maskValue=0.000000000001, color='FFFFFF, 220066', label='layer'):
     """Returns the MapID for a given image."""
     mask = image.gt(ee.Image(maskValue)).int()
     maskedImage = image.updateMask(mask)
 
-    return maskedImage.getMapId({
-        'min': '0',
-        'max': str(maxVal),
-        'format': 'png',
-        'palette': color,
-        })
+    with diagnostics.stage('mapids'):
+        return diagnostics.getMapId(maskedImage, {
+            'min': '0',
+            'max': str(maxVal),
+            'format': 'png',
+            'palette': color,
+            }, label)
 
 def getSensitivity(receptor, year, monthly=True):
     """Gets sensitivity for a particular receptor and meteorological year."""
@@ -322,83 +923,97 @@ def getSensitivity(receptor, year, monthly=True):
 
         return ee.ImageCollection(sensitivities.map(divide_by_days));
     else:
-        sensitivities = ee.ImageCollection('projects/IndonesiaPolicyTool/'+receptor+'_sensitivities').filterDate(str(year)+'-01-01', str(year)+'-12-31')
+        # daily images, up to and including the last day of the year
+        sensitivities = ee.ImageCollection('projects/IndonesiaPolicyTool/'+receptor+'_sensitivities').filterDate(str(year)+'-01-01', str(year+1)+'-01-01')
         return sensitivities
 
 
-def getDailyPM(sensitivities):
-    """Returns daily PM."""
+def getDailyPM(sensitivities, emissions, year):
+    """Returns daily PM at the receptor for a year of monthly emissions.
 
-    # get emissions
-    emiss = ee.Image(0)
+    The daily sensitivities of a month are cumulative: the image of a day is
+    the sensitivity to the emissions from that day to the end of the month.
+    The sensitivity to a single day is the difference to the image of the
+    next day, or the image itself on the last day of the month, and is
+    computed for all days in one mapped pass. Every day gets 1/ndays of the
+    month's emissions, regridded as in getMonthlyPM.
+    """
+    def aggregate_image(image):
+        return regrid.aggregate(image, ['b1', 'b2'])
 
-    def computeDailySensitivity(sensitivity, prev_sensitivities):
-        # first sum up all previous sensitivities, then subtract from current value
-        daily_sensitivity = sensitivity.subtract(ee.ImageCollection(ee.List(prev_sensitivities)).sum())
+    coarse_emissions = emissions.map(aggregate_image).toList(12)
 
-        # append to list
-        return ee.List(prev_sensitivities).add(daily_sensitivity)
+    days = sensitivities.sort('system:time_start', True).toList(366)
+    # pair every day with the next one, the last day with an empty image
+    end = ee.Image.constant([0, 0]).rename(['b1', 'b2']).set('system:time_start', ee.Date.fromYMD(year + 1, 1, 1).millis())
+    pairs = days.zip(days.slice(1).add(end))
 
-    def computePM(sensitivity, pm_values):
-        pm_philic = sensitivity.select('b1').multiply(emiss.select('b1'))
-        pm_phobic = sensitivity.select('b2').multiply(emiss.select('b2'))
-        return ee.List(pm_values).add(pm_philic.add(pm_phobic))
+    def computePM(pair):
+        sensitivity = ee.Image(ee.List(pair).get(0))
+        following = ee.Image(ee.List(pair).get(1))
+        date = ee.Date(sensitivity.get('system:time_start'))
+        same_month = ee.Date(following.get('system:time_start')).get('month').eq(date.get('month'))
+        daily_sensitivity = sensitivity.subtract(following.multiply(same_month))
 
-    all_pm = ee.List([])
+        month_start = ee.Date.fromYMD(date.get('year'), date.get('month'), 1)
+        ndays = month_start.advance(1, 'month').difference(month_start, 'day')
+        emission = ee.Image(coarse_emissions.get(date.get('month').subtract(1)))
+        pm_philic = daily_sensitivity.select('b1').multiply(emission.select('b1'))
+        pm_phobic = daily_sensitivity.select('b2').multiply(emission.select('b2'))
+        pm = pm_philic.add(pm_phobic).multiply(ee.Image(SCALE_FACTOR)).multiply(ee.Image.pixelArea()).divide(ndays)
+        return pm.set('system:footprint', sensitivity.get('system:footprint')).set('system:time_start', sensitivity.get('system:time_start'))
 
-    # iterate over sensitivity files, month by month then day by day
-    for month in range(1,5):
-        monthly_sensitivities = sensitivities.filterDate(str(year) + '-' + str(month).zfill(2) + '-01', str(year) + '-' + str(month+1).zfill(2) + '-01').sort('system:time_start', False)
+    return ee.ImageCollection(pairs.map(computePM))
 
-        first = ee.List([ee.Image(monthly_sensitivities.first())])
-        #first = ee.List([ee.Image(0).select([0], ['b1']).addBands(ee.Image(0).select([0], ['b2']))])
-        daily_sensitivities = ee.ImageCollection(ee.List(ee.ImageCollection(monthly_sensitivities.toList(30, 1)).iterate(computeDailySensitivity, first)))
 
-        first = ee.List([])
-        daily_pm = daily_sensitivities.iterate(computePM, first)
+def getDailyTimeSeries(imageCollection):
+    """Computes the daily exposure at the receptor site. Returns a
+    FeatureCollection, unpack the evaluated result with extractDailySeries."""
 
-        all_pm = all_pm.cat(ee.List(daily_pm))
+    def sumRegion(image):
+        PM_at_receptor = image.reduceRegion(reducer=ee.Reducer.sum().unweighted())
+        return ee.Feature(None, {'b1': PM_at_receptor.get('b1'),
+                                 'date': ee.Date(image.get('system:time_start')).format('YYYY-MM-dd')})
 
-    return ee.ImageCollection(all_pm)
+    return imageCollection.map(sumRegion)
 
 
+def extractDailySeries(exposure):
+    """Returns [date, value] pairs from an evaluated daily exposure series."""
+    return [[feature['properties']['date'], feature['properties']['b1']] for feature in exposure['features']]
+
 
 def getMonthlyPM(sensitivities, emiss):
     """Returns monthly PM"""
 
     # get emissions
     mask = ee.Image('projects/IndonesiaPolicyTool/logging_concessions')
-    print(mask.projection().nominalScale().getInfo())
+    diagnostics.debugInfo('logging mask nominal scale', mask.projection().nominalScale())
 
-    print("sensitivities nominal scale")
-    print(ee.Image(sensitivities.first()).projection().nominalScale().getInfo())
-    print(ee.Image(emiss.first()).projection().nominalScale().getInfo())
+    diagnostics.debugInfo('sensitivities nominal scale', ee.Image(sensitivities.first()).projection().nominalScale())
+    diagnostics.debugInfo('emissions nominal scale', ee.Image(emiss.first()).projection().nominalScale())
    
     # aggregate emissions to coarser grid
-    grid = ee.FeatureCollection('ft:10zDDmOTT43LmBdYb8p93Ki6BbdXjQDLzdi01aF43')
-
     prj = ee.Image(sensitivities.first()).projection()
     def aggregate_image(image):
-        regridded = image.reduceRegions(collection=grid, reducer=ee.Reducer.mean().unweighted(), scale=image.projection().nominalScale())
-        b1 = regridded.reduceToImage(properties=ee.List(['b1']), reducer=ee.Reducer.mean().unweighted()).rename(['b1'])#.reproject(crs=prj, scale=prj.nominalScale())
-        b2 = regridded.reduceToImage(properties=ee.List(['b2']), reducer=ee.Reducer.mean().unweighted()).rename(['b2'])#.reproject(crs=prj, scale=prj.nominalScale())
-        regridded_image = b1.addBands(b2)
-        return regridded_image
+        return regrid.aggregate(image, ['b1', 'b2'])
 
-    coarse_data = emiss.map(aggregate_image)
+    with diagnostics.stage('build-regrid'):
+        coarse_data = emiss.map(aggregate_image)
 
     #exportTif(ee.Image(coarse_data.first()), 'coarse_emissions_', 'test')
-    print(ee.Image(coarse_data.first()).projection().nominalScale().getInfo())
+    diagnostics.debugInfo('coarse emissions nominal scale', ee.Image(coarse_data.first()).projection().nominalScale())
 
     # compute total emissions
     def sum_collection(image, first):
         return ee.Image(first).add(ee.Image(image))
 
-    total_emissions = ee.Image(emiss.iterate(sum_collection, ee.Image(0))).multiply(ee.Image.pixelArea()).reduceRegion(reducer=ee.Reducer.sum().unweighted(), geometry=ee.Geometry.Rectangle([90,-20,150,10]), scale=ee.Image(emiss.first()).projection().nominalScale(), maxPixels=1e9)
-    print("fine total emissions: {}".format(total_emissions.getInfo()))
-    
-    total_emissions = ee.Image(coarse_data.iterate(sum_collection, ee.Image(0))).multiply(ee.Image.pixelArea()).reduceRegion(reducer=ee.Reducer.sum().unweighted(), geometry=ee.Geometry.Rectangle([90,-20,150,10]), scale=prj.nominalScale(), maxPixels=1e9)
-    print("coarse total emissions: {}".format(total_emissions.getInfo()))
+    if diagnostics.isDebug():
+        total_emissions = ee.Image(emiss.iterate(sum_collection, ee.Image(0))).multiply(ee.Image.pixelArea()).reduceRegion(reducer=ee.Reducer.sum().unweighted(), geometry=ee.Geometry.Rectangle([90,-20,150,10]), scale=ee.Image(emiss.first()).projection().nominalScale(), maxPixels=1e9)
+        diagnostics.debugInfo('fine total emissions', total_emissions)
+
+        total_emissions = ee.Image(coarse_data.iterate(sum_collection, ee.Image(0))).multiply(ee.Image.pixelArea()).reduceRegion(reducer=ee.Reducer.sum().unweighted(), geometry=ee.Geometry.Rectangle([90,-20,150,10]), scale=prj.nominalScale(), maxPixels=1e9)
+        diagnostics.debugInfo('coarse total emissions', total_emissions)
     combined_data = sensitivities.toList(12).zip(coarse_data.toList(12))
 
     def computePM(data):
@@ -409,21 +1024,68 @@ def getMonthlyPM(sensitivities, emiss):
         return pm_philic.add(pm_phobic).set('system:footprint', sensitivity.get('system:footprint')).set('system:time_start', sensitivity.get('system:time_start'))
 
     # iterate over all files
-    monthly_pm = combined_data.map(computePM)
+    with diagnostics.stage('build-pm'):
+        monthly_pm = combined_data.map(computePM)
+    graphprofile.record('coarse emissions', coarse_data)
+    graphprofile.record('monthly PM', monthly_pm)
 
     return ee.ImageCollection(ee.List(monthly_pm))
     #return monthly_pm
 
 
+def GetExposureComponents(scenario, receptor, metYear, emissYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+    """Returns the receptor exposure of a scenario per unit emission factor.
+
+    The result is a nested list of shape (12 months, 2 aerosol types, 6 land
+    types): entry [m][a][k] is the month m PM at the receptor of hydrophilic
+    (a = 0) or hydrophobic (a = 1) aerosol from land type k emitted with an
+    emission factor of 1 g/kg DM. The exposure for any emission factors and
+    hydrophilic fractions is a weighted sum of these (see uncertainty.py). All
+    of it is evaluated in one round trip.
+    """
+    components = emiss.getEmissionComponents(scenario, emissYear, metYear, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces)
+    sensitivities = getSensitivity(receptor, metYear)
+
+    def aggregate_image(image):
+        return regrid.aggregate(image, emiss.COMPONENT_BANDS)
+
+    combined_data = sensitivities.toList(12).zip(components.map(aggregate_image).toList(12))
+    philic_bands = ['b1_' + band for band in emiss.COMPONENT_BANDS]
+    phobic_bands = ['b2_' + band for band in emiss.COMPONENT_BANDS]
+
+    def computeComponents(data):
+        sensitivity = ee.Image(ee.List(data).get(0))
+        emission = ee.Image(ee.List(data).get(1))
+        scale = ee.Image(SCALE_FACTOR).multiply(ee.Image.pixelArea())
+        philic = emission.multiply(sensitivity.select('b1')).multiply(scale).rename(philic_bands)
+        phobic = emission.multiply(sensitivity.select('b2')).multiply(scale).rename(phobic_bands)
+        pm = philic.addBands(phobic).set('system:footprint', sensitivity.get('system:footprint'))
+        totals = pm.reduceRegion(reducer=ee.Reducer.sum().unweighted())
+        return ee.Feature(None, totals)
+
+    features = diagnostics.getInfo(ee.FeatureCollection(combined_data.map(computeComponents)), 'exposure components')['features']
+
+    def extractComponents(feature):
+        values = feature['properties']
+        return [[values.get(band) or 0.0 for band in philic_bands], [values.get(band) or 0.0 for band in phobic_bands]]
+
+    return map(extractComponents, features)
+
+
 def getExposureTimeSeries(imageCollection):
-    """Computes the exposure at receptor site"""
+    """Computes the exposure at receptor site. Returns a FeatureCollection,
+    unpack the evaluated result with extractTimeSeries."""
 
     def sumRegion(image):
         PM_at_receptor = image.reduceRegion(reducer=ee.Reducer.sum().unweighted())
         return ee.Feature(None, {'b1': PM_at_receptor.get('b1'),
                                  'index': image.get('system:index')})
 
-    exposure = imageCollection.map(sumRegion).getInfo()
+    return imageCollection.map(sumRegion)
+
+
+def extractTimeSeries(exposure):
+    """Returns [index, value] pairs from an evaluated exposure time series."""
 
     # extract the values
     def extractSum(feature):
@@ -434,15 +1096,16 @@ def getExposureTimeSeries(imageCollection):
 
 
 def computeTotal(image, projection):
-    """Computes total over a specific region"""
+    """Computes total over a specific region. Returns an ee.Dictionary."""
     geom = ee.Geometry.Rectangle([-55, -20, 40, 20]);
     totalValue = image.reduceRegion(reducer=ee.Reducer.sum().unweighted(), maxPixels=1e9, crs=projection)
 
-    return ee.Feature(None, {'b1': totalValue.get('b1')}).getInfo()['properties']
+    return ee.Dictionary({'b1': totalValue.get('b1')})
 
 
 def computeRegionalTotal(image, regions, projection):
-    """Computes the provincial totals"""
+    """Computes the provincial totals. Returns a FeatureCollection, unpack
+    the evaluated result with extractRegionalTotals."""
     provincialTotals = image.reduceRegions(regions, reducer=ee.Reducer.sum().unweighted(), crs=projection)
 
     # remove unncessary info
@@ -450,8 +1113,12 @@ def computeRegionalTotal(image, regions, projection):
         return ee.Feature(None, {'province': ee.Feature(feature).get('NAME_1'), 
                 'regional': ee.Feature(feature).get('sum')})
 
-    stripped_totals = provincialTotals.map(strip).getInfo()
-    
+    return provincialTotals.map(strip)
+
+
+def extractRegionalTotals(stripped_totals):
+    """Returns [province, total] pairs from evaluated provincial totals."""
+
     # extract the totals and only return that
     def getVal(feature):
         return [feature['properties']['province'], feature['properties']['regional']]
@@ -489,9 +1156,28 @@ def getPopulationDensity(year):
 # https://cloud.google.com/appengine/docs/python/memcache/
 MEMCACHE_EXPIRATION = 60 * 60 * 24
 
+# Map ids and tokens returned by getMapId only stay valid for a limited time,
+# so cached scenario results are dropped well before they would go stale.
+MAPID_EXPIRATION = 60 * 60 * 3
+
 POPULATION_DENSITY_COLLECTION_ID = 'CIESIN/GPWv4/unwpp-adjusted-population-density'
 LANDCOVER_COLLECTION_ID = ''
 
+# Scenario of the main page, also computed by the warmup request
+DEFAULT_SCENARIO = {
+    'scenario': 'Miriam',
+    'receptor': 'Singapore',
+    'metYear': 2006,
+    'emissYear': 2006,
+    'logging': False,
+    'oilpalm': False,
+    'timber': False,
+    'peatlands': False,
+    'conservation': False,
+    'BRGsites': False,
+    'provinces': [],
+}
+
 # Receptor sites
 RECEPTORS = ['Singapore', 'Malaysia', 'Indonesia', 'Population_weighted_SEAsia']
 DEFAULT_RECEPTOR = 'Population_weighted_SEAsia'
@@ -505,24 +1191,70 @@ SCALE_FACTOR = 1.0 / (24.0 * 24.0 * 3.0)
 
 REGION_PATH = 'static/regions/'
 
+# JSON responses smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+# Scenarios per /batch request, and scenarios evaluated per getInfo.
+MAX_BATCH = 200
+BATCH_SIZE = 20
+
+# Scenario parameters in the rows of a /batch response
+BATCH_PARAMS = ['scenario', 'receptor', 'metYear', 'emissYear', 'logging', 'oilpalm', 'timber', 'peatlands', 'conservation', 'BRGsites', 'provinces']
+
+# Retries of a failed /admin/prefill task
+PREFILL_RETRIES = 2
+
+# Seconds a single EE call of a job may take, within jobs.TASK_DEADLINE
+JOB_CALL_TIMEOUT = 5 * 60
+
+# Map layers after land cover, grouped as the client indexes them.
+MAP_LAYERS = [
+    ['emissions'],
+    ['sensitivity', 'seasonal PM'],
+    ['population', 'baseline mortality'],
+]
+
 ###############################################################################
 #                               Initialization.                               #
 ###############################################################################
 
 
-# Use our App Engine service account's credentials.
-EE_CREDENTIALS = ee.ServiceAccountCredentials(
-    config.EE_ACCOUNT, config.EE_PRIVATE_KEY_FILE)
+def InitializeApp():
+    """Connects to EE. Runs once, before the first request that needs EE or
+    in the warmup request."""
+    # Initialize the EE API.
+    ee.Initialize(config.getCredentials())
+
+
+def CreateJinjaEnvironment():
+    # Create the Jinja templating system we use to dynamically generate HTML. See:
+    # http://jinja.pocoo.org/docs/dev/
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+        autoescape=True,
+        extensions=['jinja2.ext.autoescape'])
+
+def ListRegionIds():
+    # Read region IDs from the file system
+    return [name.replace('.json', '') for name in os.listdir(REGION_PATH) if name.endswith('.json')]
+
+# Nothing below contacts a service or reads files at import, see startup.py.
+APP_INITIALIZED = startup.Lazy(InitializeApp)
+JINJA2_ENVIRONMENT = startup.Lazy(CreateJinjaEnvironment)
+REGION_IDS = startup.Lazy(ListRegionIds)
+
+# Results of recently computed scenarios.
+RESULT_CACHE = cache.ScenarioCache(MEMCACHE_EXPIRATION, MAPID_EXPIRATION)
+
+# Numeric results that outlive instances and deploys, see store.py.
+RESULT_STORE = store.ResultStore(store.createBackend(config.RESULT_STORE))
 
-# Read region IDs from the file system
-REGION_IDS = [name.replace('.json', '') for name in os.listdir(REGION_PATH)]
+# Raster exports started by this instance.
+EXPORTS = exports.ExportManager(exports.EETaskService(), exports.MemcacheExportStore())
 
-# Create the Jinja templating system we use to dynamically generate HTML. See:
-# http://jinja.pocoo.org/docs/dev/
-JINJA2_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-    autoescape=True,
-    extensions=['jinja2.ext.autoescape'])
+# Scenario jobs, run by the backend chosen in config.JOB_BACKEND.
+JOBS = jobs.JobQueue(RunScenarioJob, jobs.createBackend(config.JOB_BACKEND, '/jobs/run'), jobs.MemcacheJobStore(MAPID_EXPIRATION))
 
-# Initialize the EE API.
-ee.Initialize(EE_CREDENTIALS)
+# exposure components and daily series hold no map ids, so they live as long
+# as memcache allows
+COMPONENT_CACHE = cache.ScenarioCache(MEMCACHE_EXPIRATION, MEMCACHE_EXPIRATION)
@@ -0,0 +1,56 @@
+""" Lazy initialization and cold start measurement
+
+Importing the app does not contact any service: credentials, the EE client,
+templates and file listings are created by Lazy objects on first use, or
+ahead of the first user request by the /_ah/warmup handler. The time from
+importing this module (which server.py does first) to the first response is
+logged once per instance.
+"""
+
+import logging
+import threading
+import time
+
+PROCESS_STARTED = time.time()
+
+
+class Lazy(object):
+    """A value created by factory on the first get(), once per instance."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._created = False
+        self._value = None
+
+    def get(self):
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self.factory()
+                    self._created = True
+        return self._value
+
+    def created(self):
+        return self._created
+
+
+def recordResponse(path):
+    """Logs the import to first response time if this is the instance's first
+    response, and returns it in seconds (None for later responses)."""
+    global _FIRST_RESPONSE
+    with _LOCK:
+        if _FIRST_RESPONSE is not None:
+            return None
+        _FIRST_RESPONSE = time.time() - PROCESS_STARTED
+    logging.info('cold start: %.2f s from import to first response (%s)', _FIRST_RESPONSE, path)
+    return _FIRST_RESPONSE
+
+
+def stats():
+    """Returns the cold start timings of this instance."""
+    return {'uptime': time.time() - PROCESS_STARTED, 'import_to_first_response': _FIRST_RESPONSE}
+
+
+_LOCK = threading.Lock()
+_FIRST_RESPONSE = None
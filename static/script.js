@@ -270,9 +270,18 @@ smoke.App.prototype.openInfowindow = function(event) {
  * Add boundaries to map
  */
 smoke.App.prototype.addBoundaries = function(regions) {
-  regions.forEach((function(region) {
+  // regions is {tiles: {regions, minZoom, maxZoom}, files: [...]}, or a
+  // plain list of whole GeoJSON files
+  var files = $.isArray(regions) ? regions : regions.files;
+  files.forEach((function(region) {
     this.map.data.loadGeoJson('static/regions/' + region + '.json');
   }).bind(this));
+
+  if (!$.isArray(regions) && regions.tiles.regions.length > 0) {
+    this.regionTiles = regions.tiles;
+    this.loadedTiles = {};
+    this.map.addListener('idle', this.loadRegionTiles.bind(this));
+  }
   this.map.data.setStyle(function(feature) {
       var s = feature.getProperty('sum');
       if (s > 0) {
@@ -295,6 +304,86 @@ smoke.App.prototype.addBoundaries = function(regions) {
   });
 };
 
+/**
+ * Loads the region tiles that cover the current viewport at the current zoom.
+ * Features keep their id across tiles and zooms, so the data layer replaces
+ * them with the version of the latest tile instead of drawing them twice.
+ */
+smoke.App.prototype.loadRegionTiles = function() {
+  var bounds = this.map.getBounds();
+  if (!bounds) {
+    return;
+  }
+  var tiles = this.regionTiles;
+  var zoom = Math.max(tiles.minZoom, Math.min(tiles.maxZoom, this.map.getZoom()));
+  var northWest = smoke.App.tileOf(bounds.getSouthWest().lng(), bounds.getNorthEast().lat(), zoom);
+  var southEast = smoke.App.tileOf(bounds.getNorthEast().lng(), bounds.getSouthWest().lat(), zoom);
+
+  tiles.regions.forEach((function(region) {
+    for (var x = northWest[0]; x <= southEast[0]; x++) {
+      for (var y = northWest[1]; y <= southEast[1]; y++) {
+        var path = region + '/' + zoom + '/' + x + '/' + y;
+        if (this.loadedTiles[path]) {
+          continue;
+        }
+        this.loadedTiles[path] = true;
+        $.ajax({url: '/regions/' + path + '.json', dataType: 'json'}).done((function(topology, status, xhr) {
+          // 204 means the tile has no features
+          if (xhr.status == 200) {
+            this.map.data.addGeoJson(smoke.App.decodeTopology(topology));
+          }
+        }).bind(this));
+      }
+    }
+  }).bind(this));
+};
+
+/**
+ * Returns the [x, y] web mercator tile containing a point.
+ */
+smoke.App.tileOf = function(lon, lat, zoom) {
+  var n = Math.pow(2, zoom);
+  lat = Math.max(Math.min(lat, 85.0511), -85.0511) * Math.PI / 180;
+  var x = Math.floor((lon + 180) / 360 * n);
+  var y = Math.floor((1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2 * n);
+  return [Math.min(Math.max(x, 0), n - 1), Math.min(Math.max(y, 0), n - 1)];
+};
+
+/**
+ * Decodes a quantized, delta encoded TopoJSON tile into a GeoJSON
+ * FeatureCollection.
+ */
+smoke.App.decodeTopology = function(topology) {
+  var scale = topology.transform.scale;
+  var translate = topology.transform.translate;
+  var rings = topology.arcs.map(function(arc) {
+    var x = 0, y = 0;
+    return arc.map(function(delta) {
+      x += delta[0];
+      y += delta[1];
+      return [x * scale[0] + translate[0], y * scale[1] + translate[1]];
+    });
+  });
+
+  var features = [];
+  Object.keys(topology.objects).forEach(function(name) {
+    topology.objects[name].geometries.forEach(function(geometry) {
+      features.push({
+        type: 'Feature',
+        id: geometry.id,
+        properties: geometry.properties,
+        geometry: {
+          type: 'MultiPolygon',
+          coordinates: geometry.arcs.map(function(polygon) {
+            return polygon.map(function(ring) { return rings[ring[0]]; });
+          })
+        }
+      });
+    });
+  });
+  return {type: 'FeatureCollection', features: features};
+};
+
 smoke.App.prototype.handlePeatlandHover = function(event) {
   if (smoke.App.BRG == false) {
     this.map.data.setStyle(function(feature) {
@@ -837,12 +926,13 @@ smoke.App.prototype.newScenario = function() {
          peatlands: $('#peatlands').is(':checked'),
          conservation: $('#conservation').is(':checked'),
          provinces: $('#provinces').val(),
-         BRGsites: $('#BRGsites').is(':checked')
+         BRGsites: $('#BRGsites').is(':checked'),
+         v: 2
       },
       function(data) {
-        // Set other map values
-        smoke.App.mapids = JSON.parse(data.eeMapId);
-        smoke.App.tokens = JSON.parse(data.eeToken);
+        // Set other map values (version 2 response, fields are plain JSON)
+        smoke.App.mapids = data.eeMapId;
+        smoke.App.tokens = data.eeToken;
 
         smoke.App.receptor = $('#receptor').val();
         smoke.App.metYear = $('#metYear').val();
@@ -850,15 +940,19 @@ smoke.App.prototype.newScenario = function() {
 
         // Set total PM equal to extracted value
         smoke.App.total_PM = data.totalPM.toFixed(2);
-        smoke.App.provincial = JSON.parse(data.provincial);
-        smoke.App.timeseries = JSON.parse(data.timeseries);
-        console.info(data.timeseries);
-        smoke.App.endeaths = JSON.parse(data.endeaths);
-        smoke.App.lndeaths = JSON.parse(data.lndeaths);
-        smoke.App.pndeaths = JSON.parse(data.pndeaths);
-        smoke.App.a14deaths = JSON.parse(data.a14deaths);
-        smoke.App.adultdeaths = JSON.parse(data.adultdeaths);
-        smoke.App.totalE = JSON.parse(data.totalE);
+        // the charts take [label, value] rows
+        smoke.App.provincial = data.provinces.map(function(province, i) {
+          return [province, data.provincial[i]];
+        });
+        smoke.App.timeseries = data.timeseries.map(function(value, month) {
+          return [String(month), value];
+        });
+        smoke.App.endeaths = data.deaths[data.ages.indexOf('earlyneonatal')];
+        smoke.App.lndeaths = data.deaths[data.ages.indexOf('lateneonatal')];
+        smoke.App.pndeaths = data.deaths[data.ages.indexOf('postneonatal')];
+        smoke.App.a14deaths = data.deaths[data.ages.indexOf('1-4')];
+        smoke.App.adultdeaths = data.deaths[data.ages.indexOf('adult')];
+        smoke.App.totalE = data.totalE;
 
         // Also need to retrieve scenario
         smoke.App.scenario = data.scenario;
@@ -0,0 +1,295 @@
+""" Persistent scenario result store
+
+The numeric outputs of a scenario (exposure, totals, mortality and
+emissions) depend only on its parameters and on the EE assets it reads.
+ResultStore keeps them durably, in Datastore on App Engine or in SQLite for
+local runs, so that they outlive instances and deploys.
+
+Entries are keyed by the scenario key (cache.scenarioKey) plus a fingerprint
+of the update times of the assets of the scenario (scenarioAssets). When an
+asset is replaced its update time changes, and so does the fingerprint, so
+old entries are no longer found. Update times are looked up at most every
+FINGERPRINT_LIFETIME seconds.
+
+Map ids and tokens expire and are not stored: for a stored scenario only
+the map layers are requested from EE again.
+
+The most common scenarios (prefillScenarios) are computed by prefill(). On
+App Engine an admin starts it as a task with a GET of /admin/prefill; with
+the SQLite backend it can also run locally:
+
+    python store.py prefill
+
+Unlike the store of the app, prefill fails on store errors rather than
+logging them.
+"""
+
+import functools
+import hashlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import cache
+import diagnostics
+import emiss
+import parallel
+
+
+class ResultStore(object):
+    """Stores scenario outputs under their parameters and asset versions.
+    Store errors are logged and ignored unless strict is set."""
+
+    def __init__(self, backend, strict=False):
+        self.backend = backend
+        self.strict = strict
+        self._update_times = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, params):
+        """Returns the stored outputs of a scenario, or None.
+
+        params are the keyword arguments of cache.scenarioKey.
+        """
+        return self.getMany([params])[0]
+
+    def getMany(self, scenarios):
+        """Returns the stored outputs of many scenarios, None where missing."""
+        try:
+            payloads = self.backend.getMany(self.keys(scenarios))
+        except Exception as e:
+            if self.strict:
+                raise
+            # the store only saves work, a failing store must not fail requests
+            print('result store lookup failed: {}'.format(e))
+            payloads = [None] * len(scenarios)
+        with self._lock:
+            found = sum(1 for payload in payloads if payload is not None)
+            self.hits += found
+            self.misses += len(payloads) - found
+        return payloads
+
+    def put(self, params, payload):
+        self.putMany([(params, payload)])
+
+    def putMany(self, entries):
+        """Stores (params, payload) pairs. The payloads must be JSON."""
+        if not entries:
+            return
+        try:
+            keys = self.keys([params for params, payload in entries])
+            self.backend.putMany([(key, payload) for key, (params, payload) in zip(keys, entries)])
+        except Exception as e:
+            if self.strict:
+                raise
+            print('result store update failed: {}'.format(e))
+
+    def keys(self, scenarios):
+        """Returns the store keys of scenarios: the scenario key and the
+        fingerprint of STORE_VERSION and their assets."""
+        assets = [scenarioAssets(params['scenario'], params['receptor'], params['emissYear']) for params in scenarios]
+        update_times = self.updateTimes(sorted(set(itertools.chain.from_iterable(assets))))
+        keys = []
+        for params, scenario_assets in zip(scenarios, assets):
+            versions = json.dumps([STORE_VERSION, [[asset, update_times[asset]] for asset in scenario_assets]], separators=(',', ':'))
+            keys.append('{}:{}'.format(cache.scenarioKey(**params), hashlib.sha1(versions).hexdigest()))
+        return keys
+
+    def updateTimes(self, assets):
+        """Returns {asset: update time}, requesting the assets that were not
+        looked up in the last FINGERPRINT_LIFETIME seconds concurrently."""
+        now = time.time()
+        with self._lock:
+            known = dict((asset, self._update_times[asset][0]) for asset in assets
+                         if asset in self._update_times and self._update_times[asset][1] > now)
+        missing = [asset for asset in assets if asset not in known]
+        if missing:
+            shared = memcache.get_multi(missing, key_prefix=ASSET_KEY_PREFIX)
+            calls = [(asset, functools.partial(assetUpdateTime, asset)) for asset in missing if asset not in shared]
+            results, errors = parallel.runConcurrently(calls)
+            if errors:
+                raise errors.values()[0]
+            memcache.set_multi(results, key_prefix=ASSET_KEY_PREFIX, time=FINGERPRINT_LIFETIME)
+            shared.update(results)
+            with self._lock:
+                for asset, update_time in shared.items():
+                    self._update_times[asset] = (update_time, now + FINGERPRINT_LIFETIME)
+            known.update(shared)
+        return known
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def scenarioAssets(scenario, receptor, emissYear):
+    """Returns the ids of the EE assets the outputs of a scenario are computed
+    from. The province boundaries of the provincial totals are a fusion
+    table, which has no update time, and are not included."""
+    assets = COMMON_ASSETS + [SENSITIVITY_ASSET.format(receptor)]
+    if scenario == 'GFED4':
+        assets.append(GFED_ASSET)
+    else:
+        assets.extend(emiss.getLandcoverPeriod(int(emissYear)))
+    return sorted(assets)
+
+
+def assetUpdateTime(asset):
+    """Returns the update time of an asset, as reported by EE."""
+    info = diagnostics.getAssetInfo(asset, 'asset ' + asset)
+    if info is None:
+        raise ValueError('unknown asset ' + asset)
+    # newer API versions report updateTime, older ones a version timestamp
+    return str(info.get('updateTime', info.get('version')))
+
+
+class StoredResult(ndb.Model):
+    """A scenario result in Datastore, with the store key as its id."""
+    payload = ndb.JsonProperty(compressed=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class DatastoreBackend(object):
+    """Keeps results in Datastore."""
+
+    def getMany(self, keys):
+        entities = ndb.get_multi([ndb.Key(StoredResult, key) for key in keys])
+        return [entity.payload if entity is not None else None for entity in entities]
+
+    def putMany(self, entries):
+        ndb.put_multi([StoredResult(id=key, payload=payload) for key, payload in entries])
+
+
+class SqliteBackend(object):
+    """Keeps results in a local SQLite database."""
+
+    def __init__(self, path=None):
+        self.path = path or SQLITE_PATH
+
+    def getMany(self, keys):
+        with self._connect() as connection:
+            rows = connection.execute('SELECT key, payload FROM results WHERE key IN ({})'.format(','.join('?' * len(keys))), keys).fetchall()
+        payloads = dict((key, json.loads(payload)) for key, payload in rows)
+        return [payloads.get(key) for key in keys]
+
+    def putMany(self, entries):
+        now = time.time()
+        with self._connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                   [(key, json.dumps(payload), now) for key, payload in entries])
+
+    def _connect(self):
+        # sqlite3 is not available on App Engine, and connections can't be
+        # shared between threads
+        import sqlite3
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, payload TEXT, created REAL)')
+        return connection
+
+
+def createBackend(name):
+    """Returns the store backend called name ('datastore' or 'sqlite')."""
+    if name == 'datastore':
+        return DatastoreBackend()
+    elif name == 'sqlite':
+        return SqliteBackend()
+    raise ValueError('unknown result store backend {}'.format(name))
+
+
+def prefill(evaluate, backend):
+    """Computes and stores the prefillScenarios in backend. evaluate is
+    server.EvaluateScenarios. Returns the number of scenarios by the source
+    of their outputs ('ee' ones were stored now, 'store' ones before, see
+    EvaluateScenarios) and the errors of the failed ones. Raises on store
+    errors."""
+    scenarios = prefillScenarios()
+    outputs = evaluate(scenarios, provincial=True, result_store=ResultStore(backend, strict=True))
+    counts = {}
+    errors = []
+    for output in outputs:
+        if 'error' in output:
+            errors.append(output['error'])
+        else:
+            counts[output['source']] = counts.get(output['source'], 0) + 1
+    return counts, errors
+
+
+def prefillScenarios():
+    """Returns the scenarios to prefill: every receptor and meteorological
+    year of the client, with the emissions of the same year, with no policy
+    or a single one."""
+    scenarios = []
+    for receptor in PREFILL_RECEPTORS:
+        for year in PREFILL_YEARS:
+            for policy in [None] + emiss.POLICY_LAYERS:
+                params = {
+                    'scenario': PREFILL_SCENARIO,
+                    'receptor': receptor,
+                    'metYear': year,
+                    'emissYear': year,
+                    'provinces': [],
+                }
+                for layer in emiss.POLICY_LAYERS:
+                    params[layer] = layer == policy
+                scenarios.append(params)
+    return scenarios
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+# Assets read by every scenario: the emissions grid, the peat mask, the
+# policy bits, the island and country masks of the transition emissions, the
+# regridding cell ids and the province ids.
+COMMON_ASSETS = [
+    'projects/IndonesiaPolicyTool/dsGFEDgrid',
+    'projects/IndonesiaPolicyTool/peatlands',
+    'projects/IndonesiaPolicyTool/policy_bits',
+    'projects/IndonesiaPolicyTool/island_boundary_null',
+    'projects/IndonesiaPolicyTool/indonesia',
+    'projects/IndonesiaPolicyTool/regrid_fine_cells',
+    'projects/IndonesiaPolicyTool/regrid_coarse_cells',
+    'projects/IndonesiaPolicyTool/province_ids',
+]
+SENSITIVITY_ASSET = 'projects/IndonesiaPolicyTool/{}_monthly_sensitivities'
+GFED_ASSET = 'projects/IndonesiaPolicyTool/gfed4'
+
+# Part of every fingerprint, increment it when the stored outputs of the
+# same assets change (e.g. a change of how a scenario is computed).
+STORE_VERSION = 1
+
+# Seconds between lookups of the update time of an asset.
+FINGERPRINT_LIFETIME = 60 * 10
+ASSET_KEY_PREFIX = 'asset:v1:'
+
+SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.sqlite')
+
+# Scenarios computed by prefill, see prefillScenarios.
+PREFILL_SCENARIO = 'Miriam'
+PREFILL_RECEPTORS = ['Singapore', 'Indonesia', 'Malaysia']
+PREFILL_YEARS = range(2005, 2010)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'prefill':
+        import server
+        if server.config.RESULT_STORE != 'sqlite':
+            sys.exit('the {} store is prefilled by the /admin/prefill task of the app'.format(server.config.RESULT_STORE))
+        server.APP_INITIALIZED.get()
+        counts, errors = prefill(server.EvaluateScenarios, server.RESULT_STORE.backend)
+        print('prefilled scenarios by source: {}, {} failed'.format(counts, len(errors)))
+        for error in sorted(set(errors)):
+            print(error)
+        if errors:
+            sys.exit(1)
+    else:
+        print('usage: store.py prefill')
@@ -0,0 +1,134 @@
+""" Linear response surfaces for receptor PM
+
+Receptor PM is linear in the emissions, and every policy toggle and province
+selection only removes emission cells. So for one scenario, receptor,
+meteorological year and emissions year it is enough to know the monthly PM
+contribution of each disjoint class of emission cells, where a class is a
+combination of policy layer bits (emiss.getPolicyBits) and a province. Any
+combination of toggles is then the sum of the classes it keeps.
+
+Surfaces are computed once on EE by server.BuildResponseSurface and stored
+as JSON in SURFACE_DIR:
+
+    python surface.py build Miriam Singapore 2006 2006
+
+Surfaces are only built and used for the transition scenarios: for GFED4
+GetMapData averages only the remaining cells of a coarse cell, which is not
+linear in the toggles, while the surface would count removed cells as zero.
+Provincial totals are still attributed by the province of the emission cell
+rather than of the coarse cell, so results from a surface are approximate and
+are marked with 'source': 'surface'.
+"""
+
+import json
+import os
+import sys
+import threading
+
+import emiss
+
+
+class ResponseSurface(object):
+    """Precomputed PM contributions of a scenario, by policy/province class."""
+
+    def __init__(self, data):
+        if len(data['provinces']) >= PROVINCE_STRIDE:
+            raise ValueError('{} provinces do not fit in class codes of stride {}'.format(len(data['provinces']), PROVINCE_STRIDE))
+        self.data = data
+        self.provinces = data['provinces']
+        self.bits = [int(code) // PROVINCE_STRIDE for code in data['classes']]
+        self.province_ids = [int(code) % PROVINCE_STRIDE for code in data['classes']]
+
+    def evaluate(self, logging, oilpalm, timber, peatlands, conservation, BRGsites, provinces):
+        """Returns exposure, totalPM, annualPM, provincial totals and total
+        emissions, in the formats GetMapData returns them."""
+        toggles = emiss.policyBitmask(logging, oilpalm, timber, peatlands, conservation, BRGsites)
+        removed = set(self.provinces.index(province) + 1 for province in provinces if province in self.provinces)
+        kept = [i for i in range(len(self.bits)) if self.bits[i] & toggles == 0 and self.province_ids[i] not in removed]
+
+        monthly = [0.0] * 12
+        seasonal_by_province = [0.0] * (len(self.provinces) + 1)
+        for i in kept:
+            pm = self.data['pm'][i]
+            for month in range(12):
+                monthly[month] += pm[month]
+            seasonal_by_province[self.province_ids[i]] += sum(pm[month] for month in SEASON) / len(SEASON)
+
+        exposure = [[str(month), monthly[month]] for month in range(12)]
+        totalPM = {'b1': sum(monthly[month] for month in SEASON) / len(SEASON)}
+        annualPM = {'b1': sum(monthly) / 12.0}
+        provtotal = [[name, seasonal_by_province[i + 1]] for i, name in enumerate(self.provinces)]
+
+        totalE = {}
+        for band, values in self.data['emissions'].items():
+            totalE[band] = sum(values[i] for i in kept)
+        return exposure, totalPM, annualPM, provtotal, totalE
+
+
+def loadSurface(scenario, receptor, metYear, emissYear):
+    """Returns the stored ResponseSurface of a scenario, or None."""
+    if not hasSurface(scenario):
+        return None
+    name = surfaceName(scenario, receptor, metYear, emissYear)
+    with _LOCK:
+        if name not in _LOADED:
+            path = os.path.join(SURFACE_DIR, name + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    _LOADED[name] = ResponseSurface(json.load(f))
+            else:
+                _LOADED[name] = None
+        return _LOADED[name]
+
+
+def saveSurface(data):
+    """Stores the surface data computed by server.BuildResponseSurface."""
+    if not hasSurface(data['scenario']):
+        raise ValueError('no response surfaces for {} scenarios'.format(data['scenario']))
+    name = surfaceName(data['scenario'], data['receptor'], data['metYear'], data['emissYear'])
+    response_surface = ResponseSurface(data)
+    if not os.path.isdir(SURFACE_DIR):
+        os.makedirs(SURFACE_DIR)
+    with open(os.path.join(SURFACE_DIR, name + '.json'), 'w') as f:
+        json.dump(data, f)
+    with _LOCK:
+        _LOADED[name] = response_surface
+
+
+def hasSurface(scenario):
+    """Returns whether response surfaces are exact for scenario."""
+    return scenario not in NONLINEAR_SCENARIOS
+
+
+def surfaceName(scenario, receptor, metYear, emissYear):
+    return '{}_{}_{}_{}'.format(scenario, receptor, int(metYear), int(emissYear))
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+SURFACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'surfaces')
+
+# class code = policy bits * PROVINCE_STRIDE + province id (0 outside provinces)
+PROVINCE_STRIDE = 100
+
+# scenarios whose coarse grid average is not linear in the toggles
+NONLINEAR_SCENARIOS = ['GFED4']
+
+# months (0-based) of the Jul - Oct season used for the seasonal totals
+SEASON = [6, 7, 8, 9]
+
+_LOCK = threading.Lock()
+_LOADED = {}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == 'build' and not hasSurface(sys.argv[2]):
+        print('no response surfaces for {} scenarios, see the module docstring'.format(sys.argv[2]))
+    elif len(sys.argv) == 6 and sys.argv[1] == 'build':
+        import server
+        server.APP_INITIALIZED.get()
+        saveSurface(server.BuildResponseSurface(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5])))
+    else:
+        print('usage: surface.py build scenario receptor metYear emissYear')
@@ -0,0 +1,124 @@
+""" Monte Carlo uncertainty of exposure and health impacts
+
+Samples the OC and BC emission factors, the hydrophilic fractions of OC and
+BC and the concentration response slopes, and returns percentile bands of the
+receptor exposure and the attributable deaths.
+
+Receptor PM is linear in the emission factors and hydrophilic fractions, so
+EE is only asked once per scenario for the exposure per unit emission factor
+of every land type and aerosol type (server.GetExposureComponents). Each draw
+is then a weighted sum of those components, and all draws are evaluated
+together with numpy.
+"""
+
+import numpy as np
+
+import emiss
+import health
+import surface
+
+
+def sampleParameters(samples, seed=None):
+    """Draws the uncertain parameters.
+
+    Returns a dictionary of arrays with one row per draw: oc_ef and bc_ef
+    (samples, land types), oc_philic and bc_philic (samples,), and the
+    concentration response slopes cr_adult and cr_child (samples,).
+    """
+    random = np.random.RandomState(seed)
+    num_types = len(emiss.OC_EF)
+
+    def scaled(values):
+        # lognormal around the central value
+        return np.asarray(values) * np.exp(EF_SIGMA * random.standard_normal((samples, num_types)))
+
+    def splitNormal(low, mid, high):
+        # normal with the 2.5 and 97.5 percentiles of the deterministic curves
+        z = random.standard_normal(samples)
+        slope = np.where(z < 0, mid + z * (mid - low) / 1.96, mid + z * (high - mid) / 1.96)
+        return np.maximum(slope, 0.0)
+
+    return {
+        'oc_ef': scaled(emiss.OC_EF),
+        'bc_ef': scaled(emiss.BC_EF),
+        'oc_philic': random.uniform(OC_PHILIC_RANGE[0], OC_PHILIC_RANGE[1], samples),
+        'bc_philic': random.uniform(BC_PHILIC_RANGE[0], BC_PHILIC_RANGE[1], samples),
+        'cr_adult': splitNormal(*health.CR_SLOPES['adult']),
+        'cr_child': splitNormal(*health.CR_SLOPES['child']),
+    }
+
+
+def exposureSamples(components, params):
+    """Returns the monthly receptor exposure of every draw, (samples, 12).
+
+    components is the (12, 2, land types) result of
+    server.GetExposureComponents.
+    """
+    components = np.asarray(components, dtype=float)
+    oc_philic = params['oc_philic'][:, np.newaxis]
+    bc_philic = params['bc_philic'][:, np.newaxis]
+
+    # kg hydrophilic and hydrophobic OA+BC per kg DM, as in emiss.get_oc_bc
+    philic = (params['oc_ef'] * oc_philic * OA_OC_RATIO + params['bc_ef'] * bc_philic) * 1.0e-3
+    phobic = (params['oc_ef'] * (1 - oc_philic) * OA_OC_RATIO + params['bc_ef'] * (1 - bc_philic)) * 1.0e-3
+
+    emissions = np.concatenate([philic[:, np.newaxis, :], phobic[:, np.newaxis, :]], axis=1)
+    return np.einsum('mak,nak->nm', components, emissions)
+
+
+def propagate(components, receptor, samples=None, seed=None, year=None):
+    """Returns percentile bands of exposure and attributable deaths.
+
+    The result has the PERCENTILES of the monthly exposure ([index, low,
+    median, high] per month, like the exposure time series), of the
+    seasonal and annual mean PM, and of the deaths of every age group.
+    """
+    samples = samples or DEFAULT_SAMPLES
+    params = sampleParameters(samples, seed)
+
+    monthly = exposureSamples(components, params)
+    seasonal = monthly[:, surface.SEASON].mean(axis=1)
+    annual = monthly.mean(axis=1)
+
+    baseline = health.BASELINE_DEATHS[:, health.YEARS.index(str(year or health.DEFAULT_YEAR)), health.RECEPTORS.index(receptor)]
+    mortality = {}
+    for i, age in enumerate(health.AGES):
+        slope = params['cr_adult'] if age == 'adult' else params['cr_child']
+        mortality[age] = percentiles(baseline[i] * health.responseCurve(annual, slope))
+
+    monthly_bands = percentiles(monthly)
+    return {
+        'samples': samples,
+        'percentiles': PERCENTILES,
+        'exposure': [[str(month)] + [band[month] for band in monthly_bands] for month in range(12)],
+        'totalPM': percentiles(seasonal),
+        'annualPM': percentiles(annual),
+        'mortality': mortality,
+    }
+
+
+def percentiles(values):
+    """Returns the PERCENTILES of values over the draws (first axis)."""
+    return [np.percentile(values, q, axis=0).tolist() for q in PERCENTILES]
+
+
+###############################################################################
+#                                   Constants.                                #
+###############################################################################
+
+PERCENTILES = [2.5, 50, 97.5]
+
+DEFAULT_SAMPLES = 10000
+MAX_SAMPLES = 100000
+
+# Emission factors are lognormal around OC_EF and BC_EF with this log
+# standard deviation, independently for every land type and species.
+EF_SIGMA = 0.4
+
+# Hydrophilic fractions of OC and BC, uniform in these ranges (the fixed
+# split in emiss is 0.5 and 0.2).
+OC_PHILIC_RANGE = (0.3, 0.7)
+BC_PHILIC_RANGE = (0.1, 0.3)
+
+# organic aerosol per organic carbon
+OA_OC_RATIO = 2.1